@@ -40,6 +40,7 @@ if __name__ == "__main__":
                 'ssws-server=ssws.service:main', 
                 'ssws-session=ssws.sync:session_main', 
                 'ssws-message=ssws.sync:message_main', 
+                'ssws-bench=ssws.bench:main', 
             ],
         ),
     )
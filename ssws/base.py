@@ -31,12 +31,19 @@ Inbox Model:
                 writable
                     channel_id
         
+        control (only present when the daemon runs with --control journal)
+        
         channels
         
             channel_id
             
                 out (outgoing messages)
                 in (incoming messages)
+                log (retained messages, named by sequence number)
+                overflow (optional, policy for connections which fall behind)
+                handler (optional, what the daemon does with client messages)
+                conflate (optional flag, only the latest message matters)
+                head (the last sequence the daemon assigned)
 
 When the server wants to initiate a message-send to channel:
 
@@ -44,17 +51,48 @@ When the server wants to initiate a message-send to channel:
     
     moves the file into channels/<channel_id>/out
     
-    the daemon's inotify on the channel/out hard-links the message 
-    into each session's channel_id/out where the session has that 
-    channel_id present. outgoing message-send is en-queued for the 
-    session
+    the daemon's inotify on the channel/out moves the message 
+    into channels/<channel_id>/log, assigning it the channel's next 
+    sequence number. The message is stored once, no matter how many 
+    sessions will receive it.
+    
+    each session keeps a cursor (last sequence sent) for each 
+    readable channel, sending to the session's connections sends 
+    everything in the channel's log after the cursor.
+    
+    the log is pruned by age and size, a session granted read 
+    with a "since" sequence will receive everything still in the 
+    log after that sequence. The daemon applies a flag-file's "since" 
+    once (then rewrites it as a plain flag), and records the channel's 
+    head so that sequences carry on after a restart even when the 
+    log is empty.
     
-    in the per-session outgoing operation, iterate through the 
-    set of messages in the queue until there are no messages, for 
-    each message, attempt to write to the socket, IFF we succeed and 
-    get an ack, delete the message, otherwise retry when possible.
+    a channel with a conflate flag-file carries "latest value" 
+    messages: connections are only sent the newest of its pending 
+    messages, new sessions/connections are sent its current (last 
+    logged) message, and the log keeps only that message.
     
 
+Control Journal:
+
+    Watching every session's readable/writable and every channel's 
+    out directory costs kernel inotify watches per session/channel. 
+    When the daemon runs with --control journal it creates the 
+    control directory and watches only that (plus the top-level 
+    session and channel directories), the synchronous API then 
+    also writes:
+    
+        publishes (message or batch files) into control instead of 
+        channels/<channel_id>/out, the channel_id being the prefix 
+        of the message(s)
+        
+        grant/revoke commands (control/*.cmd, one command per line) 
+        alongside the flag files, which remain the persistent record 
+        of the session's permissions
+    
+    control filenames start with a timestamp so that the daemon can 
+    apply them in order.
+
 When the client wants to initiate a message-send to channel:
 
     sends websocket request
@@ -64,24 +102,116 @@ When the client wants to initiate a message-send to channel:
     reads channel from the request, decides whether the 
     channel is in writable. If it is, moves into channels/in
     
-    IFF there's a handler registered for the channel, then 
-    the daemon calls that handler. The most command handler is 
-    going to be "broadcast" (move to out), so likely that 
-    should be a special flag/common operation.
+    the daemon calls the channel's handler (named in its handler 
+    file, default ssws-server --handler), see service.HANDLERS:
     
-    Otherwise, the server is responsible for pulling messages 
-    out of the in-box and deleting them when processed.
+        spool -- publish through the channel's outbox, as 
+        if the server had sent it (the default)
+        
+        broadcast -- publish in memory, straight to the channel's 
+        subscribers without touching the filesystem
+        
+        broadcast-persist -- broadcast, then write the message 
+        into the channel's log (so it survives a restart)
+        
+        inbox -- move into channels/<channel_id>/in, the server is 
+        responsible for pulling messages out of the in-box and 
+        deleting them when processed.
 """
-import os, uuid, shutil, re
+import os, uuid, shutil, re, time
 
 ID_MATCH = re.compile(r'^[-0-9a-zA-Z]+$')
 simple_id = ID_MATCH.match
 
+def intern_id(identifier):
+    """Get the shared copy of a (simple_id validated, so ascii) id"""
+    return intern(str(identifier))
+
+# Default spooling directory (shared by the daemon and its clients)
+DEFAULT_PATH = '/run/shm/ssws'
+# Format of filenames in a channel's log directory
+LOG_FORMAT = '%012d'
+# Content of a flag-file which doesn't carry a "since" sequence
+FLAG_CONTENT = 'flag-file'
+
+# Suffix for spool/log files holding a batch of messages (see encode_batch)
+BATCH_SUFFIX = '.batch'
+# Suffix for control journal files holding commands
+COMMAND_SUFFIX = '.cmd'
+# What to do when a slow connection's outgoing queue is full of a 
+# channel's messages, written to the channel's overflow file
+OVERFLOW_POLICIES = ('drop-oldest', 'drop-newest', 'coalesce', 'disconnect')
+
+def journal_name(suffix=''):
+    """Create a (time-ordered) unique filename for the control journal"""
+    return '%.6f-%s%s'%(time.time(), uuid.uuid4().hex, suffix)
+
+def log_sequence(filename):
+    """Get the (first) sequence number for a log filename (or None)"""
+    try:
+        return int(os.path.basename(filename).split('.', 1)[0])
+    except ValueError:
+        return None
+
+def encode_batch(records):
+    """Encode records as a batch file's content (a series of netstrings)"""
+    return ''.join(['%d:%s,'%(len(record), record) for record in records])
+
+def decode_batch(content):
+    """Get [(offset, length)] for the records in a batch file's content"""
+    result = []
+    position = 0
+    while position < len(content):
+        colon = content.index(':', position)
+        length = int(content[position:colon])
+        offset = colon + 1
+        if content[offset+length:offset+length+1] != ',':
+            raise ValueError("Malformed batch record at %s"%(position, ))
+        result.append((offset, length))
+        position = offset + length + 1
+    return result
+
+def log_records(filename):
+    """Get [(sequence, message)] for a log file (single message or batch)"""
+    sequence = log_sequence(filename)
+    if sequence is None:
+        return []
+    with open(filename, 'rb') as fh:
+        content = fh.read()
+    if not filename.endswith(BATCH_SUFFIX):
+        return [(sequence, content)]
+    return [
+        (sequence + i, content[offset:offset+length])
+        for i, (offset, length) in enumerate(decode_batch(content))
+    ]
+
+def stored_sequence(filename):
+    """Get the sequence recorded in filename (or None)"""
+    try:
+        with open(filename, 'rb') as fh:
+            content = fh.read()
+    except (IOError, OSError):
+        return None
+    try:
+        return int(content)
+    except ValueError:
+        return None
+# the "since" sequence recorded in a readable flag-file (or None)
+flag_since = stored_sequence
+
 class Session(object):
+    # the daemon holds one of these for every session, keep them small
+    __slots__ = (
+        'server', 'session_id', 'session_path', 
+        'outbox_path', 'readable_path', 'writable_path', 
+    )
     def __init__(self, server, session_id):
         self.server = server
         self.session_id = session_id
         self.session_path = server.session_path(session_id)
+        self.outbox_path = os.path.join(self.session_path, 'out')
+        self.readable_path = os.path.join(self.session_path, 'readable')
+        self.writable_path = os.path.join(self.session_path, 'writable')
         self.setup()
     def setup(self):
         _ensure_dirs([self.outbox_path, self.readable_path, self.writable_path])
@@ -94,27 +224,29 @@ class Session(object):
             # something is broken/stale/missing...
             return 0
     
-    @property
-    def outbox_path(self):
-        return os.path.join(self.session_path, 'out')
-    @property
-    def readable_path(self):
-        return os.path.join(self.session_path, 'readable')
-    @property
-    def writable_path(self):
-        return os.path.join(self.session_path, 'writable')
-    
     def cleanup(self):
         shutil.rmtree(self.session_path, True ) # ignore_errors
     
 class Channel(object):
+    __slots__ = (
+        'server', 'channel_id', 'channel_path', 
+        'inbox_path', 'outbox_path', 'log_path', 'overflow_path', 
+        'handler_path', 'conflate_path', 'head_path', 
+    )
     def __init__(self, server, channel_id):
         self.server = server 
         self.channel_id = channel_id
         self.channel_path = server.channel_path(channel_id)
+        self.inbox_path = os.path.join(self.channel_path, 'in')
+        self.outbox_path = os.path.join(self.channel_path, 'out')
+        self.log_path = os.path.join(self.channel_path, 'log')
+        self.overflow_path = os.path.join(self.channel_path, 'overflow')
+        self.handler_path = os.path.join(self.channel_path, 'handler')
+        self.conflate_path = os.path.join(self.channel_path, 'conflate')
+        self.head_path = os.path.join(self.channel_path, 'head')
         self.setup()
     def setup(self):
-        _ensure_dirs([self.inbox_path, self.outbox_path])
+        _ensure_dirs([self.inbox_path, self.outbox_path, self.log_path])
     def mark_active(self):
         os.utime(self.channel_path, None)
     def last_active(self):
@@ -123,26 +255,47 @@ class Channel(object):
         except Exception:
             # something is broken/stale/missing...
             return 0
-    @property
-    def inbox_path(self):
-        return os.path.join(self.channel_path, 'in')
-    @property
-    def outbox_path(self):
-        return os.path.join(self.channel_path, 'out')
     def write(self, message, inbox=False):
         """This is horribly synchronous"""
-        guid = uuid.uuid4().hex
+        return self._spool([self.channel_id+',', message], '', inbox, message)
+    def write_many(self, messages, inbox=False):
+        """Write a batch of messages with a single spool file and rename
+        
+        The batch is published atomically (the daemon sees all of the 
+        messages or none of them), and costs the same handful of 
+        syscalls as a single write(), regardless of size.
+        """
+        prefix = self.channel_id + ','
+        try:
+            content = encode_batch([
+                prefix + (message.encode('utf-8') if isinstance(message, unicode) else message)
+                for message in messages
+            ])
+        except TypeError as err:
+            raise WriteError(str(err), messages)
+        return self._spool([content], BATCH_SUFFIX, inbox, messages)
+    def _spool(self, chunks, suffix, inbox, message):
+        guid = uuid.uuid4().hex + suffix
         filename = os.path.join(self.server.spool_dir, guid)
         if inbox:
             final = os.path.join(self.inbox_path, guid)
+        elif self.server.journal_mode():
+            final = os.path.join(self.server.control_path, journal_name(suffix))
         else:
             final = os.path.join(self.outbox_path, guid)
         assert os.path.exists(self.server.spool_dir)
         try:
             with open(filename, 'wb') as fh:
-                fh.write(self.channel_id+',')
-                fh.write(message)
-            os.rename(filename, final)
+                for chunk in chunks:
+                    fh.write(chunk)
+            try:
+                os.rename(filename, final)
+            except OSError:
+                if inbox or os.path.dirname(final) != self.server.control_path:
+                    raise
+                # daemon has switched out of journal mode
+                final = os.path.join(self.outbox_path, guid)
+                os.rename(filename, final)
         except Exception as err:
             for fn in (filename, final):
                 try:
@@ -158,7 +311,12 @@ class Channel(object):
 def _ensure_dirs(directories):
     for directory in directories:
         if not os.path.exists(directory):
-            os.makedirs(directory, 0775 )
+            try:
+                os.makedirs(directory, 0775 )
+            except OSError:
+                # created by the daemon/another client since we checked
+                if not os.path.isdir(directory):
+                    raise
 
 def _ordered_ls(directory):
     """Do a timestamp-ordered directory listing of a directory"""
@@ -170,21 +328,21 @@ def _ordered_ls(directory):
     filenames = [
         os.path.join(directory, f) for f in os.listdir(directory)
     ]
-    return [
+    return sorted([
         (filename, mtime)
         for (filename, mtime) in [
             (filename, stats(filename))
             for filename in filenames
         ]
         if mtime is not None
-    ]
+    ], key=lambda record: (record[1], record[0]))
     
 
 class Server(object):
     """Server-side (synchronous API)"""
     SESSION_CLASS = Session 
     CHANNEL_CLASS = Channel
-    def __init__(self, base_path='/run/shm/ssws'):
+    def __init__(self, base_path=DEFAULT_PATH):
         self.base_path = base_path
         self.spool_dir = os.path.join(base_path, '.tmp')
         self.setup()
@@ -196,6 +354,15 @@ class Server(object):
     @property
     def channels_path(self):
         return os.path.join(self.base_path, 'channel')
+    @property
+    def publish_path(self):
+        return os.path.join(self.base_path, 'publish.sock')
+    @property
+    def control_path(self):
+        return os.path.join(self.base_path, 'control')
+    def journal_mode(self):
+        """Is the daemon taking publishes/commands via the control journal?"""
+        return os.path.isdir(self.control_path)
     def session_path(self, session_id):
         return os.path.join(self.base_path, 'session', session_id)
     def channel_path(self, channel_id):
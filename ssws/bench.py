@@ -0,0 +1,782 @@
+"""Micro-benchmarks for the ssws daemon's hot paths
+
+Run with:
+
+    python -m ssws.bench fanout --sessions 100 --sessions 10000
+    python -m ssws.bench framing --connections 1000
+    python -m ssws.bench deflate --size 256 --size 4096 --level 1 --level 6
+    python -m ssws.bench decorator --requests 50
+    python -m ssws.bench startup --sessions 100000
+    python -m ssws.bench memory --sessions 100000 --connections 10000
+    python -m ssws.bench workers --workers 0 --workers 2 --clients 1000
+    ssws-bench load --clients 1000 --sessions 100 --channels 10 --rate 500
+
+Most benchmarks drive the service objects directly (no reactor is
+run), so they measure the cost of our own code rather than network
+or browser behaviour. The workers and load benchmarks run a real 
+ssws-server and WebSocket clients in subprocesses; load prints one 
+JSON object per run so results can be compared between releases.
+"""
+import os, sys, time, json, random, shutil, tempfile, socket, struct, subprocess, select
+import argparse
+from twisted.internet import inotify, protocol, reactor
+from twisted.python import filepath
+from . import sync, service, __version__
+from .framing import FrameMaker, WebSocketFactory
+import txws
+
+def temp_spool():
+    """Create a temporary spool directory (in RAM if available)"""
+    base = '/run/shm' if os.path.isdir('/run/shm') else None
+    return tempfile.mkdtemp(prefix='ssws-bench-', dir=base)
+
+def fanout(session_count, subscriber_count=10, message_count=200):
+    """Time Channel.on_outbox_message with session_count idle sessions
+
+    Only subscriber_count of the sessions can read the channel, the
+    rest are connected to the server but idle, so the per-message
+    cost should track subscriber_count, not session_count.
+
+    returns seconds-per-message
+    """
+    path = temp_spool()
+    try:
+        writer = sync.Server(path)
+        for i in range(subscriber_count):
+            writer.session('reader-%s'%(i,)).add_readable('bench')
+        server = service.Server(path, batch_outbox=False)
+        try:
+            for i in range(session_count - subscriber_count):
+                server.session('idle-%s'%(i,))
+            channel = server.channel('bench')
+            source = writer.channel('bench')
+            filenames = [
+                filepath.FilePath(source.write('message %s'%(i,)))
+                for i in range(message_count)
+            ]
+            start = time.time()
+            for filename in filenames:
+                channel.on_outbox_message(None, filename, inotify.IN_MOVED_TO)
+            return (time.time() - start)/message_count
+        finally:
+            server.cleanup()
+    finally:
+        shutil.rmtree(path, True)
+
+class _CountingTransport(object):
+    """Socket stand-in which just counts what is written"""
+    def __init__(self):
+        self.written = 0
+    def write(self, data):
+        self.written += len(data)
+    def registerProducer(self, producer, streaming):
+        pass
+
+def _framed_connections(count, factory):
+    """Create count SSWSProtocols in an established RFC 6455 conversation"""
+    connections = []
+    for i in range(count):
+        websocket = factory.buildProtocol(None)
+        transport = _CountingTransport()
+        transport.protocol = websocket
+        websocket.makeConnection(transport)
+        websocket.state = txws.FRAMES
+        websocket.flavor = txws.RFC6455
+        connections.append(websocket.wrappedProtocol)
+    return connections
+
+def framing(connection_count, shared, payload_size=512, rounds=3):
+    """Time delivering one broadcast message to connection_count connections
+    
+    shared -- whether to write the shared (pre-built) frame or have 
+        txws frame the payload for each connection
+    
+    returns best seconds-per-broadcast over rounds
+    """
+    factory = txws.WebSocketFactory(service.SSWSFactory(None))
+    connections = _framed_connections(connection_count, factory)
+    payload = 'bench,' + 'x'*payload_size
+    best = None
+    for i in range(rounds):
+        message = service.Message('bench', i+1, time.time(), None, len(payload), payload)
+        message.acquire()
+        for connection in connections:
+            connection.SHARED_FRAMES = shared
+            connection.add_message(message)
+        message.release()
+        start = time.time()
+        for connection in connections:
+            connection.send_pending()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+def framing_main(arguments):
+    for count in arguments.connections or [1000, 10000, 50000]:
+        per_connection = framing(count, False, payload_size=arguments.size)
+        shared = framing(count, True, payload_size=arguments.size)
+        print('framing connections=%d per-connection=%.1fms shared=%.1fms'%(
+            count, per_connection * 1000, shared * 1000,
+        ))
+
+class _RequestSession(object):
+    def __init__(self, session_key):
+        self.session_key = session_key
+
+def json_payload(size):
+    """A channel-prefixed JSON payload of about size bytes (a status-update-like list)"""
+    generator = random.Random(size)
+    records, length = [], 0
+    while length < size:
+        record = {
+            'id': generator.randint(0, 100000), 
+            'state': generator.choice(['queued', 'running', 'complete', 'failed']), 
+            'progress': round(generator.random(), 3), 
+            'host': 'worker-%02d'%(generator.randint(0, 40), ), 
+        }
+        records.append(record)
+        length += len(json.dumps(record)) + 2
+    return 'bench,' + json.dumps(records)[:size]
+
+def deflate_cost(payload, level, connection_count=1000, rounds=5):
+    """Cost and savings of permessage-deflate for broadcasting payload
+    
+    returns dict of the (mean) seconds to compress the payload once, 
+    the best (over rounds) seconds to deliver it to connection_count 
+    connections with and without the extension, and the bytes each 
+    connection is sent
+    """
+    maker = FrameMaker(level, threshold=0)
+    start = time.time()
+    for i in range(rounds * 100):
+        maker(payload)
+    compress = (time.time() - start)/(rounds * 100)
+    result = {'level': level, 'size': len(payload), 'compress': compress}
+    for name, negotiated in (('plain', None), ('deflate', maker)):
+        factory = WebSocketFactory(service.SSWSFactory(None), maker)
+        connections = _framed_connections(connection_count, factory)
+        for connection in connections:
+            connection.transport.protocol.deflate = negotiated
+        best = None
+        for i in range(rounds):
+            message = service.Message('bench', i+1, time.time(), None, len(payload), payload)
+            message.acquire()
+            for connection in connections:
+                connection.add_message(message)
+            message.release()
+            start = time.time()
+            for connection in connections:
+                connection.send_pending()
+            duration = time.time() - start
+            if best is None or duration < best:
+                best = duration
+        result[name] = best
+        result[name + '_bytes'] = connections[0].transport.transport.written // rounds
+    return result
+
+def deflate_main(arguments):
+    for size in arguments.size or [256, 1024, 16384]:
+        payload = json_payload(size)
+        for level in arguments.level or [1, 6, 9]:
+            result = deflate_cost(payload, level, arguments.connections)
+            saved = result['plain_bytes'] - result['deflate_bytes']
+            print(
+                'deflate size=%d level=%d compress=%.1fus bytes=%d->%d (%.0f%% saved) '
+                'cpu/KB saved=%.1fus broadcast(%d) plain=%.1fms deflate=%.1fms'%(
+                    size, level, result['compress'] * 1e6, 
+                    result['plain_bytes'], result['deflate_bytes'], 
+                    100.0 * saved / result['plain_bytes'], 
+                    result['compress'] * 1e6 * 1024 / saved if saved > 0 else float('inf'), 
+                    arguments.connections, result['plain'] * 1000, result['deflate'] * 1000, 
+                )
+            )
+
+class _Request(object):
+    """Just enough of a Django request for with_websocket_enable"""
+    def __init__(self, session_key):
+        self.session = _RequestSession(session_key)
+        self.META = {}
+    def get_host(self):
+        return 'localhost:8000'
+    def is_secure(self):
+        return False
+
+def _views(directory, in_process):
+    """Import ssws.views configured to use directory"""
+    from django.conf import settings as django_settings
+    if not django_settings.configured:
+        django_settings.configure()
+    from . import settings, views
+    settings.SETTINGS['directory'] = directory
+    settings.SETTINGS['in_process'] = in_process
+    return views
+
+def decorator(request_count, in_process, refresh=False):
+    """Time with_websocket_enable per request with in-process or ssws-session grants
+    
+    refresh -- if True, every request uses the same session (i.e. 
+        page refreshes, which should find the grants already made)
+    
+    returns seconds-per-request
+    """
+    path = temp_spool()
+    try:
+        views = _views(path, in_process)
+        view = views.with_websocket_enable(
+            read_channels=['default'], 
+            write_channels=['chat'], 
+            enable_callback=views.default_callback, 
+        )(lambda request: None)
+        start = time.time()
+        for i in range(request_count):
+            view(_Request('bench' if refresh else 'bench-%s'%(i, )))
+        return (time.time() - start)/request_count
+    finally:
+        shutil.rmtree(path, True)
+
+def decorator_main(arguments):
+    for in_process, refresh, label in (
+        (False, False, 'subprocess'), 
+        (True, False, 'in-process'), 
+        (True, True, 'in-process-refresh'), 
+    ):
+        per_request = decorator(arguments.requests, in_process, refresh)
+        print('decorator grants=%s per-request=%.2fms'%(label, per_request * 1000))
+
+def fanout_main(arguments):
+    for count in arguments.sessions or [100, 1000, 10000]:
+        per_message = fanout(
+            count,
+            subscriber_count=arguments.subscribers,
+            message_count=arguments.messages,
+        )
+        print('fanout sessions=%d subscribers=%d per-message=%.1fus'%(
+            count, arguments.subscribers, per_message * 1000000,
+        ))
+
+def startup_spool(session_count, channel_count=10):
+    """Create a spool of session_count sessions, each reading one of channel_count channels"""
+    path = temp_spool()
+    writer = sync.Server(path)
+    for i in range(session_count):
+        writer.session('session-%s'%(i, )).add_readable('channel-%s'%(i % channel_count, ))
+    return path
+
+def startup(path, lazy):
+    """Time starting a (journal mode) daemon on path
+    
+    returns (seconds until serving, seconds until everything is loaded)
+    """
+    start = time.time()
+    server = service.Server(path, control='journal', lazy=lazy)
+    try:
+        serving = time.time() - start
+        while server.rehydrate():
+            pass
+        return serving, time.time() - start
+    finally:
+        server.cleanup()
+
+def startup_main(arguments):
+    for count in arguments.sessions or [100000]:
+        path = startup_spool(count)
+        try:
+            for lazy, label in ((False, 'eager'), (True, 'lazy')):
+                serving, loaded = startup(path, lazy)
+                print('startup sessions=%d mode=%s serving=%.3fs loaded=%.3fs'%(
+                    count, label, serving, loaded, 
+                ))
+        finally:
+            shutil.rmtree(path, True)
+
+def resident():
+    """Current resident set size of this process in bytes"""
+    with open('/proc/self/statm') as fh:
+        return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def memory(session_count, connection_count, channel_count=3):
+    """Measure the daemon's memory per idle session and per connection
+    
+    Sessions read channel_count channels each, every connection is 
+    attached to its own session.
+    
+    returns (bytes-per-session, bytes-per-connection)
+    """
+    path = startup_spool(0)
+    try:
+        writer = sync.Server(path)
+        for i in range(session_count):
+            writer.session('session-%s'%(i, )).grant(
+                readable=['channel-%s'%(j, ) for j in range(channel_count)]
+            )
+        before = resident()
+        server = service.Server(path, control='journal', lazy=False)
+        try:
+            per_session = (resident() - before) / float(session_count or 1)
+            before = resident()
+            factory = txws.WebSocketFactory(service.SSWSFactory(server))
+            connections = _framed_connections(connection_count, factory)
+            for i, connection in enumerate(connections):
+                connection._session = server.session('session-%s'%(i % session_count, ))
+                connection._session.protocols.append(connection)
+            per_connection = (resident() - before) / float(connection_count or 1)
+            return per_session, per_connection
+        finally:
+            server.cleanup()
+    finally:
+        shutil.rmtree(path, True)
+
+def memory_main(arguments):
+    per_session, per_connection = memory(arguments.sessions, arguments.connections)
+    print('memory sessions=%d connections=%d per-session=%dB per-connection=%dB'%(
+        arguments.sessions, arguments.connections, per_session, per_connection, 
+    ))
+
+class _Client(protocol.Protocol):
+    """Minimal WebSocket (RFC 6455) client counting the messages it receives
+    
+    If latencies is passed (a _Sample) the messages are expected to 
+    carry the time.time() at which they were published as the first 
+    (space separated) token of their data, and the latency is recorded.
+    """
+    def __init__(self, session_id, prefix, latencies=None):
+        self.session_id = session_id
+        self.prefix = prefix
+        self.latencies = latencies
+        self.received = 0
+        self.buffer = ''
+        self.upgraded = False
+    def connectionMade(self):
+        self.transport.write(
+            'GET /ws/%s HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+            'Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+            'Sec-WebSocket-Version: 13\r\n\r\n'%(self.session_id, )
+        )
+    def send(self, data):
+        """Send data as a (masked, as required of clients) text frame"""
+        mask = os.urandom(4)
+        masked = ''.join([
+            chr(ord(character) ^ ord(mask[i % 4])) for i, character in enumerate(data)
+        ])
+        assert len(data) < 126
+        self.transport.write(chr(0x81) + chr(0x80 | len(data)) + mask + masked)
+    def dataReceived(self, data):
+        self.buffer += data
+        if not self.upgraded:
+            if '\r\n\r\n' not in self.buffer:
+                return
+            _, self.buffer = self.buffer.split('\r\n\r\n', 1)
+            self.upgraded = True
+            self.send(',{}')
+        while len(self.buffer) >= 2:
+            length, start = ord(self.buffer[1]) & 0x7f, 2
+            if length == 126:
+                if len(self.buffer) < 4:
+                    return
+                length, start = struct.unpack('!H', self.buffer[2:4])[0], 4
+            elif length == 127:
+                if len(self.buffer) < 10:
+                    return
+                length, start = struct.unpack('!Q', self.buffer[2:10])[0], 10
+            if len(self.buffer) < start + length:
+                return
+            payload = self.buffer[start:start+length]
+            self.buffer = self.buffer[start+length:]
+            if payload.startswith(self.prefix):
+                self.received += 1
+                if self.latencies is not None:
+                    published = payload.split(',', 1)[1].split(' ', 1)[0]
+                    self.latencies.add(time.time() - float(published))
+
+class _Sample(object):
+    """Uniform (reservoir) sample of at most size values"""
+    def __init__(self, size=20000):
+        self.size = size
+        self.count = 0
+        self.values = []
+    def add(self, value):
+        self.count += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < self.size:
+                self.values[index] = value
+
+def percentiles(values, points=(50, 90, 99, 99.9)):
+    """Map 'p<point>' (and 'max') to the nearest-rank percentiles of values"""
+    values = sorted(values)
+    if not values:
+        return {}
+    result = dict([
+        ('p%s'%(point, ), values[min((len(values) - 1, int(len(values) * point / 100.0)))])
+        for point in points
+    ])
+    result['max'] = values[-1]
+    return result
+
+def _wait_for_port(port, timeout=10.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(.1)
+    raise RuntimeError('Server did not start listening on %s'%(port, ))
+
+def _free_port():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+def clients_main(arguments):
+    """Connect clients, report "ready", then a JSON summary on stdout
+    
+    With --messages each client waits for that many messages, with 
+    --messages 0 the clients run until a line (or EOF) arrives on stdin.
+    """
+    numbers = range(arguments.first, arguments.first + arguments.clients)
+    if arguments.sessions:
+        numbers = [number % arguments.sessions for number in numbers]
+    port, message_count, timeout = arguments.port, arguments.messages, arguments.timeout
+    latencies = _Sample() if arguments.latency else None
+    clients = [
+        _Client('client-%s'%(number, ), arguments.prefix, latencies) for number in numbers
+    ]
+    for client in clients:
+        factory = protocol.ClientFactory()
+        factory.protocol = lambda client=client: client
+        reactor.connectTCP('127.0.0.1', port, factory)
+    state = {}
+    def check():
+        now = time.time()
+        if 'connected' not in state:
+            if all([client.upgraded for client in clients]):
+                state['connected'] = now
+        elif 'ready' not in state:
+            # give the server a moment to register the connections
+            if now - state['connected'] > .5:
+                sys.stdout.write('ready\n')
+                sys.stdout.flush()
+                state['ready'] = now
+        else:
+            received = sum([client.received for client in clients])
+            if message_count:
+                finished = received >= len(clients) * message_count
+            else:
+                finished = bool(select.select([sys.stdin], [], [], 0)[0])
+            if finished or now - state['ready'] > timeout:
+                sys.stdout.write(json.dumps({
+                    'received': received, 
+                    'end': now, 
+                    'latencies': latencies.values if latencies else [], 
+                })+'\n')
+                sys.stdout.flush()
+                reactor.stop()
+                return
+        reactor.callLater(.01, check)
+    check()
+    reactor.run()
+
+def _read_line(fd, timeout):
+    line = ''
+    end = time.time() + timeout
+    while not line.endswith('\n'):
+        if not select.select([fd], [], [], max((0, end - time.time())))[0]:
+            raise RuntimeError('Timed out waiting for client process')
+        data = os.read(fd, 1)
+        if not data:
+            raise RuntimeError('Client process exited')
+        line += data
+    return line.strip()
+
+def _start_daemon(path, port, worker_count=0):
+    """Start ssws-server on path listening on port, wait until it is listening"""
+    command = [
+        sys.executable, '-m', 'ssws.service', '-d', path, 
+        '-l', 'tcp:%s:interface=127.0.0.1:backlog=1024'%(port, ), '--control', 'journal', 
+    ]
+    if worker_count:
+        command.extend(['--workers', str(worker_count)])
+    with open(os.devnull, 'w') as null:
+        daemon = subprocess.Popen(command, stderr=null)
+    try:
+        _wait_for_port(port)
+    except Exception:
+        daemon.terminate()
+        daemon.wait()
+        raise
+    return daemon
+
+def _start_clients(port, client_count, processes, extra, timeout):
+    """Start clients_main processes, wait until all of them are ready"""
+    children = []
+    for i in range(processes):
+        first = i * client_count // processes
+        children.append(subprocess.Popen([
+            sys.executable, '-m', 'ssws.bench', 'clients', '--port', str(port), 
+            '--first', str(first), 
+            '--clients', str((i + 1) * client_count // processes - first), 
+            '--timeout', str(timeout), 
+        ] + list(extra), stdin=subprocess.PIPE, stdout=subprocess.PIPE))
+    for child in children:
+        _read_line(child.stdout.fileno(), timeout)
+    return children
+
+def _stop(daemon, children, path):
+    for child in children:
+        if child.poll() is None:
+            child.terminate()
+        child.wait()
+    if daemon:
+        daemon.terminate()
+        daemon.wait()
+    shutil.rmtree(path, True)
+
+def process_usage(pid):
+    """(resident bytes, cpu seconds) of process pid and its children (e.g. workers)"""
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                stat = open('/proc/%s/stat'%(entry, )).read()
+            except IOError:
+                continue
+            if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+                pids.append(int(entry))
+    resident, cpu = 0, 0.0
+    for current in pids:
+        try:
+            fields = open('/proc/%s/stat'%(current, )).read().rsplit(')', 1)[1].split()
+            pages = int(open('/proc/%s/statm'%(current, )).read().split()[1])
+        except IOError:
+            continue
+        resident += pages * os.sysconf('SC_PAGE_SIZE')
+        cpu += (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+    return resident, cpu
+
+def throughput(worker_count, client_count, message_count, processes=1, payload_size=128, timeout=60.0):
+    """Deliveries per second from an ssws-server (with worker_count workers) to client_count clients
+    
+    Every client reads the one channel, the clients are spread over 
+    processes client processes (see clients_main), message_count messages are 
+    published (in batches) and we time until every client has all of them.
+    
+    returns (deliveries-per-second, deliveries, expected deliveries)
+    """
+    path = temp_spool()
+    port = _free_port()
+    writer = sync.Server(path)
+    for i in range(client_count):
+        writer.session('client-%s'%(i, )).add_readable('bench')
+    daemon, children = None, []
+    try:
+        daemon = _start_daemon(path, port, worker_count)
+        children = _start_clients(
+            port, client_count, processes, ['--messages', str(message_count)], timeout, 
+        )
+        payload = 'x' * payload_size
+        start = time.time()
+        channel = writer.channel('bench')
+        for offset in range(0, message_count, 100):
+            channel.write_many([payload] * min((100, message_count - offset)))
+        delivered, end = 0, start
+        for child in children:
+            report = json.loads(_read_line(child.stdout.fileno(), timeout * 2))
+            delivered += report['received']
+            end = max((end, report['end']))
+        return delivered / (end - start), delivered, client_count * message_count
+    finally:
+        _stop(daemon, children, path)
+
+def workers_main(arguments):
+    for count in arguments.workers or [0, 2]:
+        rate, delivered, expected = throughput(
+            count, arguments.clients, arguments.messages, processes=arguments.processes, 
+        )
+        print('workers workers=%d clients=%d messages=%d delivered=%d/%d rate=%.0f/s'%(
+            count, arguments.clients, arguments.messages, delivered, expected, rate, 
+        ))
+
+def load(client_count, session_count, channel_count, rate, duration, 
+         payload_size=64, worker_count=0, processes=1, settle=2.0, timeout=60.0):
+    """End-to-end load test of an ssws-server, returns a dictionary of results
+    
+    client_count clients connect as session_count sessions (client i uses 
+    session i % session_count), session j can read channel j % channel_count.
+    Messages carrying their publication time are written round-robin 
+    to the channels with sync.Channel.write at rate messages/second for 
+    duration seconds, then we wait settle seconds for the deliveries.
+    
+    Latencies are in milliseconds, daemon usage includes any workers.
+    """
+    session_count = min((session_count, client_count))
+    path = temp_spool()
+    port = _free_port()
+    writer = sync.Server(path)
+    for j in range(session_count):
+        writer.session('client-%s'%(j, )).add_readable('load-%s'%(j % channel_count, ))
+    channels = [writer.channel('load-%s'%(k, )) for k in range(channel_count)]
+    subscribers = [0] * channel_count
+    for i in range(client_count):
+        subscribers[(i % session_count) % channel_count] += 1
+    daemon, children = None, []
+    try:
+        daemon = _start_daemon(path, port, worker_count)
+        children = _start_clients(port, client_count, processes, [
+            '--messages', '0', '--sessions', str(session_count), 
+            '--prefix', 'load-', '--latency', 
+        ], timeout)
+        _, cpu_before = process_usage(daemon.pid)
+        padding = 'x' * max((0, payload_size - 18))
+        published = expected = 0
+        start = time.time()
+        while True:
+            elapsed = time.time() - start
+            if elapsed >= duration:
+                break
+            for _ in range(min((int(elapsed * rate), int(duration * rate))) - published):
+                index = published % channel_count
+                channels[index].write('%.6f %s'%(time.time(), padding))
+                expected += subscribers[index]
+                published += 1
+            time.sleep(.001)
+        elapsed = time.time() - start
+        time.sleep(settle)
+        resident, cpu_after = process_usage(daemon.pid)
+        received, latencies = 0, []
+        for child in children:
+            child.stdin.write('stop\n')
+            child.stdin.flush()
+        for child in children:
+            report = json.loads(_read_line(child.stdout.fileno(), timeout))
+            received += report['received']
+            latencies.extend(report['latencies'])
+        return {
+            'clients': client_count, 
+            'sessions': session_count, 
+            'channels': channel_count, 
+            'workers': worker_count, 
+            'payload_bytes': payload_size, 
+            'duration': elapsed, 
+            'published': published, 
+            'publish_rate': published / elapsed, 
+            'delivered': received, 
+            'expected': expected, 
+            'delivery_rate': received / elapsed, 
+            'latency_ms': dict([
+                (key, value * 1000.0) for key, value in percentiles(latencies).items()
+            ]), 
+            'daemon_rss_bytes': resident, 
+            'daemon_cpu_seconds': cpu_after - cpu_before, 
+            'daemon_cpu_percent': 100.0 * (cpu_after - cpu_before) / (elapsed + settle), 
+        }
+    finally:
+        _stop(daemon, children, path)
+
+def load_main(arguments):
+    for rate in arguments.rate or [100]:
+        result = load(
+            arguments.clients, arguments.sessions, arguments.channels, rate, 
+            arguments.duration, payload_size=arguments.size, 
+            worker_count=arguments.workers, processes=arguments.processes, 
+        )
+        result['version'] = __version__
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
+
+parser = argparse.ArgumentParser(description='Run micro-benchmarks against the ssws daemon code')
+subparsers = parser.add_subparsers()
+fanout_parser = subparsers.add_parser('fanout', help='Per-message outbox fan-out cost as idle session count grows')
+fanout_parser.add_argument('--sessions', metavar='COUNT', type=int, action='append',
+                   help='Total number of sessions (argument can be repeated)')
+fanout_parser.add_argument('--subscribers', metavar='COUNT', type=int, default=10,
+                   help='Number of sessions which can read the benchmark channel')
+fanout_parser.add_argument('--messages', metavar='COUNT', type=int, default=200,
+                   help='Number of messages to publish per run')
+fanout_parser.set_defaults(function=fanout_main)
+framing_parser = subparsers.add_parser('framing', help='Broadcast cost with per-connection vs shared WebSocket framing')
+framing_parser.add_argument('--connections', metavar='COUNT', type=int, action='append',
+                   help='Number of connections receiving the broadcast (argument can be repeated)')
+framing_parser.add_argument('--size', metavar='BYTES', type=int, default=512,
+                   help='Size of the broadcast payload')
+framing_parser.set_defaults(function=framing_main)
+deflate_parser = subparsers.add_parser('deflate', help='CPU cost of permessage-deflate against the bytes it saves per broadcast')
+deflate_parser.add_argument('--size', metavar='BYTES', type=int, action='append',
+                   help='Size of the (JSON) broadcast payload (argument can be repeated)')
+deflate_parser.add_argument('--level', metavar='LEVEL', type=int, action='append',
+                   help='zlib compression level (argument can be repeated)')
+deflate_parser.add_argument('--connections', metavar='COUNT', type=int, default=1000,
+                   help='Number of connections receiving the broadcast')
+deflate_parser.set_defaults(function=deflate_main)
+decorator_parser = subparsers.add_parser('decorator', help='Request overhead of with_websocket_enable (ssws-session vs in-process grants)')
+decorator_parser.add_argument('--requests', metavar='COUNT', type=int, default=50,
+                   help='Number of requests to time')
+decorator_parser.set_defaults(function=decorator_main)
+startup_parser = subparsers.add_parser('startup', help='Daemon start time (until serving and until fully loaded) with a large spool')
+startup_parser.add_argument('--sessions', metavar='COUNT', type=int, action='append',
+                   help='Number of sessions in the spool (argument can be repeated)')
+startup_parser.set_defaults(function=startup_main)
+memory_parser = subparsers.add_parser('memory', help='Daemon memory per idle session and per connection')
+memory_parser.add_argument('--sessions', metavar='COUNT', type=int, default=100000,
+                   help='Number of (idle) sessions')
+memory_parser.add_argument('--connections', metavar='COUNT', type=int, default=10000,
+                   help='Number of connections')
+memory_parser.set_defaults(function=memory_main)
+workers_parser = subparsers.add_parser('workers', help='Delivery throughput of ssws-server against its --workers count')
+workers_parser.add_argument('--workers', metavar='COUNT', type=int, action='append',
+                   help='Number of worker processes, 0 for a single process (argument can be repeated)')
+workers_parser.add_argument('--clients', metavar='COUNT', type=int, default=200,
+                   help='Number of WebSocket clients reading the channel')
+workers_parser.add_argument('--messages', metavar='COUNT', type=int, default=1000,
+                   help='Number of messages to publish')
+workers_parser.add_argument('--processes', metavar='COUNT', type=int, default=1,
+                   help='Number of processes to spread the clients over (so the clients are not the bottleneck)')
+workers_parser.set_defaults(function=workers_main)
+load_parser = subparsers.add_parser('load', help='End-to-end latency, rate and daemon usage under a publishing load (JSON output)')
+load_parser.add_argument('--clients', metavar='COUNT', type=int, default=100,
+                   help='Number of WebSocket clients')
+load_parser.add_argument('--sessions', metavar='COUNT', type=int, default=10,
+                   help='Number of sessions the clients are spread over')
+load_parser.add_argument('--channels', metavar='COUNT', type=int, default=1,
+                   help='Number of channels the sessions are spread over')
+load_parser.add_argument('--rate', metavar='MESSAGES', type=float, action='append',
+                   help='Messages per second to publish (argument can be repeated)')
+load_parser.add_argument('--duration', metavar='SECONDS', type=float, default=10.0,
+                   help='Seconds to publish for')
+load_parser.add_argument('--size', metavar='BYTES', type=int, default=64,
+                   help='Size of the message payloads')
+load_parser.add_argument('--workers', metavar='COUNT', type=int, default=0,
+                   help='Number of ssws-server worker processes')
+load_parser.add_argument('--processes', metavar='COUNT', type=int, default=1,
+                   help='Number of processes to spread the clients over')
+load_parser.set_defaults(function=load_main)
+clients_parser = subparsers.add_parser('clients', help='Connect WebSocket clients and report what they receive (used by workers and load)')
+clients_parser.add_argument('--port', type=int, required=True,
+                   help='Port of the ssws-server to connect to')
+clients_parser.add_argument('--first', metavar='NUMBER', type=int, default=0,
+                   help='Number of the first client session')
+clients_parser.add_argument('--clients', metavar='COUNT', type=int, default=1,
+                   help='Number of clients')
+clients_parser.add_argument('--sessions', metavar='COUNT', type=int, default=0,
+                   help='Number of sessions the clients share (default one per client)')
+clients_parser.add_argument('--messages', metavar='COUNT', type=int, default=1,
+                   help='Number of messages each client waits for (0 to wait for a line on stdin)')
+clients_parser.add_argument('--prefix', default='bench,',
+                   help='Count only messages starting with this prefix')
+clients_parser.add_argument('--latency', action='store_true', default=False,
+                   help='Report the latency of messages (which must start with their time.time())')
+clients_parser.add_argument('--timeout', metavar='SECONDS', type=float, default=60.0,
+                   help='Seconds to wait for the messages')
+clients_parser.set_defaults(function=clients_main)
+
+def main():
+    arguments = parser.parse_args()
+    arguments.function(arguments)
+
+if __name__ == '__main__':
+    main()
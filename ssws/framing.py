@@ -0,0 +1,289 @@
+"""WebSocket framing beyond txws: permessage-deflate and binary messages
+
+permessage-deflate (RFC 7692) is only offered in its "no context
+takeover" mode for our frames: each message is compressed on its own,
+so a broadcast's compressed frame is built once (see
+service.Message.frame) and written to every connection which
+negotiated the extension. Messages smaller than the threshold are
+sent uncompressed (RSV1 clear), as the extension allows. Clients may
+compress their own messages, with or without context takeover, we
+inflate them before the wrapped protocol sees them.
+
+Clients which request the "ssws.binary" subprotocol are sent each
+channel message as a binary frame:
+
+    channel number (4 bytes, big-endian)
+    sequence (8 bytes, big-endian, ordered connections only)
+    payload (as published, without the "channel_id," prefix)
+
+channel numbers are assigned by the daemon (per process) and announced
+in text control messages, ,{"channels":{"channel_id":number}}, before
+their first use. Clients can publish with binary frames of the channel
+number followed by the payload, text frames keep the "channel_id,data"
+format.
+
+For RFC 6455 (and HyBi-07/10) conversations we parse frames ourselves:
+fragmented messages are reassembled, and the wrapped protocol can
+check the opcode (TEXT/BINARY) of the message it is handed.
+"""
+import zlib
+from struct import pack, unpack, Struct
+from twisted.protocols.policies import ProtocolWrapper
+from twisted.python import log
+import txws
+
+EXTENSION = 'permessage-deflate'
+# zlib's sync flush marker, which RFC 7692 strips from each message
+TAIL = '\x00\x00\xff\xff'
+RSV1 = 0x40
+PARAMETERS = set([
+    'server_no_context_takeover', 'client_no_context_takeover',
+    'server_max_window_bits', 'client_max_window_bits',
+])
+CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xa
+# close code for messages beyond our MAX_MESSAGE
+MESSAGE_TOO_BIG = 1009
+# subprotocol for binary channel messages
+BINARY_PROTOCOL = 'ssws.binary'
+CHANNEL_HEADER = Struct('!I')
+ORDERED_HEADER = Struct('!IQ')
+
+def compress(payload, level):
+    """Deflate payload as a self-contained (no context takeover) message"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    if data.endswith(TAIL):
+        data = data[:-len(TAIL)]
+    return data
+
+class FrameMaker(object):
+    """Builds (RFC 6455) frames for connections which negotiated permessage-deflate
+
+    One instance is shared by all connections, so that Message.frame
+    caches a single compressed frame per message.
+    """
+    def __init__(self, level=6, threshold=256):
+        self.level = level
+        self.threshold = threshold
+    def __call__(self, payload, opcode=TEXT):
+        if len(payload) < self.threshold:
+            return txws.make_hybi07_frame(payload, opcode)
+        frame = txws.make_hybi07_frame(compress(payload, self.level), opcode)
+        # FIN + RSV1 ("compressed") + opcode
+        return chr(0x80 | RSV1 | opcode) + frame[1:]
+
+def pack_message(number, payload, offset, sequence=None):
+    """Binary message for payload[offset:] on channel number (with sequence if ordered)"""
+    if sequence is None:
+        header = CHANNEL_HEADER.pack(number)
+    else:
+        header = ORDERED_HEADER.pack(number, sequence)
+    return header + payload[offset:]
+
+def unpack_message(data):
+    """Get (channel number, payload) from a client's binary message"""
+    if len(data) < CHANNEL_HEADER.size:
+        raise ValueError('Binary message without a channel number')
+    return CHANNEL_HEADER.unpack_from(data)[0], data[CHANNEL_HEADER.size:]
+
+def parse_parameters(offer):
+    """Split an extension offer into (name, {parameter: value or True})"""
+    parts = [part.strip() for part in offer.split(';')]
+    parameters = {}
+    for part in parts[1:]:
+        if not part:
+            continue
+        key, _, value = part.partition('=')
+        parameters[key.strip().lower()] = value.strip().strip('"') or True
+    return parts[0].lower(), parameters
+
+def negotiate(header):
+    """Choose a permessage-deflate offer from a Sec-WebSocket-Extensions header
+
+    returns (response, client_no_context_takeover) or None if no offer
+    can be accepted (offers limiting our window below zlib's default,
+    or with unknown parameters, are declined)
+    """
+    for offer in (header or '').split(','):
+        name, parameters = parse_parameters(offer)
+        if name != EXTENSION:
+            continue
+        if set(parameters) - PARAMETERS:
+            continue
+        if parameters.get('server_max_window_bits', '15') not in ('15', True):
+            continue
+        response = [EXTENSION, 'server_no_context_takeover']
+        client_reset = 'client_no_context_takeover' in parameters
+        if client_reset:
+            response.append('client_no_context_takeover')
+        return '; '.join(response), client_reset
+    return None
+
+def parse_frames(buf):
+    """Parse (RFC 6455) frames which may have RSV1 set or be fragments
+
+    returns ([(fin, opcode, data, compressed)], remaining buf) with the
+    frames' raw opcodes (CLOSE data is (code, reason)), raises
+    txws.WSException on invalid frames
+    """
+    start = 0
+    frames = []
+    while len(buf) - start >= 2:
+        header, length = ord(buf[start]), ord(buf[start + 1])
+        if header & 0x30:
+            raise txws.WSException("Reserved flag in frame (%d)"%(header, ))
+        fin, opcode, compressed = bool(header & 0x80), header & 0xf, bool(header & RSV1)
+        if opcode not in (CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG):
+            raise txws.WSException("Unknown opcode %d in frame"%(opcode, ))
+        if opcode & 0x8 and (compressed or not fin):
+            raise txws.WSException("Compressed or fragmented control frame")
+        masked = length & 0x80
+        length &= 0x7f
+        offset = 2
+        if length == 0x7e:
+            if len(buf) - start < 4:
+                break
+            length = unpack('>H', buf[start + 2:start + 4])[0]
+            offset += 2
+        elif length == 0x7f:
+            if len(buf) - start < 10:
+                break
+            length = unpack('>Q', buf[start + 2:start + 10])[0]
+            offset += 8
+        if masked:
+            if len(buf) - (start + offset) < 4:
+                break
+            key = buf[start + offset:start + offset + 4]
+            offset += 4
+        if len(buf) - (start + offset) < length:
+            break
+        data = buf[start + offset:start + offset + length]
+        if masked:
+            data = txws.mask(data, key)
+        if opcode == CLOSE:
+            if len(data) >= 2:
+                data = unpack('>H', data[:2])[0], data[2:]
+            else:
+                data = 1000, 'No reason given'
+        frames.append((fin, opcode, data, compressed))
+        start += offset + length
+    return frames, buf[start:]
+
+class WebSocketProtocol(txws.WebSocketProtocol):
+    """txws WebSocketProtocol with permessage-deflate, subprotocols and fragments
+
+    deflate -- the factory's FrameMaker once the extension was
+        negotiated (None otherwise), used for our messages' frames
+    subprotocol -- the factory's subprotocol the client chose (or None)
+    opcode -- TEXT or BINARY, the type of the message being passed to
+        the wrapped protocol
+    
+    Compressed and fragmented messages which would be larger than 
+    MAX_MESSAGE (once inflated/reassembled) close the connection.
+    """
+    MAX_MESSAGE = 16*1024*1024
+    deflate = None
+    subprotocol = None
+    opcode = TEXT
+    client_reset = False
+    decompressor = None
+    fragments = None
+    def validateHeaders(self):
+        # txws refuses subprotocols other than its codecs, take ours out first
+        offered = self.headers.get('Sec-WebSocket-Protocol')
+        if offered:
+            for protocol in [protocol.strip() for protocol in offered.split(',')]:
+                if protocol in getattr(self.factory, 'subprotocols', ()):
+                    self.subprotocol = protocol
+                    del self.headers['Sec-WebSocket-Protocol']
+                    break
+        return txws.WebSocketProtocol.validateHeaders(self)
+    def sendHyBi07Preamble(self):
+        maker = getattr(self.factory, 'deflate', None)
+        agreed = negotiate(self.headers.get('Sec-WebSocket-Extensions')) if maker else None
+        self.sendCommonPreamble()
+        if self.codec or self.subprotocol:
+            self.writeEncoded("Sec-WebSocket-Protocol: %s\r\n"%(self.codec or self.subprotocol, ))
+        if agreed is not None:
+            response, self.client_reset = agreed
+            self.deflate = maker
+            self.writeEncoded("Sec-WebSocket-Extensions: %s\r\n"%(response, ))
+        self.writeEncoded("Sec-WebSocket-Accept: %s\r\n\r\n"%(
+            txws.make_accept(self.headers["Sec-WebSocket-Key"]),
+        ))
+    def inflate(self, data):
+        """Decompress a client's message, None if it is larger than MAX_MESSAGE"""
+        if self.decompressor is None or self.client_reset:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        message = self.decompressor.decompress(data + TAIL, self.MAX_MESSAGE)
+        if self.decompressor.unconsumed_tail:
+            return None
+        return message
+    def close(self, reason='', code=None):
+        """Close the connection, with a status code (e.g. MESSAGE_TOO_BIG) if given"""
+        if code is not None and self.flavor != txws.HYBI00:
+            reason = pack('!H', code) + reason
+        txws.WebSocketProtocol.close(self, reason)
+    def parseFrames(self):
+        if self.flavor == txws.HYBI00:
+            return txws.WebSocketProtocol.parseFrames(self)
+        try:
+            frames, self.buf = parse_frames(self.buf)
+        except txws.WSException as err:
+            self.close(err.args[0])
+            return
+        for fin, opcode, data, compressed in frames:
+            if opcode == CLOSE:
+                reason, text = data
+                log.msg("Closing connection: %r (%d)"%(text, reason))
+                self.close()
+                return
+            elif opcode in (PING, PONG):
+                continue
+            if opcode == CONTINUATION:
+                if self.fragments is None:
+                    self.close('Continuation without a message')
+                    return
+                self.fragments[2].append(data)
+                if sum([len(part) for part in self.fragments[2]]) > self.MAX_MESSAGE:
+                    self.close('Message too big', MESSAGE_TOO_BIG)
+                    return
+                if not fin:
+                    continue
+                opcode, compressed, parts = self.fragments
+                self.fragments = None
+                data = ''.join(parts)
+            elif self.fragments is not None:
+                self.close('New message before the last one finished')
+                return
+            elif not fin:
+                self.fragments = (opcode, compressed, [data])
+                continue
+            if compressed:
+                if self.deflate is None:
+                    self.close('Compressed message without permessage-deflate')
+                    return
+                try:
+                    data = self.inflate(data)
+                except zlib.error as err:
+                    self.close('Invalid compressed message: %s'%(err, ))
+                    return
+                if data is None:
+                    self.close('Message too big', MESSAGE_TOO_BIG)
+                    return
+            if self.codec:
+                data = txws.decoders[self.codec](data)
+            self.opcode = opcode
+            ProtocolWrapper.dataReceived(self, data)
+        self.opcode = TEXT
+
+class WebSocketFactory(txws.WebSocketFactory):
+    """txws WebSocketFactory offering permessage-deflate (if deflate is not None)
+
+    subprotocols -- subprotocols a client may choose (besides txws's codecs)
+    """
+    protocol = WebSocketProtocol
+    def __init__(self, wrappedFactory, deflate=None, subprotocols=(BINARY_PROTOCOL, )):
+        txws.WebSocketFactory.__init__(self, wrappedFactory)
+        self.deflate = deflate
+        self.subprotocols = subprotocols
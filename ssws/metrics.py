@@ -0,0 +1,200 @@
+"""Runtime metrics for ssws-server in Prometheus text format (see --metrics)
+
+The hot paths only bump counters (and observe the fan-out histogram),
+gauges such as connection counts and queue depths are computed when
+the metrics are requested.
+"""
+import os, json, time, bisect, collections
+from twisted.web import resource
+from twisted.python import log
+
+INFINITY = float('inf')
+
+def _number(value):
+    if value == INFINITY:
+        return '+Inf'
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}'%(','.join([
+        '%s="%s"'%(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items())
+    ]), )
+
+class Histogram(object):
+    """Histogram with cumulative buckets (value <= bound) as Prometheus expects"""
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+    def samples(self):
+        """[(suffix, labels, value)] for the histogram"""
+        samples, total = [], 0
+        for bound, count in zip(self.bounds + (INFINITY, ), self.counts):
+            total += count
+            samples.append(('_bucket', {'le': _number(bound)}, total))
+        samples.append(('_count', {}, self.count))
+        samples.append(('_sum', {}, self.sum))
+        return samples
+
+class Metrics(object):
+    """Counters maintained by a Server (and its protocols)"""
+    FAN_OUT_BUCKETS = (.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+    QUEUE_BUCKETS = (0, 1, 10, 100, 1000, 10000)
+    REAPER_BUCKETS = (.001, .01, .1, .5, 1, 5, 10)
+    def __init__(self):
+        self.fan_out = Histogram(self.FAN_OUT_BUCKETS)
+        self.reaper = Histogram(self.REAPER_BUCKETS)
+        # watch kind: events handled
+        self.inotify_events = collections.Counter()
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.dropped = 0
+
+    def collect(self, server):
+        """[(name, type, help, [(suffix, labels, value)])] for server's current state"""
+        protocols = [
+            protocol
+            for session in server.sessions.values()
+            for protocol in session.protocols
+        ]
+        queues = Histogram(self.QUEUE_BUCKETS)
+        for protocol in protocols:
+            queues.observe(protocol.queue_depth)
+        return [
+            ('ssws_start_time_seconds', 'gauge', 'Time the server started', [
+                ('', {}, getattr(server, 'started', 0)),
+            ]),
+            ('ssws_sessions', 'gauge', 'Sessions loaded/not yet loaded (lazy start)', [
+                ('', {'state': 'loaded'}, len(server.sessions)),
+                ('', {'state': 'dormant'}, len(server.dormant_sessions)),
+            ]),
+            ('ssws_channels', 'gauge', 'Channels loaded/not yet loaded (lazy start)', [
+                ('', {'state': 'loaded'}, len(server.channels)),
+                ('', {'state': 'dormant'}, len(server.dormant_channels)),
+            ]),
+            ('ssws_connections', 'gauge', 'Connected WebSockets', [
+                ('', {}, len(protocols)),
+            ]),
+            ('ssws_channel_messages_total', 'counter', 'Messages published on each loaded channel (the channel\'s sequence)', [
+                ('', {'channel': channel_id}, channel.log.head)
+                for channel_id, channel in sorted(server.channels.items())
+            ]),
+            ('ssws_channel_subscribers', 'gauge', 'Sessions which can read each channel', [
+                ('', {'channel': channel_id}, len(sessions))
+                for channel_id, sessions in sorted(server.subscribers.items())
+            ]),
+            ('ssws_fan_out_seconds', 'histogram', 'Time to hand a channel\'s new messages to its subscribers',
+                self.fan_out.samples()
+            ),
+            ('ssws_queue_depth', 'histogram', 'Messages waiting to be written, per connection',
+                queues.samples()
+            ),
+            ('ssws_dropped_messages_total', 'counter', 'Messages dropped by overflow policies', [
+                ('', {}, self.dropped),
+            ]),
+            ('ssws_written_frames_total', 'counter', 'Messages written to connections', [
+                ('', {}, self.frames_written),
+            ]),
+            ('ssws_written_bytes_total', 'counter', 'Bytes of messages (frames when pre-framed) written to connections', [
+                ('', {}, self.bytes_written),
+            ]),
+            ('ssws_received_frames_total', 'counter', 'Messages received from connections', [
+                ('', {}, self.frames_received),
+            ]),
+            ('ssws_received_bytes_total', 'counter', 'Bytes of messages received from connections', [
+                ('', {}, self.bytes_received),
+            ]),
+            ('ssws_inotify_events_total', 'counter', 'Inotify events handled, by kind of watch', [
+                ('', {'watch': watch}, count)
+                for watch, count in sorted(self.inotify_events.items())
+            ]),
+            ('ssws_io_batches', 'gauge', 'Batches of filesystem work queued or running in the I/O threads', [
+                ('', {}, len(server.io.pending) + server.io.running),
+            ]),
+            ('ssws_io_removals', 'gauge', 'Directory trees (expired sessions/channels) being removed', [
+                ('', {}, len(server.io.removals)),
+            ]),
+            ('ssws_reaper_seconds', 'histogram', 'Duration of the reaper\'s expiry and log pruning passes',
+                self.reaper.samples()
+            ),
+        ]
+
+def render(processes):
+    """Prometheus text format for [(labels, families)] (one entry per process)"""
+    order, merged = [], {}
+    for labels, families in processes:
+        for name, kind, text, samples in families:
+            if name not in merged:
+                order.append(name)
+                merged[name] = (kind, text, [])
+            merged[name][2].extend([
+                (suffix, dict(sample_labels, **labels), value)
+                for suffix, sample_labels, value in samples
+            ])
+    lines = []
+    for name in order:
+        kind, text, samples = merged[name]
+        lines.append('# HELP %s %s'%(name, text))
+        lines.append('# TYPE %s %s'%(name, kind))
+        for suffix, labels, value in samples:
+            lines.append('%s%s%s %s'%(name, suffix, _labels(labels), _number(value)))
+    return '\n'.join(lines) + '\n'
+
+def write_snapshot(server, filename):
+    """Atomically write server's metrics as JSON (a --workers child's metrics)"""
+    temporary = '%s.%s.tmp'%(filename, os.getpid())
+    try:
+        with open(temporary, 'w') as fh:
+            fh.write(json.dumps(server.metrics.collect(server)))
+        os.rename(temporary, filename)
+    except (IOError, OSError) as err:
+        log.msg('Unable to write metrics to %s: %s'%(filename, err))
+
+def read_snapshots(directory, max_age):
+    """[(labels, families)] for worker snapshots updated in the last max_age seconds"""
+    try:
+        filenames = sorted(os.listdir(directory))
+    except OSError:
+        return []
+    snapshots = []
+    stale = time.time() - max_age
+    for filename in filenames:
+        if not filename.endswith('.json'):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            if os.stat(path).st_mtime < stale:
+                continue
+            with open(path) as fh:
+                families = json.loads(fh.read())
+        except (IOError, OSError, ValueError):
+            continue
+        snapshots.append(({'worker': filename[:-len('.json')]}, families))
+    return snapshots
+
+class MetricsResource(resource.Resource):
+    """Serves the server's (and its workers') metrics to Prometheus"""
+    isLeaf = True
+    def __init__(self, server):
+        resource.Resource.__init__(self)
+        self.server = server
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        processes = [({}, self.server.metrics.collect(self.server))]
+        processes.extend(read_snapshots(
+            self.server.metrics_path, self.server.METRICS_FREQUENCY * 3,
+        ))
+        return render(processes).encode('utf-8')
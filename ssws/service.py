@@ -1,243 +1,1754 @@
 """Messaging server service using Twisted and txws
 """
-import os, json, sys, time
-from . import base
+import os, json, sys, time, shutil, collections, heapq, itertools, struct, socket, uuid
+from . import base, metrics, framing
 from twisted.internet import inotify
 from twisted.python import filepath, log
 from twisted.application import strports
 from twisted.internet.task import LoopingCall
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, threads
+from twisted.python import failure, threadpool
 import txws
 
-class Channel(base.Channel):
+# Deletion (or rename-away) of a flag file/directory, checked *before*
+# the catch-all "anything else is a creation" handling
+REMOVED_MASK = inotify.IN_DELETE | inotify.IN_MOVED_FROM
+# Suffix for directories being removed (in the spool's .tmp directory)
+TRASH_SUFFIX = '.trash'
+
+def unlink_all(paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+def touch_all(paths):
+    for path in paths:
+        try:
+            os.utime(path, None)
+        except OSError:
+            # removed since it was marked active
+            pass
+def clear_since(paths):
+    """Rewrite readable flag-files as plain flags (their "since" has been applied)"""
+    for path in paths:
+        try:
+            # no O_CREAT, a flag revoked in the meantime stays revoked
+            fd = os.open(path, os.O_WRONLY | os.O_TRUNC)
+        except OSError:
+            continue
+        try:
+            os.write(fd, base.FLAG_CONTENT)
+        finally:
+            os.close(fd)
+def write_all(files):
+    """Atomically write [(filename, content)], returns the filenames written"""
+    written = []
+    for filename, content in files:
+        # not a log filename, so never loaded if we die mid-write
+        temporary = os.path.join(
+            os.path.dirname(filename), '.%s.tmp'%(os.path.basename(filename), )
+        )
+        try:
+            with open(temporary, 'wb') as fh:
+                fh.write(content)
+            os.rename(temporary, filename)
+        except (IOError, OSError) as err:
+            log.msg('Unable to write %s: %s'%(filename, err))
+            continue
+        written.append(filename)
+    return written
+
+class TreeRemoval(object):
+    """Removal of a directory tree, a step (a bounded number of entries) at a time"""
+    def __init__(self, path):
+        self.path = path
+        self.walk = None
+        self.directory = None
+        self.filenames = []
+    def step(self, limit):
+        """Remove up to limit files/directories, returns True once the tree is gone"""
+        if self.walk is None:
+            self.walk = os.walk(self.path, topdown=False)
+        removed = 0
+        while removed < limit:
+            if self.filenames:
+                try:
+                    os.unlink(os.path.join(self.directory, self.filenames.pop()))
+                except OSError:
+                    pass
+            else:
+                if self.directory is not None:
+                    try:
+                        os.rmdir(self.directory)
+                    except OSError:
+                        pass
+                try:
+                    self.directory, _, self.filenames = next(self.walk)
+                except StopIteration:
+                    self.directory = None
+                    return True
+            removed += 1
+        return False
+
+class IOExecutor(object):
+    """Filesystem work the reactor doesn't wait for, in a bounded pool of threads
+    
+    Operations submitted during a reactor tick are run, in order, as 
+    one batch (a single hand-off to the pool). Directory trees are 
+    moved aside (so their names can be re-used at once) then removed 
+    REMOVE_STEP entries per batch, so removing a large session or 
+    channel never holds up the reactor (or the other operations).
+    """
+    REMOVE_STEP = 500
+    def __init__(self, threads, trash_path):
+        self.trash_path = trash_path
+        self.pool = threadpool.ThreadPool(minthreads=0, maxthreads=threads, name='ssws-io')
+        self.pending = []
+        # batches handed to the pool whose results we haven't had
+        self.running = 0
+        self.removals = set()
+        self.stopped = True
+        self._call = None
+        self._trigger = None
+    def start(self):
+        self.stopped = False
+        self.pool.start()
+        # the pool's threads would keep the process alive
+        self._trigger = reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+        # left by a previous daemon
+        try:
+            leftovers = [
+                os.path.join(self.trash_path, filename)
+                for filename in os.listdir(self.trash_path)
+                if filename.endswith(TRASH_SUFFIX)
+            ]
+        except OSError:
+            leftovers = []
+        for path in leftovers:
+            self.remove(TreeRemoval(path))
+    def stop(self):
+        """Finish all outstanding work (in the calling thread) and stop the pool"""
+        if self.stopped:
+            return
+        if self._trigger is not None:
+            try:
+                reactor.removeSystemEventTrigger(self._trigger)
+            except (ValueError, KeyError):
+                # we are the trigger being run
+                pass
+            self._trigger = None
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self.stopped = True
+        # runs the batches already handed to the pool
+        self.pool.stop()
+        # (their results are delivered if the reactor runs again)
+        self.running = 0
+        batch, self.pending = self.pending, []
+        self.deliver(self.run(batch), batch)
+        for removal in list(self.removals):
+            while not removal.step(self.REMOVE_STEP):
+                pass
+        self.removals.clear()
+    def busy(self):
+        """Is there work queued, running or (tree removals) still to do?"""
+        return bool(self.pending or self.running or self.removals)
+    def submit(self, function, *args):
+        """Run function(*args) in the pool with this tick's other operations, returns a Deferred"""
+        deferred = defer.Deferred()
+        if self.stopped:
+            batch = [(function, args, deferred)]
+            self.deliver(self.run(batch), batch)
+            return deferred
+        self.pending.append((function, args, deferred))
+        if self._call is None:
+            self._call = reactor.callLater(0, self.run_pending)
+        return deferred
+    def run_pending(self):
+        self._call = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        self.running += 1
+        threads.deferToThreadPool(reactor, self.pool, self.run, batch).addCallback(
+            self.batch_finished, batch, 
+        )
+    @staticmethod
+    def run(batch):
+        """Run the batch's operations (in a pool thread), returns [(succeeded, result)]"""
+        results = []
+        for function, args, _ in batch:
+            try:
+                results.append((True, function(*args)))
+            except Exception:
+                results.append((False, failure.Failure()))
+        return results
+    def batch_finished(self, results, batch):
+        self.running = max((0, self.running - 1))
+        self.deliver(results, batch)
+    def deliver(self, results, batch):
+        for (succeeded, result), (_, _, deferred) in zip(results, batch):
+            if succeeded:
+                deferred.callback(result)
+            else:
+                deferred.errback(result)
+    def remove_tree(self, path):
+        """Move directory path aside and remove it incrementally"""
+        trash = os.path.join(self.trash_path, uuid.uuid4().hex + TRASH_SUFFIX)
+        try:
+            os.rename(path, trash)
+        except OSError:
+            # already removed
+            return
+        self.remove(TreeRemoval(trash))
+    def remove(self, removal):
+        self.removals.add(removal)
+        self.submit(removal.step, self.REMOVE_STEP).addCallback(self.removed, removal)
+    def removed(self, finished, removal):
+        if finished or removal not in self.removals:
+            self.removals.discard(removal)
+        else:
+            self.submit(removal.step, self.REMOVE_STEP).addCallback(self.removed, removal)
+
+class Message(object):
+    """An (immutable) message in a channel's log
+    
+    The payload is loaded once and shared by every session and 
+    connection sending the message, connections acquire() the payload 
+    when they queue the message and release() it once written, when 
+    the last one has released it the payload is dropped (it will be 
+    re-read from the log if a late subscriber needs it).
+    
+    Messages published in-memory (path is None) keep their payload 
+    for as long as they are in the log.
+    """
+    __slots__ = (
+        'channel_id', 'sequence', 'timestamp', 'path', 'offset', 'size', 
+        'payload', 'refcount', 'frames', 
+    )
+    def __init__(self, channel_id, sequence, timestamp, path, size, payload=None, offset=0):
+        self.channel_id = channel_id
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.path = path
+        # messages from a batch share a log file, offset is our position
+        self.offset = offset
+        self.size = size
+        self.payload = payload
+        self.refcount = 0
+        self.frames = None
+    def acquire(self):
+        """Add a reference to our payload (loading if necessary), returns payload"""
+        if self.payload is None:
+            with open(self.path, 'rb') as fh:
+                if self.offset:
+                    fh.seek(self.offset)
+                self.payload = fh.read(self.size)
+        self.refcount += 1
+        return self.payload
+    def release(self):
+        """Release a reference to our payload"""
+        self.refcount -= 1
+        if self.refcount <= 0:
+            self.refcount = 0
+            if self.path is not None:
+                self.payload = None
+            self.frames = None
+    def sequenced(self):
+        """Get our (acquired) payload as sent to ordered connections, "channel:sequence,data" """
+        return '%s:%d%s'%(
+            self.channel_id, self.sequence, self.payload[len(self.channel_id):], 
+        )
+    def frame(self, maker, ordered=False, number=None):
+        """Get our (acquired) payload framed by maker, built once per message
+        
+        number -- our channel's number, for a binary message (see framing)
+        """
+        if self.frames is None:
+            self.frames = {}
+        key = (maker, ordered, number)
+        frame = self.frames.get(key)
+        if frame is None:
+            if number is not None:
+                frame = self.frames[key] = maker(framing.pack_message(
+                    number, self.payload, len(self.channel_id) + 1, 
+                    self.sequence if ordered else None, 
+                ), framing.BINARY)
+            else:
+                frame = self.frames[key] = maker(
+                    self.sequenced() if ordered else self.payload
+                )
+        return frame
+
+class MessageLog(object):
+    """Append-only, retention-bounded log of a channel's messages
+    
+    Each message is stored once (in the channel's log directory) 
+    regardless of how many sessions will receive it, sessions 
+    track how far through the log they have been sent.
+    """
+    def __init__(self, channel_id, path, retention, max_messages, max_bytes, readonly=False, io=None, head_path=None):
+        self.channel_id = channel_id
+        self.path = path
+        # file recording our head, for when our directory can't (see save_head)
+        self.head_path = head_path
+        self._head_call = None
+        # IOExecutor for our writes/removals, None to do them in-line
+        self.io = io
+        # another process owns (appends to/prunes) our directory
+        self.readonly = readonly
+        self.retention = retention
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.entries = []
+        self.size = 0
+        self.head = 0
+        # messages after this sequence are waiting for acks, and are 
+        # kept past the retention period (but not the size limits)
+        self.pinned = None
+        # only our latest message matters (the channel's conflate flag)
+        self.conflate = False
+    def load(self):
+        """Load entries left in our directory by a previous daemon"""
+        for filename, mtime in base._ordered_ls(self.path):
+            sequence = base.log_sequence(filename)
+            if sequence is None:
+                continue
+            try:
+                if filename.endswith(base.BATCH_SUFFIX):
+                    with open(filename, 'rb') as fh:
+                        records = base.decode_batch(fh.read())
+                else:
+                    records = [(0, os.stat(filename).st_size)]
+            except (IOError, OSError, ValueError) as err:
+                log.msg('Unable to load log file %s: %s'%(filename, err))
+                continue
+            for i, (offset, size) in enumerate(records):
+                self.entries.append(Message(
+                    self.channel_id, sequence + i, mtime, filename, size, offset=offset, 
+                ))
+        self.entries.sort(key=lambda entry: entry.sequence)
+        self.size = sum([entry.size for entry in self.entries])
+        if self.entries:
+            self.head = self.entries[-1].sequence
+        if self.head_path is not None:
+            # pruned (or in-memory) messages still used their sequences
+            self.head = max((self.head, base.stored_sequence(self.head_path) or 0))
+        self.prune()
+    def append(self, filename, content=None):
+        """Move filename (a message or batch) into the log, returns [Message]
+        
+        content -- filename's content, if the caller has already read it
+        
+        The returned messages have their payloads loaded (but not acquired), 
+        callers should acquire/release them around fan-out.
+        """
+        if content is None:
+            with open(filename, 'rb') as fh:
+                content = fh.read()
+        sequence = self.head + 1
+        if filename.endswith(base.BATCH_SUFFIX):
+            try:
+                records = base.decode_batch(content)
+            except ValueError:
+                # don't leave it in the outbox to fail on every drain
+                os.unlink(filename)
+                raise
+            if not records:
+                os.unlink(filename)
+                return []
+            target = os.path.join(self.path, base.LOG_FORMAT%(sequence, ) + base.BATCH_SUFFIX)
+        else:
+            records = None
+            target = os.path.join(self.path, base.LOG_FORMAT%(sequence, ))
+        os.rename(filename, target)
+        now = time.time()
+        if records is None:
+            messages = [Message(self.channel_id, sequence, now, target, len(content), content)]
+        else:
+            messages = [
+                Message(
+                    self.channel_id, sequence + i, now, target, length, 
+                    content[offset:offset+length], offset=offset, 
+                )
+                for i, (offset, length) in enumerate(records)
+            ]
+        self.head = messages[-1].sequence
+        self.entries.extend(messages)
+        self.size += sum([message.size for message in messages])
+        self.prune()
+        return messages
+    def append_payload(self, payload, sequence=None):
+        """Add an in-memory (not persisted) message to the log, returns [Message]
+        
+        sequence -- the message's sequence if assigned elsewhere (see 
+            WorkerServer), messages we already have are ignored
+        """
+        if sequence is None:
+            sequence = self.head + 1
+        elif sequence <= self.head:
+            return []
+        elif sequence != self.head + 1 and self.entries:
+            # we missed messages, since() relies on entries being contiguous
+            del self.entries[:]
+            self.size = 0
+        self.head = sequence
+        message = Message(self.channel_id, sequence, time.time(), None, len(payload), payload)
+        self.entries.append(message)
+        self.size += message.size
+        self.prune()
+        self.save_head()
+        return [message]
+    def persist(self, messages):
+        """Write in-memory messages (see append_payload) still in the log to our directory
+        
+        Once written they are like any other logged message (payloads 
+        are dropped when released, files are removed when pruned) and 
+        are loaded by the next daemon.
+        """
+        if self.readonly or not self.entries:
+            return
+        first = self.entries[0].sequence
+        runs = []
+        for message in messages:
+            if message.path is not None or message.sequence < first:
+                continue
+            if runs and runs[-1][-1].sequence + 1 == message.sequence:
+                runs[-1].append(message)
+            else:
+                # a batch file's messages have consecutive sequences
+                runs.append([message])
+        files, targets = [], {}
+        for run in runs:
+            name = base.LOG_FORMAT%(run[0].sequence, )
+            if len(run) == 1:
+                content = run[0].payload
+                records = [(0, len(content))]
+            else:
+                name += base.BATCH_SUFFIX
+                content = base.encode_batch([message.payload for message in run])
+                records = base.decode_batch(content)
+            target = os.path.join(self.path, name)
+            files.append((target, content))
+            targets[target] = (run, records)
+        if self.io is None:
+            self.persisted(write_all(files), targets)
+        else:
+            self.io.submit(write_all, files).addCallback(self.persisted, targets)
+    def persisted(self, written, targets):
+        """Point messages at the log files written for them (see persist)"""
+        first = self.entries[0].sequence if self.entries else self.head + 1
+        for target in written:
+            run, records = targets[target]
+            if run[-1].sequence < first:
+                # pruned while we were writing
+                self.remove([target])
+                continue
+            for message, (offset, size) in zip(run, records):
+                message.path, message.offset = target, offset
+                if not message.refcount:
+                    message.payload = None
+    def remove(self, paths):
+        if self.io is None:
+            unlink_all(paths)
+        else:
+            self.io.submit(unlink_all, paths)
+    def since(self, sequence):
+        """Get the entries with sequence > sequence"""
+        if not self.entries or sequence >= self.head:
+            return []
+        first = self.entries[0].sequence
+        if self.entries[-1].sequence - first + 1 != len(self.entries):
+            # a gap, left by in-memory messages lost in a restart
+            return [entry for entry in self.entries if entry.sequence > sequence]
+        return self.entries[max((0, sequence + 1 - first)):]
+    def prune(self, now=None):
+        """Drop messages that are too old or exceed our size limits"""
+        if not self.entries:
+            return 0
+        stale = (now or time.time()) - self.retention
+        excess = len(self.entries) - self.max_messages
+        if self.conflate:
+            excess = max((excess, len(self.entries) - 1))
+        pinned = self.pinned
+        size = self.size
+        count = 0
+        for entry in self.entries:
+            if count < excess or size > self.max_bytes or (
+                entry.timestamp < stale and (pinned is None or entry.sequence <= pinned)
+            ):
+                size -= entry.size
+                count += 1
+            else:
+                break
+        if count:
+            # a batch's file is only removed with the last of its messages
+            keep = self.entries[count].path if count < len(self.entries) else None
+            if not self.readonly:
+                self.remove([
+                    path for path in set([entry.path for entry in self.entries[:count]])
+                    if path is not None and path != keep
+                ])
+            del self.entries[:count]
+            self.size = size
+            if not self.entries:
+                self.save_head()
+        return count
+    def save_head(self):
+        """Record our head in head_path (at most once per tick)
+        
+        Needed whenever our directory doesn't show the next daemon how 
+        far the sequences got: once everything has been pruned, and for 
+        in-memory messages.
+        """
+        if self.readonly or self.head_path is None or self._head_call is not None:
+            return
+        self._head_call = reactor.callLater(0, self.write_head)
+    def cancel_head(self):
+        """Cancel a scheduled head write, returns whether there was one"""
+        call, self._head_call = self._head_call, None
+        if call is not None and call.active():
+            call.cancel()
+            return True
+        return False
+    def write_head(self):
+        self._head_call = None
+        files = [(self.head_path, str(self.head))]
+        if self.io is None:
+            write_all(files)
+        else:
+            self.io.submit(write_all, files)
+
+class Activity(object):
+    """Last-activity time kept in memory
+    
+    mark_active() is called for every message, so rather than touching 
+    our directory each time the server writes the times of everything 
+    marked active to disk in batches (see Server.flush_activity).
+    
+    Subclasses provide the "active" slot.
+    """
+    __slots__ = ()
+    def setup(self):
+        super(Activity, self).setup()
+        self.active = self.stored_active()
+    def mark_active(self):
+        self.active = time.time()
+        self.server.dirty.add(self)
+    def last_active(self):
+        return self.active
+    def stored_active(self):
+        """Last activity recorded on disk (e.g. by synchronous API clients)"""
+        return super(Activity, self).last_active()
+    def cleanup(self):
+        self.server.dirty.discard(self)
+        if self.server.OWNS_SPOOL:
+            self.server.io.remove_tree(self.directory)
+
+class Channel(Activity, base.Channel):
+    __slots__ = (
+        'active', 'log', 'relayed', '_drain_call', '_publish_call', '_overflow', 
+        '_handler', '_persist_call', '_unpersisted', 'conflate', '_conflate', 
+    )
     def __init__(self, *args, **named):
+        self.active = 0
+        # last sequence relayed to --workers processes
+        self.relayed = 0
+        self._drain_call = None
+        self._publish_call = None
+        # (inode, mtime, policy) as last read from our overflow file
+        self._overflow = None
+        # (inode, mtime, name) as last read from our handler file
+        self._handler = None
+        # messages published with persist=True not yet written to our log
+        self._persist_call = None
+        self._unpersisted = []
+        # whether we have a conflate flag, (inode, mtime, content) of it
+        self.conflate = False
+        self._conflate = None
         super(Channel, self).__init__(*args, **named)
         log.msg("Channel %r started"%( self.channel_id, ))
     
     def setup(self):
         super(Channel, self).setup()
-        for path, cb in [
-            (self.outbox_path, self.on_outbox_message), 
-        ]:
-            self.server.inotify.watch(
-                filepath.FilePath(path), callbacks=[cb]
-            )
+        self.log = MessageLog(
+            self.channel_id, 
+            self.log_path, 
+            retention = self.server.log_retention, 
+            max_messages = self.server.log_messages, 
+            max_bytes = self.server.log_bytes, 
+            readonly = not self.server.OWNS_SPOOL, 
+            io = self.server.io, 
+            head_path = self.head_path, 
+        )
+        self.update_conflate()
+        self.log.load()
+        self.relayed = self.log.head
+        if not self.server.OWNS_SPOOL:
+            # the parent process consumes our outbox
+            return
+        if not self.server.journal:
+            for path, cb in [
+                (self.outbox_path, self.on_outbox_message), 
+            ]:
+                self.server.inotify.watch(
+                    filepath.FilePath(path), callbacks=[cb]
+                )
+        if os.listdir(self.outbox_path):
+            # published while we weren't watching (e.g. before a lazy load)
+            self._drain_call = reactor.callLater(0, self.drain)
         
     def cleanup(self):
         log.msg("Removing channel: %r"%( self.channel_id, ))
-        for path in (self.outbox_path, ):
-            try:
-                self.server.inotify.ignore(filepath.FilePath(path))
-            except KeyError:
-                pass
+        self.cancel_calls()
+        self.server.forget_channel_number(self.channel_id)
+        if self.server.relays:
+            # a re-created channel's sequences start again
+            self.server.relay_command('forget', self.channel_id)
+        if not self.server.journal:
+            for path in (self.outbox_path, ):
+                try:
+                    self.server.inotify.ignore(filepath.FilePath(path))
+                except KeyError:
+                    pass
         super(Channel, self).cleanup()
+    @property
+    def directory(self):
+        return self.channel_path
+    def cancel_calls(self):
+        """Cancel our scheduled drain/fan-out (we are being removed or shut down)"""
+        for call in (self._drain_call, self._publish_call, self._persist_call):
+            if call is not None and call.active():
+                call.cancel()
+        self._drain_call = self._publish_call = self._persist_call = None
+        self.log.cancel_head()
     def on_outbox_message(self, _, path, mask ):
+        self.server.metrics.inotify_events['outbox'] += 1
         if mask & inotify.IN_CREATE or mask & inotify.IN_MOVED_TO:
-            # do some os hardlinks...
+            if self.server.batch_outbox:
+                # coalesce all of this tick's events into one drain pass
+                if self._drain_call is None:
+                    self._drain_call = reactor.callLater(0, self.drain)
+                return
             # this should likely be async, but we rely on in-memory fs to be fast
-            for session in self.server.sessions.values():
-                if self.channel_id in session.readable:
-                    session.add_message(path.path)
-            os.unlink(path.path)
-            self.mark_active()
+            try:
+                messages = self.log.append(path.path)
+            except (IOError, OSError, ValueError) as err:
+                # e.g. duplicate event for an already-logged message
+                log.msg('Unable to log message %s: %s'%(path.path, err))
+                return
+            if messages:
+                self.fan_out(messages)
+    def drain(self):
+        """Log everything in our outbox, then fan the batch out in one pass"""
+        self._drain_call = None
+        messages = []
+        for filename, _ in base._ordered_ls(self.outbox_path):
+            try:
+                messages.extend(self.log.append(filename))
+            except (IOError, OSError, ValueError) as err:
+                log.msg('Unable to log message %s: %s'%(filename, err))
+        if messages:
+            self.fan_out(messages)
+    def publish(self, payload, sequence=None, persist=False):
+        """Log payload (which includes our channel prefix) in memory and fan it out
+        
+        Used for messages which arrive without going through the spool.
+        
+        persist -- also write the message into our log directory, after 
+            (and separately from) the fan-out
+        """
+        messages = self.log.append_payload(payload, sequence)
+        if persist and messages:
+            self._unpersisted.extend(messages)
+            if self._persist_call is None:
+                self._persist_call = reactor.callLater(0, self.persist_published)
+        if not self.server.batch_outbox:
+            self.fan_out(messages)
+        elif self._publish_call is None:
+            # everything published this tick is in the log after our 
+            # subscribers' cursors, so one fan-out pass sends them all
+            self._publish_call = reactor.callLater(0, self.fan_out_published)
+    def persist_published(self):
+        self._persist_call = None
+        messages, self._unpersisted = self._unpersisted, []
+        self.log.persist(messages)
+    def _setting(self, path, cached):
+        """Get (inode, mtime, content) of setting file path, re-read only if it changed
+        
+        returns None if there is no such setting
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if cached is None or cached[:2] != (stat.st_ino, stat.st_mtime):
+            try:
+                with open(path) as fh:
+                    cached = (stat.st_ino, stat.st_mtime, fh.read().strip())
+            except (IOError, OSError):
+                return None
+        return cached
+    def overflow_policy(self):
+        """Get our overflow policy (re-read only when the overflow file changes)"""
+        self._overflow = self._setting(self.overflow_path, self._overflow)
+        if self._overflow is None:
+            return self.server.overflow
+        if self._overflow[2] not in base.OVERFLOW_POLICIES:
+            log.msg('Invalid overflow policy for %r: %r'%(self.channel_id, self._overflow[2]))
+            return self.server.overflow
+        return self._overflow[2]
+    def update_conflate(self):
+        """Re-read our conflate flag, cached in .conflate between fan-outs"""
+        self._conflate = self._setting(self.conflate_path, self._conflate)
+        self.conflate = self.log.conflate = self._conflate is not None
+        return self.conflate
+    def handler(self):
+        """Get the name of our handler for client messages (see HANDLERS)"""
+        self._handler = self._setting(self.handler_path, self._handler)
+        if self._handler is None:
+            return self.server.handler
+        if self._handler[2] not in HANDLERS:
+            log.msg('Unknown handler for %r: %r'%(self.channel_id, self._handler[2]))
+            return self.server.handler
+        return self._handler[2]
+    def incoming(self, data):
+        """Handle data sent on our channel by a client allowed to write to it"""
+        HANDLERS[self.handler()](self, data)
+    def unacked(self, now=None):
+        """Lowest sequence acked by our subscribers' ordered connections (or None)
+        
+        Connections which haven't acked within the server's ack_timeout 
+        no longer hold messages in the log.
+        """
+        stale = (now or time.time()) - self.server.ack_timeout
+        acked = [
+            protocol.acked.get(self.channel_id, 0)
+            for session in self.server.subscribers.get(self.channel_id, ())
+            for protocol in session.protocols
+            if protocol.ordered and protocol.last_ack >= stale
+        ]
+        return min(acked) if acked else None
+    def rewind(self):
+        """Positions beyond our head are from a removed channel of the same name
+        
+        Our subscribers (and their connections) carry on from our head.
+        """
+        for session in self.server.subscribers.get(self.channel_id, ()):
+            session.rewind(self.channel_id, self.log.head)
+    def fan_out_published(self):
+        self._publish_call = None
+        self.fan_out([])
+    def fan_out(self, messages):
+        """Notify our subscribers that messages have been logged"""
+        start = time.time()
+        if self.update_conflate():
+            # the flag may have been set since these were logged
+            self.log.prune()
+        # hold a reference so the payloads are shared by all subscribers
+        for message in messages:
+            message.acquire()
+        try:
+            for session in self.server.subscribers.get(self.channel_id, ()):
+                session.on_channel_message(self.channel_id)
+        finally:
+            for message in messages:
+                message.release()
+        if self.server.relays:
+            self.server.relay(self)
+        self.mark_active()
+        self.server.metrics.fan_out.observe(time.time() - start)
 
-class Session(base.Session):
+def spool_handler(channel, data):
+    """Publish through the spool, as if the server had sent the message"""
+    channel.write(data)
+def inbox_handler(channel, data):
+    """Leave the message in the channel's in directory for the server to process"""
+    channel.write(data, inbox=True)
+def broadcast_handler(channel, data):
+    """Publish in memory, straight to the channel's subscribers"""
+    channel.publish('%s,%s'%(channel.channel_id, data))
+def persistent_broadcast_handler(channel, data):
+    """Publish in memory, writing the message into the channel's log afterwards"""
+    channel.publish('%s,%s'%(channel.channel_id, data), persist=True)
+
+# name: function(channel, data) for messages clients send to channels 
+# they can write, chosen by the channel's handler file (or --handler), 
+# register functions here to add handlers
+HANDLERS = {
+    'spool': spool_handler, 
+    'inbox': inbox_handler, 
+    'broadcast': broadcast_handler, 
+    'broadcast-persist': persistent_broadcast_handler, 
+}
+
+class Session(Activity, base.Session):
+    __slots__ = ('active', 'readable', 'writable', 'cursors', 'acked', 'protocols')
     def __init__(self, *args, **named):
+        self.active = 0
         self.readable = set()
         self.writable = set()
-        self.outgoing_queue = []
+        # channel_id: last sequence sent to our protocols
+        self.cursors = {}
+        # channel_id: last sequence acked by an ordered connection
+        self.acked = {}
         self.protocols = []
         super(Session, self).__init__(*args, **named)
     
     def setup(self):
         super(Session, self).setup()
-        for path, cb in [
-            (self.readable_path, self.on_readable_change), 
-            (self.writable_path, self.on_writable_change), 
-        ]:
-            self.server.inotify.watch(
-                filepath.FilePath(path), callbacks=[cb]
-            )
+        if not self.server.journal:
+            for path, cb in [
+                (self.readable_path, self.on_readable_change), 
+                (self.writable_path, self.on_writable_change), 
+            ]:
+                self.server.inotify.watch(
+                    filepath.FilePath(path), callbacks=[cb]
+                )
         # load any existing setup...
-        self.outgoing_queue[:] = [x[0] for x in base._ordered_ls(self.outbox_path)]
-        # readable/writable
         for channel in os.listdir(self.readable_path):
-            self.readable.add(channel)
+            self.grant_read(channel)
         for channel in os.listdir(self.writable_path):
-            self.writable.add(channel)
+            self.writable.add(base.intern_id(channel))
     def cleanup(self):
         for protocol in self.protocols:
             protocol.transport.loseConnection()
-        for path in (self.readable_path, self.writable_path):
-            try:
-                self.server.inotify.ignore(filepath.FilePath(path))
-            except KeyError:
-                pass
+        for channel in self.readable:
+            self.server.unsubscribe(channel, self)
+        if not self.server.journal:
+            for path in (self.readable_path, self.writable_path):
+                try:
+                    self.server.inotify.ignore(filepath.FilePath(path))
+                except KeyError:
+                    pass
+        if self.server.relays:
+            self.server.relay_command('drop', self.session_id)
         super(Session, self).cleanup()
     
+    @property
+    def directory(self):
+        return self.session_path
     def on_readable_change(self, _, path, mask ):
-        base = os.path.basename(path.path)
-        if mask & inotify.IN_CREATE or mask & inotify.IN_MOVED_TO or mask:
-            log.msg('Granting read to %s on %s'%(self.session_id, base))
-            self.mark_active()
-            self.readable.add(base)
-        elif mask & inotify.IN_DELETE:
-            log.msg('Revoking read from %s on %s'%(self.session_id, base))
-            self.readable.remove(base)
+        self.server.metrics.inotify_events['readable'] += 1
+        if path.path == self.readable_path:
+            # events on the directory itself (e.g. IN_IGNORED on removal)
+            return
+        if mask:
+            self.change_permission(
+                not (mask & REMOVED_MASK), 'readable', os.path.basename(path.path)
+            )
     def on_writable_change(self, _, path, mask ):
-        base = os.path.basename(path.path)
-        if mask & inotify.IN_CREATE or mask & inotify.IN_MOVED_TO or mask:
-            log.msg('Granting write to %s on %s'%(self.session_id, base))
-            self.mark_active()
-            self.writable.add(base)
-        elif mask & inotify.IN_DELETE:
-            log.msg('Revoking write from %s on %s'%(self.session_id, base))
-            self.writable.remove(base)
+        self.server.metrics.inotify_events['writable'] += 1
+        if path.path == self.writable_path:
+            return
+        if mask:
+            self.change_permission(
+                not (mask & REMOVED_MASK), 'writable', os.path.basename(path.path)
+            )
+    def change_permission(self, granted, mode, channel_id, since=None):
+        """Grant/revoke mode ('readable' or 'writable') on channel_id
+        
+        Called for flag-file inotify events and control journal commands.
+        """
+        if mode == 'readable':
+            if not granted:
+                if channel_id in self.readable:
+                    log.msg('Revoking read from %s on %s'%(self.session_id, channel_id))
+                    self.revoke_read(channel_id)
+            else:
+                if self.grant_read(channel_id, since):
+                    log.msg('Granting read to %s on %s'%(self.session_id, channel_id))
+                    self.send_pending([channel_id])
+                self.mark_active()
+        elif mode == 'writable':
+            if not granted:
+                if channel_id in self.writable:
+                    log.msg('Revoking write from %s on %s'%(self.session_id, channel_id))
+                    self.writable.discard(channel_id)
+            else:
+                if channel_id not in self.writable:
+                    log.msg('Granting write to %s on %s'%(self.session_id, channel_id))
+                    self.writable.add(base.intern_id(channel_id))
+                    for protocol in self.protocols:
+                        if protocol.binary:
+                            # so that it can publish with binary messages
+                            protocol.announce([channel_id])
+                self.mark_active()
+        else:
+            raise ValueError("Unknown permission %r"%(mode, ))
+        if self.server.relays:
+            self.server.relay_command(
+                'grant' if granted else 'revoke', self.session_id, mode, channel_id, since, 
+            )
+    def grant_read(self, channel_id, since=None):
+        """Start reading channel_id, returns False if already readable
+        
+        since -- sequence after which to start, defaults to the 
+            flag-file's "since" or the channel's current head
+        
+        A "since" is only applied once, the flag-file is then rewritten 
+        without it (so a restarted daemon doesn't re-send the backlog).
+        """
+        if channel_id in self.readable:
+            return False
+        # one copy of each channel id, however many sessions read it
+        channel_id = base.intern_id(channel_id)
+        flag = os.path.join(self.readable_path, channel_id)
+        if since is None:
+            since = base.flag_since(flag)
+        if since is None:
+            channel = self.server.channel(channel_id, create=False)
+            since = channel.log.head if channel is not None else 0
+            if since and channel.conflate:
+                # new subscribers start with the current value
+                since -= 1
+        elif self.server.OWNS_SPOOL:
+            self.server.io.submit(clear_since, [flag])
+        self.cursors[channel_id] = since
+        self.readable.add(channel_id)
+        self.server.subscribe(channel_id, self)
+        return True
+    def revoke_read(self, channel_id):
+        self.readable.discard(channel_id)
+        self.cursors.pop(channel_id, None)
+        self.acked.pop(channel_id, None)
+        for protocol in self.protocols:
+            protocol.forget(channel_id)
+        self.server.unsubscribe(channel_id, self)
     
-    def add_message(self, filename):
-        """Hardlink filename into our message queue"""
-        target = os.path.join(self.outbox_path, os.path.basename(filename))
-        os.link(filename, target )
-        self.outgoing_queue.append(target)
+    def resume(self, protocol, sequences=None):
+        """Ordered protocol has received our channels up to sequences
+        
+        sequences -- {channel_id: sequence} from the client (e.g. it is 
+            reconnecting), defaults to the last sequences acked by any 
+            of our connections
+        
+        Rewinds our cursors so that anything after those sequences (but 
+        nothing before them) is re-sent. Returns {channel_id: head} for 
+        channels where sequences are beyond the channel's head (the 
+        daemon lost track of its sequences), the client must carry on 
+        from there.
+        """
+        sequences = sequences or {}
+        rewound = {}
+        for channel_id in self.readable:
+            channel = self.server.channel(channel_id, create=False)
+            if channel is None:
+                continue
+            acked = sequences.get(channel_id, self.acked.get(channel_id))
+            if not isinstance(acked, (int, long)):
+                acked = self.cursors.get(channel_id, 0)
+            elif acked > channel.log.head:
+                rewound[channel_id] = channel.log.head
+            acked = max((0, min((acked, channel.log.head))))
+            protocol.cursors[channel_id] = protocol.acked[channel_id] = acked
+            if acked < self.cursors.get(channel_id, 0):
+                self.cursors[channel_id] = acked
+            if channel.log.pinned is None or acked < channel.log.pinned:
+                channel.log.pinned = acked
+        return rewound
+    def catch_up(self, protocol, channel_id):
+        """Protocol has (re-)subscribed to channel_id
+        
+        Ordered protocols are sent what they skipped while unsubscribed, 
+        others continue from the latest message.
+        """
+        sent = protocol.cursors.get(channel_id)
+        current = self.cursors.get(channel_id, 0)
+        if sent is None or not protocol.ordered:
+            protocol.cursors[channel_id] = max((sent or 0, current))
+            self.send_current(protocol, [channel_id])
+        elif sent < current and channel_id in self.readable:
+            # our other protocols skip what they already have
+            self.cursors[channel_id] = sent
+            self.send_pending([channel_id])
+    def connected(self, protocol):
+        """Protocol has connected (and handled its first message), deliver to it"""
+        if protocol not in self.protocols:
+            return
+        self.send_current(protocol, self.readable)
         self.send_pending()
-    def retire_message(self, filename):
-        """Retire message after it has been sent"""
-        # we sent a message (or tried, at least)
-        self.mark_active()
-        try:
-            self.outgoing_queue.remove(filename)
-        except ValueError:
-            pass
-        try:
-            os.unlink(filename)
-            return True
-        except Exception:
-            return False
+    def send_current(self, protocol, channel_ids):
+        """Send protocol the current (latest) message of conflated channel_ids
+        
+        Skipped where an ordered protocol has acked (resumed from) it.
+        """
+        sent = False
+        for channel_id in channel_ids:
+            channel = self.server.channel(channel_id, create=False)
+            if channel is None or not channel.conflate or not channel.log.entries:
+                continue
+            message = channel.log.entries[-1]
+            if protocol.acked.get(channel_id, 0) >= message.sequence:
+                continue
+            try:
+                message.acquire()
+            except (IOError, OSError):
+                continue
+            try:
+                if protocol.cursors.get(channel_id, 0) >= message.sequence:
+                    protocol.cursors[channel_id] = message.sequence - 1
+                protocol.add_message(message, conflate=True)
+            finally:
+                message.release()
+            sent = True
+        if sent:
+            protocol.schedule_send()
+    def rewind(self, channel_id, head):
+        """channel_id was re-created, positions beyond head were in its old log"""
+        for positions in (self.cursors, self.acked):
+            if positions.get(channel_id, 0) > head:
+                positions[channel_id] = head
+        for protocol in self.protocols:
+            protocol.rewind(channel_id, head)
+    def on_ack(self, protocol, sequences):
+        """Ordered protocol has acked {channel_id: sequence}"""
+        for channel_id, sequence in sequences.items():
+            if channel_id not in self.readable or not isinstance(sequence, (int, long)):
+                continue
+            if sequence > protocol.acked.get(channel_id, 0):
+                protocol.acked[channel_id] = sequence
+            if sequence > self.acked.get(channel_id, 0):
+                self.acked[channel_id] = sequence
+    
+    def on_channel_message(self, channel_id):
+        """Channel channel_id has logged a new message"""
+        self.send_pending([channel_id])
     def on_incoming(self, channel_id, data):
         assert base.simple_id(channel_id)
         if channel_id in self.writable:
             self.mark_active()
-            self.server.channel(channel_id).write(data)
+            self.server.on_incoming(channel_id, data)
             return True 
         else:
             log.err("Attempted write to unauth channel %r by %r"%( channel_id, self.session_id, ))
         return False
-    def send_pending(self):
-        """Called when we may have something to send..."""
-        to_send = self.outgoing_queue[:]
-        del self.outgoing_queue[:len(to_send)]
+    def send_pending(self, channel_ids=None):
+        """Called when we may have something to send...
+        
+        channel_ids -- if specified, only these (readable) channels 
+            can have new messages, otherwise check all readable
+        """
         send_to = [protocol for protocol in self.protocols if protocol.ready]
-        if send_to:
-            for message in to_send:
-                with open(message, 'rb') as fh:
-                    content = fh.read()
+        if not send_to:
+            # messages wait in the channel logs until we connect
+            return
+        to_send = []
+        conflated = set()
+        for channel_id in (self.readable if channel_ids is None else channel_ids):
+            channel = self.server.channel(channel_id, create=False)
+            if channel is None:
+                continue
+            entries = channel.log.since(self.cursors.get(channel_id, 0))
+            if entries and channel.conflate:
+                # only the newest message is worth reading and sending
+                entries = entries[-1:]
+                conflated.add(channel_id)
+            if entries:
+                to_send.extend(entries)
+                self.cursors[channel_id] = entries[-1].sequence
+        if not to_send:
+            return
+        if channel_ids is None or len(channel_ids) > 1:
+            to_send.sort(key=lambda message: message.timestamp)
+        for message in to_send:
+            try:
+                message.acquire()
+            except (IOError, OSError):
+                # pruned from the log before we got to it
+                continue
+            try:
+                conflate = message.channel_id in conflated
                 for protocol in send_to:
-                    protocol.add_message(content)
-                    # duh, this should wait until all protocols have sent it or 
-                    # errored out, not have the first one retire the message!
-                self.retire_message(message)
-            for protocol in send_to:
-                reactor.callLater(0, protocol.send_pending)
+                    protocol.add_message(message, conflate)
+            finally:
+                message.release()
+        self.mark_active()
+        for protocol in send_to:
+            protocol.schedule_send()
 
 class Server(base.Server):
     """Twisted API for the server"""
     SESSION_CLASS = Session 
     CHANNEL_CLASS = Channel
+    # we consume the outboxes/control journal and prune the logs
+    OWNS_SPOOL = True
+    LOG_RETENTION = 60*5
+    LOG_MESSAGES = 1000
+    LOG_BYTES = 16*1024*1024
+    BATCH_OUTBOX = True
+    CONTROL = 'watch'
+    # messages queued per connection before the overflow policy applies
+    QUEUE_LIMIT = 1000
+    OVERFLOW = 'drop-oldest'
+    # bytes buffered in a connection's socket before we stop writing to it
+    HIGH_WATER = 64*1024
+    # seconds an ordered connection may go without acking before it 
+    # stops holding messages in the channel logs
+    ACK_TIMEOUT = 60
+    # seconds between writing activity times to disk
+    FLUSH_FREQUENCY = 30
+    # load existing sessions/channels when first used (or in the background)
+    LAZY = True
+    # sessions/channels loaded per reactor tick in the background
+    REHYDRATE_BATCH = 500
+    # seconds between --workers children writing their metrics snapshots
+    METRICS_FREQUENCY = 10
+    # default handler for client messages (see HANDLERS)
+    HANDLER = 'spool'
+    # threads for filesystem work done off the reactor (see IOExecutor)
+    IO_THREADS = 2
+    # permessage-deflate compression level (0 to not offer the extension) 
+    # and the size below which messages are sent uncompressed
+    DEFLATE_LEVEL = 0
+    DEFLATE_THRESHOLD = 256
+    _rehydrate_call = None
+    _control_call = None
     def __init__(self, *args, **named):
+        self.batch_outbox = named.pop('batch_outbox', self.BATCH_OUTBOX)
+        # 'watch' -- inotify watches on every session/channel
+        # 'journal' -- a single watch on the control journal
+        self.journal = named.pop('control', self.CONTROL) == 'journal'
+
+        self.log_retention = named.pop('log_retention', self.LOG_RETENTION)
+        self.log_messages = named.pop('log_messages', self.LOG_MESSAGES)
+        self.log_bytes = named.pop('log_bytes', self.LOG_BYTES)
+        self.queue_limit = named.pop('queue_limit', self.QUEUE_LIMIT)
+        self.overflow = named.pop('overflow', self.OVERFLOW)
+        self.high_water = named.pop('high_water', self.HIGH_WATER)
+        self.ack_timeout = named.pop('ack_timeout', self.ACK_TIMEOUT)
+        self.handler = named.pop('handler', self.HANDLER)
+        self.io_threads = named.pop('io_threads', self.IO_THREADS)
+        level = named.pop('deflate_level', self.DEFLATE_LEVEL)
+        threshold = named.pop('deflate_threshold', self.DEFLATE_THRESHOLD)
+        # shared by every connection, so each message is compressed once
+        self.deflate = framing.FrameMaker(level, threshold) if level else None
         self.channels = {}
         self.sessions = {}
+        # channel_id: set(sessions) for sessions which can read channel_id
+        self.subscribers = {}
+        # sessions/channels marked active since the last flush_activity
+        self.dirty = set()
+        # heap of (expiry time, order, registry, id, session/channel)
+        self.expiry = []
+        self._expiry_order = itertools.count()
+        # ids of existing sessions/channels not yet loaded
+        self.lazy = named.pop('lazy', self.LAZY)
+        self.dormant_sessions = set()
+        self.dormant_channels = set()
+        # --workers processes we relay messages/permission changes to
+        self.relays = []
+        self.metrics = metrics.Metrics()
+        # channel_id: number and number: channel_id for binary connections
+        self.channel_numbers = {}
+        self.numbered_channels = {}
+        self._next_number = itertools.count(1)
         super(Server, self).__init__(*args, **named)
     def setup(self):
+        self.started = time.time()
         super(Server, self).setup()
+        self.io = IOExecutor(self.io_threads, self.spool_dir)
+        self.io.start()
         self.inotify = inotify.INotify()
         self.inotify.startReading()
-        for path, cb in [
+        watches = [
             (self.sessions_path, self.on_sessions_change), 
             (self.channels_path, self.on_channels_change), 
-        ]:
+        ]
+        if self.journal:
+            base._ensure_dirs([self.control_path])
+            watches.append((self.control_path, self.on_control))
+        elif os.path.isdir(self.control_path):
+            # left over from a journal-mode daemon, apply, then stop
+            # clients from writing to it
+            self.drain_control()
+            shutil.rmtree(self.control_path, True)
+        for path, cb in watches:
             assert os.path.exists(path)
             self.inotify.watch(
                 filepath.FilePath(path), callbacks=[cb]
             )
-        for channel_id in os.listdir(self.channels_path):
-            self.channel(channel_id, create=True)
-        for session_id in os.listdir(self.sessions_path):
-            self.session(session_id, create=True)
+        self.dormant_channels.update(os.listdir(self.channels_path))
+        self.dormant_sessions.update(os.listdir(self.sessions_path))
+        if not self.lazy:
+            self.rehydrate(len(self.dormant_channels) + len(self.dormant_sessions))
         self.reaping_loop = LoopingCall(self.reaper)
-        self.reaping_loop.start(120.0)
+        self.reaping_loop.start(self.REAPING_FREQUENCY)
+        self.flush_loop = LoopingCall(self.flush_activity)
+        self.flush_loop.start(self.FLUSH_FREQUENCY, now=False)
+        if self.journal:
+            # anything written before we started watching
+            self.drain_control()
+        log.msg('Server started in %.3fs, %s channels and %s sessions to load in the background'%(
+            time.time() - self.started, len(self.dormant_channels), len(self.dormant_sessions), 
+        ))
+        if self.dormant_channels or self.dormant_sessions:
+            self._rehydrate_call = reactor.callLater(0, self.rehydrate_batch)
+    def rehydrate(self, count=None):
+        """Load up to count (default REHYDRATE_BATCH) dormant channels and sessions
+        
+        Channels are loaded first, so that their messages are flowing 
+        before sessions connect. Returns the number still dormant.
+        """
+        count = count or self.REHYDRATE_BATCH
+        for dormant, load in (
+            (self.dormant_channels, self.channel), 
+            (self.dormant_sessions, self.session), 
+        ):
+            while dormant and count > 0:
+                load(dormant.pop())
+                count -= 1
+        return len(self.dormant_channels) + len(self.dormant_sessions)
+    def rehydrate_batch(self):
+        self._rehydrate_call = None
+        if self.rehydrate():
+            self._rehydrate_call = reactor.callLater(0, self.rehydrate_batch)
+        else:
+            log.msg('Finished loading sessions and channels %.3fs after start'%(
+                time.time() - self.started, 
+            ))
     def cleanup(self):
-        for path in (self.sessions_path, self.channels_path):
+        for call in (self._control_call, self._rehydrate_call):
+            if call is not None and call.active():
+                call.cancel()
+        for channel in self.channels.values():
+            channel.persist_published()
+            if channel.log.cancel_head():
+                channel.log.write_head()
+            channel.cancel_calls()
+        for path in (self.sessions_path, self.channels_path, self.control_path):
             try:
-                self.server.inotify.ignore(filepath.FilePath(path))
+                self.inotify.ignore(filepath.FilePath(path))
             except KeyError:
                 pass
         super(Server, self).cleanup()
         self.reaping_loop.stop()
+        self.flush_loop.stop()
+        self.flush_activity()
+        self.io.stop()
+        self.inotify.stopReading()
+        self.inotify.connectionLost(None)
         
     def session(self, session_id, create=True):
         current = self.sessions.get(session_id)
-        if (current is None) and create:
+        if (current is None) and (create or session_id in self.dormant_sessions):
+            self.dormant_sessions.discard(session_id)
             current = super(Server, self).session(session_id)
             self.sessions[session_id] = current 
+            self.expire_later(self.sessions, session_id, current)
         return current 
     def channel(self, channel_id, create=True):
         current = self.channels.get(channel_id)
-        if (current is None) and create:
+        if (current is None) and (create or channel_id in self.dormant_channels):
+            self.dormant_channels.discard(channel_id)
+            channel_id = base.intern_id(channel_id)
             current = super(Server, self).channel(channel_id)
             self.channels[channel_id] = current 
+            if channel_id in self.subscribers:
+                current.rewind()
+            self.expire_later(self.channels, channel_id, current)
         return current 
 
+    def channel_number(self, channel_id):
+        """Get channel_id's number (assigned on first use) for binary connections"""
+        number = self.channel_numbers.get(channel_id)
+        if number is None:
+            channel_id = base.intern_id(channel_id)
+            number = self.channel_numbers[channel_id] = next(self._next_number)
+            self.numbered_channels[number] = channel_id
+        return number
+    def forget_channel_number(self, channel_id):
+        """Channel channel_id was removed, a new one will get a new number"""
+        number = self.channel_numbers.pop(channel_id, None)
+        if number is not None:
+            self.numbered_channels.pop(number, None)
+    def on_incoming(self, channel_id, data):
+        """A client has sent data on channel_id (which it can write)"""
+        self.channel(channel_id).incoming(data)
+    def subscribe(self, channel_id, session):
+        """Record that session should receive messages from channel_id"""
+        subscribers = self.subscribers.get(channel_id)
+        if subscribers is None:
+            subscribers = self.subscribers[channel_id] = set()
+        subscribers.add(session)
+    def unsubscribe(self, channel_id, session):
+        """Record that session no longer receives messages from channel_id"""
+        subscribers = self.subscribers.get(channel_id)
+        if subscribers is not None:
+            subscribers.discard(session)
+            if not subscribers:
+                del self.subscribers[channel_id]
+
     def on_channels_change(self, _, path, mask ):
+        self.metrics.inotify_events['channels'] += 1
         channel_id = os.path.basename(path.path)
-        if mask & inotify.IN_CREATE or mask & inotify.IN_MOVED_TO or mask:
+        if path.path == self.channels_path:
+            return
+        if mask & REMOVED_MASK:
+            self.dormant_channels.discard(channel_id)
+            channel = self.channel(channel_id, create=False)
+            if channel is not None:
+                channel.cleanup()
+                self.channels.pop(channel_id, None)
+        elif mask:
             self.channel(channel_id)
-        elif mask & inotify.IN_DELETE:
-            channel = self.channel(channel_id)
-            channel.cleanup()
     def on_sessions_change(self, _, path, mask):
+        self.metrics.inotify_events['sessions'] += 1
         session_id = os.path.basename(path.path)
-        if mask & inotify.IN_CREATE or mask & inotify.IN_MOVED_TO or mask:
+        if path.path == self.sessions_path:
+            return
+        if mask & REMOVED_MASK:
+            self.dormant_sessions.discard(session_id)
+            session = self.session(session_id, create=False)
+            if session is not None:
+                session.cleanup()
+                self.sessions.pop(session_id, None)
+        elif mask:
             self.session(session_id)
-        elif mask & inotify.IN_DELETE:
-            session = self.session(session_id)
-            session.cleanup()
+    
+    def on_control(self, _, path, mask):
+        self.metrics.inotify_events['control'] += 1
+        if mask & inotify.IN_CREATE or mask & inotify.IN_MOVED_TO:
+            # coalesce all of this tick's events into one drain pass
+            if self._control_call is None:
+                self._control_call = reactor.callLater(0, self.drain_control)
+    def drain_control(self):
+        """Apply the control journal's commands and publish its messages, in order"""
+        self._control_call = None
+        published = {}
+        for filename, _ in base._ordered_ls(self.control_path):
             try:
-                del self.sessions[session_id]
-            except KeyError:
-                pass
+                with open(filename, 'rb') as fh:
+                    content = fh.read()
+                if filename.endswith(base.COMMAND_SUFFIX):
+                    os.unlink(filename)
+                    for command in content.splitlines():
+                        self.apply_command(command)
+                    continue
+                if filename.endswith(base.BATCH_SUFFIX):
+                    offset, length = base.decode_batch(content)[0]
+                    channel_id = content[offset:offset+length].split(',', 1)[0]
+                else:
+                    channel_id = content.split(',', 1)[0]
+                if not base.simple_id(channel_id):
+                    raise ValueError("Invalid channel %r"%(channel_id, ))
+                channel = self.channel(channel_id)
+                published.setdefault(channel, []).extend(
+                    channel.log.append(filename, content)
+                )
+            except (IOError, OSError, ValueError, IndexError) as err:
+                log.msg('Unable to process control file %s: %s'%(filename, err))
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+        for channel, messages in published.items():
+            if messages:
+                channel.fan_out(messages)
+    COMMANDS = ('grant', 'revoke')
+    def apply_command(self, command):
+        """Apply a control journal command, e.g. "grant session readable channel [since]" """
+        parts = command.split()
+        if not parts:
+            return
+        try:
+            action, session_id, mode, channel_id = parts[:4]
+            since = int(parts[4]) if len(parts) > 4 else None
+        except ValueError:
+            log.msg('Malformed control command: %r'%(command, ))
+            return
+        if action not in self.COMMANDS or not (
+            base.simple_id(session_id) and base.simple_id(channel_id)
+        ):
+            log.msg('Invalid control command: %r'%(command, ))
+            return
+        session = self.session(session_id)
+        try:
+            session.change_permission(action == 'grant', mode, channel_id, since)
+        except ValueError as err:
+            log.msg('Invalid control command: %r %s'%(command, err))
     
     REAPING_FREQUENCY = 60*2
     SESSION_TIMEOUT = 60*60*4
+    @property
+    def metrics_path(self):
+        """Directory in which --workers children write their metrics"""
+        return os.path.join(self.base_path, 'metrics')
+    def expire_later(self, registry, key, target, when=None):
+        """Schedule a check of whether target (registry[key]) has expired"""
+        if when is None:
+            when = target.last_active() + self.SESSION_TIMEOUT
+        heapq.heappush(self.expiry, (when, next(self._expiry_order), registry, key, target))
     def reaper(self):
         current =  time.time()
-        stale = current - self.SESSION_TIMEOUT
-        
-        for session_id, session in self.sessions.items():
-            last = session.last_active()
-            if last < stale:
-                if not session.protocols:
-                    log.msg('Clearing out session: %s'%(session_id))
-                    session.cleanup()
-                else:
-                    log.msg('Session %s is inactive, but has connections'%(session_id, ))
-        for channel_id, channel in self.channels.items():
-            last = channel.last_active()
-            if last < stale:
-                log.msg('Clearing out channel: %s'%(channel_id))
-                channel.cleanup()
+        # only what is due is checked, anything active since it was 
+        # scheduled is re-scheduled for its new expiry time
+        while self.expiry and self.expiry[0][0] <= current:
+            _, _, registry, key, target = heapq.heappop(self.expiry)
+            if registry.get(key) is not target:
+                # already removed
+                continue
+            last = max((target.last_active(), target.stored_active()))
+            if last + self.SESSION_TIMEOUT > current:
+                target.active = last
+                self.expire_later(registry, key, target)
+            elif getattr(target, 'protocols', None):
+                log.msg('Session %s is inactive, but has connections'%(key, ))
+                self.expire_later(registry, key, target, current + self.REAPING_FREQUENCY)
+            else:
+                log.msg('Clearing out %s: %s'%(
+                    'session' if registry is self.sessions else 'channel', key, 
+                ))
+                target.cleanup()
+                registry.pop(key, None)
+        for channel in self.channels.values():
+            if channel.log.entries:
+                channel.log.pinned = channel.unacked(current)
+                channel.log.prune(current)
+        self.metrics.reaper.observe(time.time() - current)
+    def relay(self, channel):
+        """Send channel's messages logged since the last relay to our workers"""
+        entries = channel.log.since(channel.relayed)
+        if not entries:
+            return
+        records = []
+        for message in entries:
+            try:
+                message.acquire()
+            except (IOError, OSError):
+                continue
+            try:
+                records.append(message.sequenced())
+            finally:
+                message.release()
+        channel.relayed = entries[-1].sequence
+        self.send_relay(records)
+    def relay_command(self, *parts):
+        """Send a control command (see apply_command) to our workers"""
+        self.send_relay(['!' + ' '.join([str(part) for part in parts if part is not None])])
+    def send_relay(self, records):
+        data = ''.join([struct.pack('!I', len(record)) + record for record in records])
+        for relay in self.relays:
+            relay.transport.write(data)
+    def flush_activity(self):
+        """Write the activity times of everything marked active to disk"""
+        dirty, self.dirty = self.dirty, set()
+        if dirty:
+            self.io.submit(touch_all, [target.directory for target in dirty])
     
+class WorkerServer(Server):
+    """Server for a --workers child process
+    
+    Workers only serve WebSocket connections, the parent process 
+    consumes the spool and relays each message it logs (and each 
+    permission change) to every worker (see RelayProtocol). Sessions 
+    and channels are loaded from the spool when first used, and no 
+    inotify watches are needed.
+    """
+    OWNS_SPOOL = False
+    metrics_loop = None
+    # RelayProtocol, on which we send client messages to the parent
+    upstream = None
+    def __init__(self, *args, **named):
+        # i.e. no per-session/channel watches
+        named['control'] = 'journal'
+        super(WorkerServer, self).__init__(*args, **named)
+    def setup(self):
+        self.started = time.time()
+        base.Server.setup(self)
+        self.io = IOExecutor(self.io_threads, self.spool_dir)
+        self.io.start()
+        self.reaping_loop = LoopingCall(self.reaper)
+        self.reaping_loop.start(self.REAPING_FREQUENCY)
+        self.flush_loop = LoopingCall(self.flush_activity)
+        self.flush_loop.start(self.FLUSH_FREQUENCY, now=False)
+    def cleanup(self):
+        for channel in self.channels.values():
+            channel.cancel_calls()
+        self.reaping_loop.stop()
+        self.flush_loop.stop()
+        self.flush_activity()
+        if self.metrics_loop is not None:
+            self.metrics_loop.stop()
+            self.metrics_loop = None
+        self.io.stop()
+    def write_metrics(self, number):
+        """Start writing our metrics for the parent's --metrics listener"""
+        base._ensure_dirs([self.metrics_path])
+        filename = os.path.join(self.metrics_path, '%s.json'%(number, ))
+        self.metrics_loop = LoopingCall(metrics.write_snapshot, self, filename)
+        self.metrics_loop.start(self.METRICS_FREQUENCY)
+    def session(self, session_id, create=True):
+        return super(WorkerServer, self).session(
+            session_id, create or os.path.isdir(self.session_path(session_id))
+        )
+    def channel(self, channel_id, create=True):
+        return super(WorkerServer, self).channel(
+            channel_id, create or os.path.isdir(self.channel_path(channel_id))
+        )
+    def on_incoming(self, channel_id, data):
+        """The parent applies the channel's handler (it owns the spool and sequences)"""
+        if self.upstream is None:
+            return super(WorkerServer, self).on_incoming(channel_id, data)
+        self.upstream.sendString('%s,%s'%(channel_id, data))
+    def apply_command(self, command):
+        """Apply a relayed command, including "drop session" (session removed) 
+        and "forget channel" (channel removed)"""
+        parts = command.split()
+        if len(parts) == 2 and parts[0] == 'forget':
+            channel = self.channels.pop(parts[1], None)
+            if channel is not None:
+                channel.cleanup()
+            return
+        if len(parts) < 2 or parts[1] not in self.sessions:
+            # not loaded, it will read its permissions when it is
+            return
+        if parts[0] == 'drop':
+            self.sessions.pop(parts[1]).cleanup()
+            return
+        super(WorkerServer, self).apply_command(command)
+    def flush_activity(self):
+        # our connected sessions are active as far as the parent's reaper knows
+        for session in self.sessions.values():
+            if session.protocols:
+                self.dirty.add(session)
+        super(WorkerServer, self).flush_activity()
+
+def channel_ids(values):
+    """Get the (interned) valid channel ids from a client-supplied list"""
+    return [
+        base.intern_id(value) for value in values
+        if isinstance(value, basestring) and base.simple_id(value)
+    ]
+
+# txws flavours for which we can write pre-built (shared) frames
+FRAME_MAKERS = {
+    txws.HYBI00: txws.make_hybi00_frame, 
+    txws.HYBI07: txws.make_hybi07_frame, 
+    txws.HYBI10: txws.make_hybi07_frame, 
+    txws.RFC6455: txws.make_hybi07_frame, 
+}
+
 from twisted.internet.protocol import Protocol, Factory
-class SSWSProtocol(Protocol):
-    ready = False
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+@implementer(IPushProducer)
+class SSWSProtocol(Protocol, object):
+    """Session's connection, a streaming producer for its socket
+    
+    The socket pauses us when more than the server's high_water bytes 
+    are buffered (i.e. the client isn't reading), messages then wait 
+    in outgoing_queue, which holds at most the server's queue_limit 
+    messages, beyond that each channel's overflow policy applies.
+    
+    Clients can request ordered delivery with a protocol-level 
+    message (empty channel):
+    
+        ,{"ordered":true,"resume":{"channel_id":sequence}}
+    
+    after which messages are sent as "channel_id:sequence,data", the 
+    client acks with ,{"ack":{"channel_id":sequence}} and a reconnecting 
+    client is sent only what follows its resume (or last acked) sequences.
+    Resume sequences beyond a channel's head (the daemon lost track of 
+    its sequences) are answered with ,{"heads":{"channel_id":sequence}}.
+    
+    By default a connection receives every channel its session can 
+    read, it can narrow (and later change) that with:
+    
+        ,{"subscribe":["channel_id",...]} -- only these (and any 
+            channels subscribed before), "*" for all channels again
+        ,{"unsubscribe":["channel_id",...]} -- not these
+    
+    which don't change the session's permissions. Ordered connections 
+    are sent what they missed when they re-subscribe, unordered ones 
+    only new messages.
+    
+    Clients can send several messages in one frame:
+    
+        ,{"batch":["channel_id,data",",{\\"ack\\":{...}}",...]}
+    
+    Clients which connect with the "ssws.binary" subprotocol are sent 
+    binary messages with channel numbers instead of "channel_id,data", 
+    see framing.
+    """
+    # new-style (Protocol isn't) so that __slots__ applies, Protocol's 
+    # own attributes (transport, factory...) are still in __dict__
+    __slots__ = (
+        'outgoing_queue', 'cursors', 'acked', 'ready', 'paused', 'ordered', 
+        'last_ack', 'dropped', 'queue_limit', '_send_call', '_session', 
+        '_metrics', 'interest', 'excluded', 'binary', 'announced', 
+    )
+    # Write each message's frame (built once per message) directly to 
+    # the socket rather than having txws frame it for each connection
+    SHARED_FRAMES = True
     def __init__(self, *args, **named):
-        self.outgoing_queue = []
-    def add_message(self, message):
+        self.ready = False
+        self.paused = False
+        self.ordered = False
+        self.last_ack = 0
+        # messages dropped by overflow policies
+        self.dropped = 0
+        self.queue_limit = Server.QUEUE_LIMIT
+        self._send_call = None
+        self._session = None
+        # our server's Metrics (None when we have no server)
+        self._metrics = None
+        self.outgoing_queue = collections.deque()
+        # channel_id: last sequence queued (so we never send one twice)
+        self.cursors = {}
+        # channel_id: last sequence acked (ordered mode)
+        self.acked = {}
+        # channels subscribed (None for all readable) and unsubscribed
+        self.interest = None
+        self.excluded = None
+        # binary framing (see framing), channel numbers the client knows
+        self.binary = False
+        self.announced = None
+    def connectionMade(self):
+        server = self.factory.server
+        connection = self.transport.transport
+        if server is not None:
+            self._metrics = server.metrics
+            self.queue_limit = server.queue_limit
+            if hasattr(connection, 'bufferSize'):
+                connection.bufferSize = server.high_water
+        connection.registerProducer(self, True)
+    @property
+    def queue_depth(self):
+        """Number of messages waiting to be written"""
+        return len(self.outgoing_queue)
+    def pauseProducing(self):
+        self.paused = True
+    def resumeProducing(self):
+        self.paused = False
+        self.schedule_send()
+    def stopProducing(self):
+        self.paused = True
+    def forget(self, channel_id):
+        """Channel channel_id is no longer readable, a re-grant starts afresh"""
+        self.cursors.pop(channel_id, None)
+        self.acked.pop(channel_id, None)
+    def rewind(self, channel_id, head):
+        """channel_id was re-created, its sequences carry on from head"""
+        if self.cursors.get(channel_id, 0) <= head:
+            return
+        self.cursors[channel_id] = head
+        if self.acked.get(channel_id, 0) > head:
+            self.acked[channel_id] = head
+        if self.ordered:
+            # the client has seen higher sequences, see Session.resume
+            self.transport.write(',%s'%(json.dumps({'heads': {channel_id: head}}), ))
+    def add_message(self, message, conflate=False):
+        """Queue (shared) Message for sending (unless already sent or not of interest)
+        
+        conflate -- message replaces any queued message on its channel
+        """
+        if message.sequence <= self.cursors.get(message.channel_id, 0):
+            return
+        if self.interest is not None and message.channel_id not in self.interest:
+            return
+        if self.excluded and message.channel_id in self.excluded:
+            return
+        if conflate and self.outgoing_queue:
+            self.discard_queued(set([message.channel_id]))
+        self.cursors[message.channel_id] = message.sequence
+        message.acquire()
         self.outgoing_queue.append(message)
+        if len(self.outgoing_queue) > self.queue_limit:
+            self.overflow(message)
+    def subscribe(self, channel_ids):
+        """Receive channel_ids' messages, if we were receiving all, only theirs"""
+        if self.interest is None:
+            self.interest, self.excluded = set(), None
+        for channel_id in channel_ids:
+            self.interest.add(channel_id)
+            self._session.catch_up(self, channel_id)
+    def subscribe_all(self):
+        """Receive every readable channel's messages (the default)"""
+        if self.interest is not None:
+            channel_ids = set(self._session.readable) - self.interest
+        else:
+            channel_ids = set(self._session.readable) & (self.excluded or set())
+        self.interest = self.excluded = None
+        for channel_id in channel_ids:
+            self._session.catch_up(self, channel_id)
+    def unsubscribe(self, channel_ids):
+        """Stop receiving channel_ids' messages (dropping any still queued)"""
+        channel_ids = set(channel_ids)
+        if self.interest is not None:
+            self.interest -= channel_ids
+        elif self.excluded is None:
+            self.excluded = channel_ids
+        else:
+            self.excluded |= channel_ids
+        for message in self.discard_queued(channel_ids):
+            # so that a re-subscribe can start from the first unsent message
+            if message.sequence <= self.cursors.get(message.channel_id, 0):
+                self.cursors[message.channel_id] = message.sequence - 1
+    def discard_queued(self, channel_ids, keep=None):
+        """Remove (and release) queued messages on channel_ids (except keep), returns them"""
+        queue = self.outgoing_queue
+        discarded = [m for m in queue if m.channel_id in channel_ids and m is not keep]
+        for message in discarded:
+            queue.remove(message)
+            message.release()
+        return discarded
+    def overflow(self, message):
+        """Our queue is full, apply message's channel's overflow policy"""
+        server = self.factory.server
+        channel = server.channel(message.channel_id, create=False)
+        policy = server.overflow if channel is None else channel.overflow_policy()
+        queue = self.outgoing_queue
+        before = len(queue)
+        if policy == 'disconnect':
+            log.msg('Disconnecting slow connection on session %r (%s queued)'%(
+                getattr(self._session, 'session_id', None), before, 
+            ))
+            self.ready = False
+            self.transport.transport.abortConnection()
+            return
+        if policy == 'drop-newest':
+            queue.pop().release()
+        elif policy == 'coalesce':
+            # only the latest message on the channel is still worth sending
+            self.discard_queued(set([message.channel_id]), keep=message)
+        else:
+            # the oldest queued message, whichever channel it is on
+            queue.popleft().release()
+        if len(queue) > self.queue_limit:
+            # other channels' messages are filling the queue
+            queue.popleft().release()
+        if not self.dropped:
+            log.msg('Connection on session %r is falling behind, dropping messages'%(
+                getattr(self._session, 'session_id', None), 
+            ))
+        self.dropped += before - len(queue)
+        if self._metrics is not None:
+            self._metrics.dropped += before - len(queue)
     def write_error(self, message, channel=''):
         self.transport.write('%s,%s'%(channel, json.dumps({'error':True, 'message':message})))
     def write_welcome(self, channel=''):
+        if self.binary:
+            self.announce(self._session.readable | self._session.writable, welcome=True)
+            return
         self.transport.write('%s,{"success":true,"message":"Connection established"}'%(channel, ))
+    def announce(self, channel_ids, welcome=False):
+        """Tell a binary connection the numbers of channel_ids"""
+        server = self.factory.server
+        numbers = dict([
+            (channel_id, server.channel_number(channel_id)) for channel_id in channel_ids
+        ])
+        self.announced.update(numbers.values())
+        control = {'channels': numbers}
+        if welcome:
+            control.update({'success': True, 'message': 'Connection established'})
+        self.transport.write(',%s'%(json.dumps(control), ))
     def dataReceived(self, data):
+        if self._metrics is not None:
+            self._metrics.frames_received += 1
+            self._metrics.bytes_received += len(data)
         if self.transport.protocol.state == txws.FRAMES:
             if not self._session:
                 session_id = self.transport.protocol.location.rstrip('/').split('/')[-1]
@@ -255,51 +1766,309 @@ class SSWSProtocol(Protocol):
                     return
                 self._session = session
                 self._session.protocols.append(self)
+                self.cursors.update(session.cursors)
+                if getattr(self.transport.protocol, 'subprotocol', None) == framing.BINARY_PROTOCOL:
+                    self.binary = True
+                    self.announced = set()
                 self.write_welcome()
+                # deliver anything logged since the session's cursors 
+                # (once our first message has set up ordering/interest)
+                reactor.callLater(0, session.connected, self)
             else:
                 session = self._session
-            try:
-                channel_id, data = data.split(',', 1)
-            except ValueError:
-                log.error('Mis-formatted request (no ,)')
-                self.write_error('Missing comma in request')
-                return 
-            if not channel_id:
-                """Protocol-level messages, currently nothing"""
-                pass 
-            elif not base.simple_id(channel_id):
-                log.err("Invalid Channel ID: %r"%( channel_id, ))
-                self.write_error("invalid channel")
-                self.transport.loseConnection()
+            if getattr(self.transport.protocol, 'opcode', None) == framing.BINARY:
+                self.binary_received(data)
                 return
-            else:
-                session.on_incoming(channel_id, data)
-            self.ready = True
-    _session = None
+            if self.message_received(data):
+                self.ready = True
+    def message_received(self, data, batched=False):
+        """Handle a "channel_id,data" message, returns False if we are disconnecting
+        
+        batched -- data is from a batch (which can't contain batches)
+        """
+        try:
+            channel_id, data = data.split(',', 1)
+        except ValueError:
+            log.msg('Mis-formatted request (no ,)')
+            self.write_error('Missing comma in request')
+            return False
+        if not channel_id:
+            self.on_control(data, batched)
+        elif not base.simple_id(channel_id):
+            log.err("Invalid Channel ID: %r"%( channel_id, ))
+            self.write_error("invalid channel")
+            self.transport.loseConnection()
+            return False
+        else:
+            self._session.on_incoming(channel_id, data)
+        return True
+    def binary_received(self, data):
+        """Handle a binary (channel number, payload) message"""
+        try:
+            number, data = framing.unpack_message(data)
+        except ValueError as err:
+            self.write_error(str(err))
+            return
+        channel_id = self.factory.server.numbered_channels.get(number)
+        if channel_id is None:
+            self.write_error('unknown channel number %s'%(number, ))
+            return
+        self._session.on_incoming(channel_id, data)
+        self.ready = True
+    def on_control(self, data, batched=False):
+        """Handle a protocol-level (empty channel) message"""
+        try:
+            control = json.loads(data)
+        except ValueError:
+            control = None
+        if not isinstance(control, dict):
+            log.msg('Mis-formatted protocol message: %r'%(data[:64], ))
+            return
+        resume, ack = control.get('resume'), control.get('ack')
+        if control.get('ordered') and not self.ordered:
+            self.ordered = True
+            self.last_ack = time.time()
+            rewound = self._session.resume(self, resume if isinstance(resume, dict) else None)
+            if rewound:
+                self.transport.write(',%s'%(json.dumps({'heads': rewound}), ))
+            if self.ready:
+                self._session.send_pending()
+        subscribe, unsubscribe = control.get('subscribe'), control.get('unsubscribe')
+        if subscribe == '*':
+            self.subscribe_all()
+        elif isinstance(subscribe, list):
+            self.subscribe(channel_ids(subscribe))
+        if isinstance(unsubscribe, list):
+            self.unsubscribe(channel_ids(unsubscribe))
+        if isinstance(ack, dict) and self.ordered:
+            self.last_ack = time.time()
+            self._session.on_ack(self, ack)
+        batch = control.get('batch')
+        if isinstance(batch, list) and not batched:
+            for message in batch:
+                if not isinstance(message, basestring):
+                    continue
+                if isinstance(message, unicode):
+                    message = message.encode('utf-8')
+                if not self.message_received(message, batched=True):
+                    break
     def connectionLost(self, reason):
         self.ready = False
+        if self._send_call is not None and self._send_call.active():
+            self._send_call.cancel()
+        self._send_call = None
+        while self.outgoing_queue:
+            self.outgoing_queue.pop().release()
         try:
             self._session.protocols.remove(self)
         except (AttributeError, ValueError):
             pass 
+    def frame_maker(self):
+        """Get the function to frame messages for our connection (or None)"""
+        websocket = self.transport.protocol
+        if self.binary:
+            # always framed by us, txws would send text frames
+            return getattr(websocket, 'deflate', None) or txws.make_hybi07_frame
+        if self.SHARED_FRAMES and not (
+            websocket.codec or websocket.do_binary_frames or websocket.pending_frames
+        ):
+            return getattr(websocket, 'deflate', None) or FRAME_MAKERS.get(websocket.flavor)
+        return None
+    def schedule_send(self):
+        """Flush our queue on the next reactor tick (at most one flush per tick)"""
+        if self._send_call is None:
+            self._send_call = reactor.callLater(0, self.send_pending)
     def send_pending(self):
-        if not self.transport.protocol.state == txws.FRAMES:
+        self._send_call = None
+        websocket = self.transport.protocol
+        if not websocket.state == txws.FRAMES:
             return 
-        while self.outgoing_queue:
-            message = self.outgoing_queue.pop()
-            self.transport.write(message)
+        maker = self.frame_maker()
+        queue = self.outgoing_queue
+        frames = written = 0
+        # writing can pause us (the socket's buffer passed high_water)
+        while queue and not self.paused:
+            message = queue.popleft()
+            try:
+                if self.binary:
+                    number = self.factory.server.channel_number(message.channel_id)
+                    if number not in self.announced:
+                        self.announce([message.channel_id])
+                    data = message.frame(maker, self.ordered, number)
+                    websocket.transport.write(data)
+                elif maker is not None:
+                    # server->client frames are unmasked, so identical for everyone
+                    data = message.frame(maker, self.ordered)
+                    websocket.transport.write(data)
+                else:
+                    data = message.sequenced() if self.ordered else message.payload
+                    self.transport.write(data)
+            finally:
+                message.release()
+            frames += 1
+            written += len(data)
+        if self._metrics is not None:
+            self._metrics.frames_written += frames
+            self._metrics.bytes_written += written
+
+from twisted.protocols.basic import Int32StringReceiver
+class PublishProtocol(Int32StringReceiver):
+    """Local producers publishing length-prefixed "channel_id,payload" records
+    
+    Lets producers on the same machine skip the spool/inotify round 
+    trip, see sync.Channel.write
+    """
+    MAX_LENGTH = 16*1024*1024
+    def stringReceived(self, record):
+        channel_id = record.split(',', 1)[0]
+        if not base.simple_id(channel_id):
+            log.err("Invalid channel published: %r"%(channel_id, ))
+            return
+        self.factory.server.channel(channel_id).publish(record)
+    def lengthLimitExceeded(self, length):
+        log.err("Published message too large (%s bytes), disconnecting"%(length, ))
+        self.transport.loseConnection()
+
+class IncomingProtocol(PublishProtocol):
+    """Client messages, "channel_id,data", forwarded by a --workers child
+    
+    The worker has checked the session can write the channel.
+    """
+    def stringReceived(self, record):
+        try:
+            channel_id, data = record.split(',', 1)
+        except ValueError:
+            log.err("Mis-formatted forwarded message: %r"%(record[:64], ))
+            return
+        if not base.simple_id(channel_id):
+            log.err("Invalid channel forwarded: %r"%(channel_id, ))
+            return
+        self.factory.server.on_incoming(channel_id, data)
+
+class RelayProtocol(Int32StringReceiver):
+    """A worker's end of the relay from the parent process (on stdin)
+    
+    Records are either messages, "channel_id:sequence,data" or 
+    commands for WorkerServer.apply_command, prefixed with "!".
+    We send client messages back to the parent (on fd 4).
+    """
+    MAX_LENGTH = PublishProtocol.MAX_LENGTH + 1024
+    def __init__(self, server):
+        self.server = server
+    def stringReceived(self, record):
+        if record.startswith('!'):
+            self.server.apply_command(record[1:])
+            return
+        try:
+            header, data = record.split(',', 1)
+            channel_id, sequence = header.split(':')
+            sequence = int(sequence)
+        except ValueError:
+            log.err("Mis-formatted relay record: %r"%(record[:64], ))
+            return
+        self.server.channel(channel_id).publish('%s,%s'%(channel_id, data), sequence)
+    def connectionLost(self, reason):
+        log.msg("Parent process has exited, stopping")
+        if reactor.running:
+            reactor.stop()
+
+from twisted.internet.protocol import ProcessProtocol
+class WorkerProcess(ProcessProtocol):
+    """The parent's end of a --workers child process (we write to its stdin)
+    
+    A worker which exits is started again (by spawn) after RESTART_DELAY 
+    seconds, doubled for each exit in a row within RESTART_RESET seconds 
+    of starting, at most MAX_RESTART_DELAY.
+    """
+    RESTART_DELAY = 1
+    MAX_RESTART_DELAY = 60
+    RESTART_RESET = 60
+    def __init__(self, server, number, spawn=None, failures=0):
+        self.server = server
+        self.number = number
+        self.incoming = None
+        # function(number, failures) starting a replacement child
+        self.spawn = spawn
+        # exits in a row (quickly) before we were started
+        self.failures = failures
+        self.started = time.time()
+    def connectionMade(self):
+        self.server.relays.append(self)
+        self.incoming = IncomingFactory(self.server).buildProtocol(None)
+        self.incoming.makeConnection(self.transport)
+    def childDataReceived(self, fd, data):
+        if fd == 4:
+            self.incoming.dataReceived(data)
+    def processEnded(self, reason):
+        log.msg("Worker %s exited: %s"%(self.number, reason.value))
+        if self in self.server.relays:
+            self.server.relays.remove(self)
+        if self.spawn is None:
+            return
+        if time.time() - self.started >= self.RESTART_RESET:
+            self.failures = 0
+        delay = min((self.MAX_RESTART_DELAY, self.RESTART_DELAY * 2**self.failures))
+        return reactor.callLater(delay, self.spawn, self.number, self.failures + 1)
+
+def listening_address(listen):
+    """Get (family, interface, port, backlog) for a tcp: strport"""
+    from twisted.internet import endpoints
+    kind, args, named = endpoints._parseServer(listen, None)
+    if kind != 'TCP':
+        raise ValueError("--workers requires a tcp: listening port")
+    interface = named.get('interface', '')
+    family = socket.AF_INET6 if ':' in interface else socket.AF_INET
+    return family, interface, args[0], named.get('backlog', 50)
+
+def spawn_workers(server, arguments):
+    """Listen and start arguments.workers children accepting on our socket"""
+    family, interface, port, backlog = listening_address(arguments.listen)
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((interface, port))
+    listener.listen(backlog)
+    listener.setblocking(False)
+    stopping = []
+    reactor.addSystemEventTrigger('before', 'shutdown', stopping.append, True)
+    def spawn(number, failures=0):
+        if stopping:
+            return
+        if failures:
+            log.msg("Restarting worker %s"%(number, ))
+        reactor.spawnProcess(
+            WorkerProcess(server, number, spawn, failures), 
+            sys.executable, 
+            [sys.executable, '-m', 'ssws.service'] + sys.argv[1:] + ['--worker', str(number)], 
+            env=os.environ, 
+            childFDs={0: 'w', 1: 1, 2: 2, 3: listener.fileno(), 4: 'r'}, 
+        )
+    for number in range(arguments.workers):
+        spawn(number)
+    return listener
+
+class PublishFactory(Factory):
+    protocol = PublishProtocol
+    def __init__(self, server):
+        self.server = server
+
+class IncomingFactory(PublishFactory):
+    protocol = IncomingProtocol
 
 class SSWSFactory(Factory):
     protocol = SSWSProtocol
     def __init__(self, server, *args, **named ):
         self.server = server 
 
+def websocket_factory(server):
+    """Wrap an SSWSFactory for server in txws (offering server's permessage-deflate)"""
+    return framing.WebSocketFactory(SSWSFactory(server), server.deflate)
+
 import argparse
 parser = argparse.ArgumentParser(description='SSWS Back-end server (intended to be run behind an nginx proxy in production)')
 parser.add_argument(
     '-d','--directory', 
     metavar='DIRECTORY', 
-    default = '/run/shm/ssws', 
+    default = base.DEFAULT_PATH, 
     help='SSWS spooling directory, SHOULD be stored in a RAM disk'
 )
 def valid_strport(value):
@@ -314,6 +2083,132 @@ parser.add_argument(
     default = 'tcp:5775', 
     help='Specification of the listening interface in twisted.application.strports format, e.g. tcp:5900 or unix:/tmp/listening.sock', 
 )
+parser.add_argument(
+    '--log-retention', 
+    metavar='SECONDS', 
+    type=float, 
+    default=Server.LOG_RETENTION, 
+    help='Seconds to retain channel messages for late subscribers (default %(default)s)', 
+)
+parser.add_argument(
+    '--log-messages', 
+    metavar='COUNT', 
+    type=int, 
+    default=Server.LOG_MESSAGES, 
+    help='Maximum number of messages retained per channel (default %(default)s)', 
+)
+parser.add_argument(
+    '--log-bytes', 
+    metavar='BYTES', 
+    type=int, 
+    default=Server.LOG_BYTES, 
+    help='Maximum bytes of messages retained per channel (default %(default)s)', 
+)
+parser.add_argument(
+    '--queue-limit', 
+    metavar='COUNT', 
+    type=int, 
+    default=Server.QUEUE_LIMIT, 
+    help='Maximum messages queued for a connection which is not keeping up (default %(default)s)', 
+)
+parser.add_argument(
+    '--overflow', 
+    choices=base.OVERFLOW_POLICIES, 
+    default=Server.OVERFLOW, 
+    help='What to do when a connection\'s queue is full, for channels without an overflow file (default %(default)s)', 
+)
+parser.add_argument(
+    '--high-water', 
+    metavar='BYTES', 
+    type=int, 
+    default=Server.HIGH_WATER, 
+    help='Bytes buffered for a connection\'s socket before we stop writing to it (default %(default)s)', 
+)
+parser.add_argument(
+    '--ack-timeout', 
+    metavar='SECONDS', 
+    type=float, 
+    default=Server.ACK_TIMEOUT, 
+    help='Seconds an ordered connection may go without acking before its unacked messages can be pruned (default %(default)s)', 
+)
+parser.add_argument(
+    '--eager', 
+    dest='lazy', 
+    action='store_const', 
+    const=False, 
+    default=Server.LAZY, 
+    help='Load every existing session and channel before serving rather than on first use/in the background', 
+)
+parser.add_argument(
+    '--no-batch', 
+    dest='batch_outbox', 
+    action='store_const', 
+    const=False, 
+    default=Server.BATCH_OUTBOX, 
+    help='Process each outbox message as its inotify event arrives rather than draining once per reactor tick', 
+)
+parser.add_argument(
+    '--control', 
+    choices=['watch', 'journal'], 
+    default=Server.CONTROL, 
+    help='How clients signal grants/publishes, "watch" uses inotify watches on every session and channel, "journal" a single watched control directory (default %(default)s)', 
+)
+parser.add_argument(
+    '--handler', 
+    choices=sorted(HANDLERS), 
+    default=Server.HANDLER, 
+    help='What to do with messages clients send, for channels without a handler file: publish them through the spool, broadcast them in memory (optionally persisting them afterwards) or leave them in the channel\'s inbox (default %(default)s)', 
+)
+parser.add_argument(
+    '--io-threads', 
+    metavar='COUNT', 
+    type=int, 
+    default=Server.IO_THREADS, 
+    help='Threads for filesystem work which the event loop doesn\'t wait on (removing expired sessions/channels and pruned messages, activity times, persisting broadcasts) (default %(default)s)', 
+)
+parser.add_argument(
+    '--deflate-level', 
+    metavar='LEVEL', 
+    type=int, 
+    choices=range(10), 
+    default=Server.DEFLATE_LEVEL, 
+    help='Offer permessage-deflate (without context takeover, so each message is compressed once for all connections) at this zlib level, 0 to not offer it (default %(default)s)', 
+)
+parser.add_argument(
+    '--deflate-threshold', 
+    metavar='BYTES', 
+    type=int, 
+    default=Server.DEFLATE_THRESHOLD, 
+    help='Send messages smaller than this uncompressed (default %(default)s)', 
+)
+parser.add_argument(
+    '--publish', 
+    dest='publish', 
+    action='store_const', 
+    const=True, 
+    default=False, 
+    help='Accept messages from local producers on DIRECTORY/publish.sock (used automatically by ssws-message and the ssws.sync API)', 
+)
+parser.add_argument(
+    '--workers', 
+    metavar='COUNT', 
+    type=int, 
+    default=0, 
+    help='Serve connections from COUNT child processes (this process consumes the spool and relays messages to them), requires a tcp: --listen', 
+)
+parser.add_argument(
+    '--worker', 
+    metavar='NUMBER', 
+    type=int, 
+    default=None, 
+    help=argparse.SUPPRESS, 
+)
+parser.add_argument(
+    '--metrics', 
+    metavar='STRPORT', 
+    default=None, 
+    help='Serve metrics in Prometheus text format over HTTP on STRPORT, e.g. tcp:9775:interface=127.0.0.1 (includes --workers children)', 
+)
 parser.add_argument(
     '--log', 
     metavar='FILENAME', 
@@ -325,9 +2220,68 @@ parser.add_argument(
 def main():
     arguments = parser.parse_args()
     if arguments.log:
-        log.startLogging(open(arguments.log, 'w'))
+        filename = arguments.log
+        if arguments.worker is not None:
+            filename = '%s.%s'%(filename, arguments.worker)
+        log.startLogging(open(filename, 'w'))
     else:
         log.startLogging(sys.stderr)
-    server = Server(base_path=arguments.directory)
-    strports.listen(arguments.listen, txws.WebSocketFactory(SSWSFactory(server)))
+    options = dict(
+        base_path=arguments.directory, 
+        log_retention=arguments.log_retention, 
+        log_messages=arguments.log_messages, 
+        log_bytes=arguments.log_bytes, 
+        queue_limit=arguments.queue_limit, 
+        overflow=arguments.overflow, 
+        high_water=arguments.high_water, 
+        ack_timeout=arguments.ack_timeout, 
+        lazy=arguments.lazy, 
+        batch_outbox=arguments.batch_outbox, 
+        control=arguments.control, 
+        handler=arguments.handler, 
+        io_threads=arguments.io_threads, 
+        deflate_level=arguments.deflate_level, 
+        deflate_threshold=arguments.deflate_threshold, 
+    )
+    if arguments.worker is not None:
+        # a --workers child, our listening socket is fd 3
+        from twisted.internet import stdio
+        server = WorkerServer(**options)
+        # flush activity times and finish the I/O threads' work
+        reactor.addSystemEventTrigger('before', 'shutdown', server.cleanup)
+        family = listening_address(arguments.listen)[0]
+        reactor.adoptStreamPort(3, family, websocket_factory(server))
+        server.upstream = RelayProtocol(server)
+        stdio.StandardIO(server.upstream, stdout=4)
+        if arguments.metrics:
+            server.write_metrics(arguments.worker)
+        # we stop when the parent does (and closes our stdin), so that 
+        # signals sent to the whole process group don't race that
+        import signal
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        reactor.run(installSignalHandlers=False)
+        return
+    server = Server(**options)
+    # flush activity times, channel heads and in-memory messages to be 
+    # persisted, and finish the I/O threads' work
+    reactor.addSystemEventTrigger('before', 'shutdown', server.cleanup)
+    if arguments.metrics:
+        # snapshots from a previous run's workers
+        shutil.rmtree(server.metrics_path, True)
+    if arguments.workers:
+        try:
+            spawn_workers(server, arguments)
+        except (ValueError, socket.error) as err:
+            parser.error(str(err))
+    else:
+        strports.listen(arguments.listen, websocket_factory(server))
+    if arguments.publish:
+        strports.listen('unix:%s:lockfile=1'%(server.publish_path, ), PublishFactory(server))
+    if arguments.metrics:
+        from twisted.web.server import Site
+        strports.listen(arguments.metrics, Site(metrics.MetricsResource(server)))
     reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,14 @@ DEFAULT_SETTINGS = {
     'direct_url_template':'%(protocol)s://%(host_base)s:%(server_port)s/ws/%(session_key)s', 
     'proxy_test_header': 'HTTP_X_NGINX_HOSTED', 
     'server_port': 5775, 
+    # SSWS spooling directory (must match ssws-server --directory)
+    'directory': '/run/shm/ssws', 
+    # Grant session permissions with the in-process sync API, if False, 
+    # run the ssws-session command line tool instead
+    'in_process': True, 
+    # Seconds for which a process remembers the grants it has made, 
+    # so repeat requests don't touch the filesystem (0 to disable)
+    'grant_cache_ttl': 60, 
 }
 
 LOCAL_SETTINGS = getattr(settings, 'SSWS_CONFIG', {})
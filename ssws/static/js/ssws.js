@@ -6,13 +6,41 @@
             socket: null,
             ready: false,
             retry: true,
+            // reconnect after a random delay of up to retry_delay doubled 
+            // for each failed attempt (at most max_retry_delay seconds)
             retry_delay: .5,
-            current_retry_delay: 0,
+            max_retry_delay: 60,
+            retry_attempts: 0,
+            // ordered delivery, messages carry sequence numbers which we 
+            // ack (after ack_delay seconds) and resume from on reconnect, 
+            // resume (the default) turns it on so that we are re-sent what 
+            // was lost with a dropped connection
+            ordered: false,
+            resume: true,
+            ack_delay: .1,
+            sequences: {},
+            ack_timer: null,
+            // channels this connection wants (null for everything the
+            // session can read), see subscribe/unsubscribe
+            channels: null,
+            excluded: [],
+            // binary framing (the ssws.binary subprotocol), binary messages 
+            // are passed to handlers as ArrayBuffers of their payload
+            binary: false,
+            channel_numbers: {},
+            channel_names: {},
             
+            // messages sent in the same animation frame (or batch_delay 
+            // seconds, for background tabs) go out in one WebSocket frame
+            batch_delay: .05,
+            flush_scheduled: false,
             pending_queue: [],
             events: {}
         };
         $.extend(self,config);
+        if (self.resume) {
+            self.ordered = true;
+        }
         self.get_socket = function() {
             if (self.socket) {
                 if (self.socket.readyState === 0 || self.socket.readyState === 2 || self.socket.readyState === 3) {
@@ -30,7 +58,12 @@
             }
             if (self.uri) {
                 try {
-                    self.socket = new WebSocket(self.uri);
+                    if (self.binary) {
+                        self.socket = new WebSocket(self.uri, ['ssws.binary']);
+                        self.socket.binaryType = 'arraybuffer';
+                    } else {
+                        self.socket = new WebSocket(self.uri);
+                    }
                 } catch (err) {
                     self.error_callback('Connection failed '+err);
                     self.trigger_retry();
@@ -46,19 +79,61 @@
         };
         self.drain_queue = function() {
             var message;
+            var batch = [];
             var socket = self.get_socket();
+            var send_batch = function() {
+                if (batch.length == 1) {
+                    socket.send(batch[0]);
+                } else if (batch.length) {
+                    socket.send(','+JSON.stringify({'batch':batch}));
+                }
+                batch = [];
+            };
             if (socket && socket.readyState == 1) {
                 while (self.pending_queue.length) {
                     message = self.pending_queue.shift();
-                    socket.send(message);
+                    if (typeof message === 'string') {
+                        batch.push(message);
+                    } else {
+                        // binary messages can't be batched
+                        send_batch();
+                        socket.send(message);
+                    }
+                }
+                send_batch();
+            }
+        };
+        self.schedule_flush = function() {
+            // drain the queue once per animation frame
+            if (self.flush_scheduled) {
+                return;
+            }
+            self.flush_scheduled = true;
+            var flush = function() {
+                if (self.flush_scheduled) {
+                    self.flush_scheduled = false;
+                    self.drain_queue();
                 }
+            };
+            if (window.requestAnimationFrame) {
+                window.requestAnimationFrame(flush);
             }
+            // animation frames don't run in background tabs
+            window.setTimeout(flush, self.batch_delay * 1000);
         };
         self.on_open = function(evt) {
             // Send a message over to the server
-            self.current_retry_delay = self.retry_delay;
+            self.retry_attempts = 0;
             self.ready = true;
-            if (self.pending_queue.length) {
+            var control = self.interest_control();
+            if (self.ordered) {
+                control.ordered = true;
+                control.resume = self.sequences;
+            }
+            if (self.ordered || control.subscribe || control.unsubscribe) {
+                self.socket.send(','+JSON.stringify(control));
+                self.drain_queue();
+            } else if (self.pending_queue.length) {
                 // we have things to send...
                 self.drain_queue();
             } else {
@@ -75,9 +150,14 @@
         };
         self.trigger_retry = function() {
             if (self.retry) {
-                self.retry_delay *= 1.25;
-                self.retry_delay = Math.min( self.retry_delay, 60 );
-                window.setTimeout( self.start, self.retry_delay * 1000 );
+                // "full jitter", so that after a daemon restart every tab 
+                // doesn't reconnect at the same moment
+                var ceiling = Math.min(
+                    self.max_retry_delay, 
+                    self.retry_delay * Math.pow(2, self.retry_attempts)
+                );
+                self.retry_attempts += 1;
+                window.setTimeout( self.start, Math.random() * ceiling * 1000 );
             }
         };
         self.on_close = function(evt) {
@@ -107,6 +187,9 @@
             }
         };
         self.on_message = function(evt) {
+            if (typeof evt.data !== 'string') {
+                return self.on_binary(evt.data);
+            }
             var split = evt.data.indexOf(',');
             if (split == -1) {
                 self.error_callback('Invalid message from server, no channel indicator'+event.data);
@@ -114,8 +197,129 @@
             }
             var channel = evt.data.substring(0,split);
             var data = evt.data.substring(split+1,evt.data.length);
+            if (self.ordered && channel.indexOf(':') != -1) {
+                var sequence = parseInt(channel.substring(channel.indexOf(':')+1),10);
+                channel = channel.substring(0,channel.indexOf(':'));
+                if (!self.record_sequence(channel, sequence)) {
+                    return;
+                }
+            }
+            if (channel === '') {
+                self.on_control(data);
+            }
             return self.dispatch_message(channel,data);
         };
+        self.record_sequence = function(channel, sequence) {
+            // returns false if we have already seen sequence on channel
+            if (sequence <= (self.sequences[channel] || 0)) {
+                // already seen (e.g. re-sent after a reconnect)
+                return false;
+            }
+            self.sequences[channel] = sequence;
+            self.schedule_ack();
+            return true;
+        };
+        self.on_control = function(data) {
+            // control messages announce the numbers of binary channels, 
+            // and the heads of channels we have sequences beyond
+            var control;
+            try {
+                control = JSON.parse(data);
+            } catch (err) {
+                return;
+            }
+            var channel;
+            for (channel in (control.channels || {})) {
+                self.channel_numbers[channel] = control.channels[channel];
+                self.channel_names[control.channels[channel]] = channel;
+            }
+            for (channel in (control.heads || {})) {
+                // the daemon lost sequences (e.g. it crashed), carry 
+                // on from its head rather than dropping what follows
+                self.sequences[channel] = control.heads[channel];
+            }
+        };
+        self.on_binary = function(buffer) {
+            // channel number, [sequence,] payload
+            var view = new DataView(buffer);
+            var channel = self.channel_names[view.getUint32(0)];
+            var offset = 4;
+            if (channel === undefined) {
+                self.error_callback('Binary message for unknown channel '+view.getUint32(0));
+                return;
+            }
+            if (self.ordered) {
+                var sequence = view.getUint32(4) * 4294967296 + view.getUint32(8);
+                offset = 12;
+                if (!self.record_sequence(channel, sequence)) {
+                    return;
+                }
+            }
+            return self.dispatch_message(channel, buffer.slice(offset));
+        };
+        self.schedule_ack = function() {
+            if (self.ack_timer === null) {
+                self.ack_timer = window.setTimeout( self.send_ack, self.ack_delay * 1000 );
+            }
+        };
+        self.send_ack = function() {
+            self.ack_timer = null;
+            if (self.socket && self.socket.readyState == 1) {
+                // batched with anything else we are sending
+                self.pending_queue.push(','+JSON.stringify({'ack':self.sequences}));
+                self.schedule_flush();
+            }
+        };
+        self.interest_control = function() {
+            var control = {};
+            if (self.channels !== null) {
+                control.subscribe = self.channels;
+            } else if (self.excluded.length) {
+                control.unsubscribe = self.excluded;
+            }
+            return control;
+        };
+        self.send_control = function(control) {
+            var socket = self.get_socket();
+            if (socket && socket.readyState == 1) {
+                socket.send(','+JSON.stringify(control));
+            }
+            // otherwise on_open sends our interest when we connect
+        };
+        self.subscribe = function(channels) {
+            // channels -- list of channels to receive (if we were 
+            // receiving all channels, only these), or '*' for all
+            var i;
+            if (channels === '*') {
+                self.channels = null;
+                self.excluded = [];
+            } else {
+                if (self.channels === null) {
+                    // as the server does
+                    self.channels = [];
+                    self.excluded = [];
+                }
+                for (i = 0; i < channels.length; i++) {
+                    if (self.channels.indexOf(channels[i]) == -1) {
+                        self.channels.push(channels[i]);
+                    }
+                }
+            }
+            self.send_control({'subscribe':channels});
+        };
+        self.unsubscribe = function(channels) {
+            var i;
+            for (i = 0; i < channels.length; i++) {
+                if (self.channels !== null) {
+                    if (self.channels.indexOf(channels[i]) != -1) {
+                        self.channels.splice(self.channels.indexOf(channels[i]),1);
+                    }
+                } else if (self.excluded.indexOf(channels[i]) == -1) {
+                    self.excluded.push(channels[i]);
+                }
+            }
+            self.send_control({'unsubscribe':channels});
+        };
         self.dispatch_message = function(channel,data) {
             var operator = self.get_handler(channel);
             if (operator !== undefined && operator !== null) {
@@ -135,8 +339,19 @@
             self.error_callback(""+evt);
         };
         self.send = function( channel, content ) {
-            self.pending_queue.push( channel + ',' + content );
-            self.drain_queue();
+            // content -- string, or (binary mode) ArrayBuffer/typed array
+            if (typeof content !== 'string' && self.binary && self.channel_numbers[channel] !== undefined) {
+                var bytes = ArrayBuffer.isView(content) ? 
+                    new Uint8Array(content.buffer, content.byteOffset, content.byteLength) : 
+                    new Uint8Array(content);
+                var message = new Uint8Array(4 + bytes.length);
+                new DataView(message.buffer).setUint32(0, self.channel_numbers[channel]);
+                message.set(bytes, 4);
+                self.pending_queue.push( message.buffer );
+            } else {
+                self.pending_queue.push( channel + ',' + content );
+            }
+            self.schedule_flush();
         };
         self.start = function() {
             self.get_socket();
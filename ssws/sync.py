@@ -5,36 +5,234 @@ they are intended for Django and similar processes which
 want to write a message to a channel and/or add/remove 
 sessions to/from a channel.
 """
-import os, sys
+import os, sys, uuid, time, json, socket, struct, select
 import argparse
 from . import base
 
+class Publisher(object):
+    """Persistent connection to the daemon's publish socket
+    
+    One is shared by everything in a process (see publisher()), if 
+    the daemon isn't listening (or goes away) we wait RETRY_DELAY 
+    before trying to connect again, callers fall back to the spool.
+    
+    A daemon which doesn't accept/read within TIMEOUT seconds (it is 
+    stalled or falling behind) is treated as having gone away.
+    
+    Note: if the daemon dies with messages still in the socket's 
+    buffer, those messages are lost (or, if the failure is noticed 
+    part-way through a batch, may be published twice).
+    """
+    RETRY_DELAY = 5.0
+    TIMEOUT = 1.0
+    def __init__(self, path):
+        self.path = path
+        self.socket = None
+        self.pid = None
+        self.retry_after = 0
+    def connect(self):
+        if self.socket is not None and self.pid != os.getpid():
+            # forked, the parent owns that connection
+            self.socket = None
+        if self.socket is None and time.time() >= self.retry_after:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # socket.timeout is a socket.error, so we fall back to the spool
+            connection.settimeout(self.TIMEOUT)
+            try:
+                connection.connect(self.path)
+            except socket.error:
+                connection.close()
+                self.retry_after = time.time() + self.RETRY_DELAY
+                return None
+            self.socket = connection
+            self.pid = os.getpid()
+        return self.socket
+    def send(self, records):
+        """Send "channel_id,payload" records, returns False if the caller should spool them"""
+        connection = self.connect()
+        if connection is None:
+            return False
+        try:
+            connection.sendall(''.join([
+                struct.pack('!I', len(record)) + record for record in records
+            ]))
+        except socket.error:
+            self.close()
+            self.retry_after = time.time() + self.RETRY_DELAY
+            return False
+        return True
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+            self.socket = None
+
+_PUBLISHERS = {}
+def publisher(path):
+    """Get the (process-wide) Publisher for the socket at path"""
+    current = _PUBLISHERS.get(path)
+    if current is None:
+        current = _PUBLISHERS[path] = Publisher(path)
+    return current
+
+def _encoded(message):
+    if isinstance(message, unicode):
+        return message.encode('utf-8')
+    return message
+
 class Channel(base.Channel):
-    pass
+    def write(self, message, inbox=False):
+        """Publish message, returns the spool filename (or None)
+        
+        If the daemon is accepting local publishes (ssws-server --publish), 
+        the message is sent over its socket (and None returned), otherwise 
+        it is written to the spool.
+        """
+        message = _encoded(message)
+        if not inbox and isinstance(message, str):
+            if self.server.publisher().send([self.channel_id + ',' + message]):
+                return None
+        return super(Channel, self).write(message, inbox)
+    def write_many(self, messages, inbox=False):
+        """Publish a batch of messages, see write() and base.Channel.write_many"""
+        messages = [_encoded(message) for message in messages]
+        if not inbox and all([isinstance(message, str) for message in messages]):
+            prefix = self.channel_id + ','
+            if self.server.publisher().send([prefix + message for message in messages]):
+                return None
+        return super(Channel, self).write_many(messages, inbox)
+    def messages_since(self, sequence=0):
+        """Get [(sequence, message)] still in the channel's log after sequence
+        
+        Note: messages include the channel prefix as sent to clients
+        """
+        result = []
+        for filename in os.listdir(self.log_path):
+            try:
+                records = base.log_records(os.path.join(self.log_path, filename))
+            except (IOError, OSError):
+                # pruned while we were reading
+                continue
+            result.extend([
+                record for record in records if record[0] > sequence
+            ])
+        result.sort()
+        return result
+    def set_overflow(self, policy=None):
+        """Set what the daemon does with connections which fall behind on this channel
+        
+        policy -- one of base.OVERFLOW_POLICIES, None to use the daemon's 
+            default (ssws-server --overflow)
+        """
+        if policy is not None and policy not in base.OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %r"%(policy, ))
+        self._write_setting(self.overflow_path, policy)
+    def set_handler(self, handler=None):
+        """Set how the daemon handles messages clients send on this channel
+        
+        handler -- name of a handler in the daemon's service.HANDLERS, 
+            e.g. 'broadcast' to publish client messages in memory, None 
+            to use the daemon's default (ssws-server --handler)
+        """
+        if handler is not None and not base.simple_id(handler):
+            raise ValueError("Invalid handler name %r"%(handler, ))
+        self._write_setting(self.handler_path, handler)
+    def set_conflate(self, conflate=True):
+        """Set whether only the latest of this channel's messages matters
+        
+        conflate -- if True connections are sent only the newest of the 
+            channel's pending messages, and its current message when 
+            they connect
+        """
+        self._write_setting(self.conflate_path, base.FLAG_CONTENT if conflate else None)
+    def _write_setting(self, path, value):
+        """Atomically replace (or with None remove) a channel setting file"""
+        if value is None:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return
+        filename = os.path.join(self.server.spool_dir, uuid.uuid4().hex)
+        with open(filename, 'w') as fh:
+            fh.write(value)
+        os.rename(filename, path)
 
 class Session(base.Session):
-    def add_readable(self, channel_id):
-        filename = os.path.join(self.readable_path, channel_id)
+    def _write_flag(self, directory, channel_id, content=base.FLAG_CONTENT):
+        """Atomically create a flag file (so the daemon never sees partial content)"""
+        filename = os.path.join(self.server.spool_dir, uuid.uuid4().hex)
         with open(filename, 'w') as fh:
-            fh.write('flag-file')
-    def remove_readable(self, channel_id):
-        filename = os.path.join(self.readable_path, channel_id)
+            fh.write(content)
+        os.rename(filename, os.path.join(directory, channel_id))
+    def _remove_flag(self, directory, channel_id):
         try:
-            os.remove(filename)
+            os.remove(os.path.join(directory, channel_id))
             return True 
         except Exception:
             return False
+    def _grant_readable(self, channel_id, since=None):
+        """Create the flag file, returns the journal command or None"""
+        if self.can_read(channel_id):
+            return None
+        if since is None:
+            self._write_flag(self.readable_path, channel_id)
+            return ('grant', self.session_id, 'readable', channel_id)
+        self._write_flag(self.readable_path, channel_id, str(int(since)))
+        return ('grant', self.session_id, 'readable', channel_id, str(int(since)))
+    def _grant_writable(self, channel_id):
+        if self.can_write(channel_id):
+            return None
+        self._write_flag(self.writable_path, channel_id)
+        return ('grant', self.session_id, 'writable', channel_id)
+    def _revoke_readable(self, channel_id):
+        if self._remove_flag(self.readable_path, channel_id):
+            return ('revoke', self.session_id, 'readable', channel_id)
+        return None
+    def _revoke_writable(self, channel_id):
+        if self._remove_flag(self.writable_path, channel_id):
+            return ('revoke', self.session_id, 'writable', channel_id)
+        return None
+    
+    def add_readable(self, channel_id, since=None):
+        """Allow reading channel_id
+        
+        since -- if specified, the session will receive all messages 
+            still in the channel's log with a sequence > since (i.e. 0 
+            to get everything retained), otherwise only new messages
+        
+        Existing grants are left untouched (so the daemon isn't woken), 
+        returns whether we created a new grant.
+        """
+        return self.server.command([self._grant_readable(channel_id, since)])
+    def remove_readable(self, channel_id):
+        return self.server.command([self._revoke_readable(channel_id)])
     def add_writable(self, channel_id):
-        filename = os.path.join(self.writable_path, channel_id)
-        with open(filename, 'w') as fh:
-            fh.write('flag-file')
+        """Allow writing channel_id, returns whether we created a new grant"""
+        return self.server.command([self._grant_writable(channel_id)])
     def remove_writable(self, channel_id):
-        filename = os.path.join(self.writable_path, channel_id)
-        try:
-            os.remove(filename)
-            return True 
-        except Exception:
-            return False
+        return self.server.command([self._revoke_writable(channel_id)])
+    def grant(self, readable=(), writable=(), since=None):
+        """Grant read/write on many channels in one call
+        
+        readable -- channel_ids the session may read
+        writable -- channel_ids the session may write
+        since -- see add_readable
+        
+        returns whether any new grants were made
+        """
+        return self.server.command(
+            [self._grant_readable(channel_id, since) for channel_id in readable] + 
+            [self._grant_writable(channel_id) for channel_id in writable]
+        )
+    def revoke(self, readable=(), writable=()):
+        """Revoke read/write on many channels in one call"""
+        return self.server.command(
+            [self._revoke_readable(channel_id) for channel_id in readable] + 
+            [self._revoke_writable(channel_id) for channel_id in writable]
+        )
     def can_write(self, channel_id):
         return os.path.exists(os.path.join(self.writable_path, channel_id))
     def can_read(self, channel_id):
@@ -44,6 +242,42 @@ class Server(base.Server):
     """Synchronous API for the server"""
     SESSION_CLASS = Session 
     CHANNEL_CLASS = Channel
+    def publisher(self):
+        return publisher(self.publish_path)
+    def command(self, commands):
+        """Send commands (tuples, None entries ignored) to the daemon's control journal
+        
+        Only does anything when the daemon is in journal mode, otherwise 
+        it picks up the flag files via inotify. Returns whether there 
+        were any commands.
+        """
+        commands = [command for command in commands if command]
+        if commands and self.journal_mode():
+            filename = os.path.join(self.spool_dir, uuid.uuid4().hex)
+            with open(filename, 'w') as fh:
+                fh.write(''.join([' '.join(command)+'\n' for command in commands]))
+            try:
+                os.rename(filename, os.path.join(
+                    self.control_path, base.journal_name(base.COMMAND_SUFFIX)
+                ))
+            except OSError:
+                # daemon has switched out of journal mode, flag files suffice
+                os.remove(filename)
+        return bool(commands)
+    def grant(self, session_id, readable=(), writable=(), since=None):
+        """Register session_id (if necessary) and grant read/write on channels
+        
+        This is the in-process equivalent of running ssws-session, 
+        returns the Session
+        """
+        session = self.session(session_id)
+        session.grant(readable=readable, writable=writable, since=since)
+        return session
+    def revoke(self, session_id, readable=(), writable=()):
+        """Revoke read/write on channels for session_id"""
+        session = self.session(session_id)
+        session.revoke(readable=readable, writable=writable)
+        return session
 
 
 def alnum_string(input):
@@ -56,30 +290,35 @@ def alnum_string_or_empty(input):
     return alnum_string(input)
 
 parser = argparse.ArgumentParser(description='Do server-side ssws configuration from scripts/command lines')
+parser.add_argument('-d', '--directory', metavar='DIRECTORY', default=base.DEFAULT_PATH,
+                   help='SSWS spooling directory (default %(default)s)')
 parser.add_argument('session', metavar='SESSION', type=alnum_string,
                    help='Session being manipulated')
 parser.add_argument('--channel', metavar='CHANNEL',action='append', type=alnum_string_or_empty,
                     dest='channels', 
                    help='Channel to be manipulated (argument can be repeated)')
+# modes which are neither granted nor revoked are left as they are
 parser.add_argument('--writable', dest='writable', action='store_const',
-                   const=True, default=False,
+                   const=True, default=None,
                    help='Allow the session to write to the given channel')
 parser.add_argument('--readable', dest='readable', action='store_const',
-                   const=True, default=False,
-                   help='Allow the session to write to the given channel')
+                   const=True, default=None,
+                   help='Allow the session to read from the given channel')
 parser.add_argument('--no-writable', dest='writable', action='store_const',
-                   const=False, default=False,
+                   const=False, default=None,
                    help='Do not allow the session to write to the given channel')
 parser.add_argument('--no-readable', dest='readable', action='store_const',
-                   const=False, default=False,
-                   help='Do not allow the session to write to the given channel')
+                   const=False, default=None,
+                   help='Do not allow the session to read from the given channel')
+parser.add_argument('--since', dest='since', metavar='SEQUENCE', type=int, default=None,
+                   help='With --readable, also deliver retained channel messages after SEQUENCE (0 for all)')
 parser.add_argument('--remove', dest='remove', action='store_const',
                    const=True, default=False,
                    help='Cleanup/de-register this session')
 
 def session_main():
     arguments = parser.parse_args()
-    server = Server()
+    server = Server(arguments.directory)
     session = server.session(arguments.session)
     if arguments.remove:
         session.cleanup()
@@ -88,32 +327,128 @@ def session_main():
         pass
     else:
         if arguments.writable:
-            for channel in arguments.channels:
-                session.add_writable(channel)
-        else:
-            for channel in arguments.channels:
-                session.remove_writable(channel)
+            session.grant(writable=arguments.channels)
+        elif arguments.writable is not None:
+            session.revoke(writable=arguments.channels)
         if arguments.readable:
-            for channel in arguments.channels:
-                session.add_readable(channel)
-        else:
-            for channel in arguments.channels:
-                session.remove_readable(channel)
+            session.grant(readable=arguments.channels, since=arguments.since)
+        elif arguments.readable is not None:
+            session.revoke(readable=arguments.channels)
 
 mparser = argparse.ArgumentParser(description='Do server-side ssws configuration from scripts/command lines')
-mparser.add_argument('channel', metavar='CHANNEL', type=alnum_string,
-                   help='Channel to which to send message')
+mparser.add_argument('-d', '--directory', metavar='DIRECTORY', default=base.DEFAULT_PATH,
+                   help='SSWS spooling directory (default %(default)s)')
+mparser.add_argument('channel', metavar='CHANNEL', type=alnum_string, nargs='?', default=None, 
+                   help='Channel to which to send message (required unless --ndjson specifies channels)')
 mparser.add_argument('--message', dest='message', default=None,
                    help='Pass the message in as an argument, otherwise use stdin')
+mparser.add_argument('--stdin-lines', dest='stdin_lines', action='store_const',
+                   const=True, default=False,
+                   help='Stream messages from stdin, one message per line')
+mparser.add_argument('--ndjson', dest='ndjson', action='store_const',
+                   const=True, default=False,
+                   help='Stream messages from stdin, one JSON object per line with "message" and (optional) "channel" keys')
+mparser.add_argument('--batch-size', dest='batch_size', metavar='COUNT', type=int, default=1000,
+                   help='When streaming, publish at most COUNT messages per batch')
+mparser.add_argument('--flush-interval', dest='flush_interval', metavar='SECONDS', type=float, default=1.0,
+                   help='When streaming, publish pending messages once the oldest is SECONDS old')
+
+def ndjson_message(line, default_channel=None):
+    """Parse an NDJSON line into (channel_id, message)"""
+    record = json.loads(line)
+    channel_id = record.get('channel') or default_channel
+    if not channel_id or not base.simple_id(channel_id):
+        raise ValueError("Invalid/missing channel in %r"%(line, ))
+    message = record['message']
+    if not isinstance(message, basestring):
+        message = json.dumps(message)
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    return str(channel_id), message
 
+def poll_lines(stream):
+    """Generator of stream's lines which waits at most the seconds sent to it
+    
+    yields None when no line arrived in time (see stream_batches)
+    """
+    fd = stream.fileno()
+    buffer = ''
+    timeout = None
+    while True:
+        if '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            timeout = yield line + '\n'
+            continue
+        if not select.select([fd], [], [], timeout)[0]:
+            timeout = yield None
+            continue
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        buffer += data
+    if buffer:
+        yield buffer
+
+def stream_batches(lines, default_channel=None, ndjson=False, batch_size=1000, flush_interval=1.0):
+    """Group streamed lines into batches, yields (channel_id, [message,...])
+    
+    lines -- iterable of lines, generators such as poll_lines are sent 
+        the seconds until the pending messages are due, so that an idle 
+        stream doesn't hold them back
+    """
+    pending = {}
+    count = 0
+    started = None
+    lines = iter(lines)
+    send = getattr(lines, 'send', None)
+    timeout = None
+    while True:
+        try:
+            line = next(lines) if send is None else send(timeout)
+        except StopIteration:
+            break
+        line = (line or '').rstrip('\r\n')
+        if line:
+            if ndjson:
+                channel_id, message = ndjson_message(line, default_channel)
+            else:
+                channel_id, message = default_channel, line
+            pending.setdefault(channel_id, []).append(message)
+            count += 1
+            if started is None:
+                started = time.time()
+        if pending and (count >= batch_size or time.time() - started >= flush_interval):
+            for batch in sorted(pending.items()):
+                yield batch
+            pending = {}
+            count = 0
+            started = None
+        timeout = None if started is None else max((0, started + flush_interval - time.time()))
+    for batch in sorted(pending.items()):
+        yield batch
 
 def message_main():
     arguments = mparser.parse_args()
+    if not (arguments.channel or arguments.ndjson):
+        mparser.error('CHANNEL is required')
+    server = Server(arguments.directory)
+    if arguments.stdin_lines or arguments.ndjson:
+        channels = {}
+        for channel_id, messages in stream_batches(
+            poll_lines(sys.stdin), 
+            default_channel=arguments.channel, 
+            ndjson=arguments.ndjson, 
+            batch_size=arguments.batch_size, 
+            flush_interval=arguments.flush_interval, 
+        ):
+            channel = channels.get(channel_id)
+            if channel is None:
+                channel = channels[channel_id] = server.channel(channel_id)
+            channel.write_many(messages)
+        return
     if not arguments.message:
         message = sys.stdin.read()
     else:
         message = arguments.message
-    server = Server()
     channel = server.channel(arguments.channel)
     channel.write(message)
-    
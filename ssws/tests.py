@@ -1,6 +1,12 @@
 from unittest import TestCase
-import os, shutil, tempfile
-from . import sync, base
+import os, sys, json, shutil, tempfile, time, socket, zlib
+from . import sync, base, service, metrics, framing
+from twisted.internet import inotify, reactor, error
+from twisted.internet.task import LoopingCall
+from twisted.python import filepath, failure
+from twisted.test.proto_helpers import StringTransport
+import struct
+import txws
 
 class BaseTests(TestCase):
     def setUp(self):
@@ -32,6 +38,41 @@ class BaseTests(TestCase):
         session.remove_writable('moo')
         assert not session.can_write('moo')
 
+    def test_grant_idempotent(self):
+        session = self.server.session('test')
+        assert session.add_readable('moo')
+        flag = os.path.join(session.readable_path, 'moo')
+        inode = os.stat(flag).st_ino
+        assert not session.add_readable('moo')
+        assert os.stat(flag).st_ino == inode
+        assert session.add_writable('moo')
+        assert not session.add_writable('moo')
+    
+    def test_server_grant(self):
+        session = self.server.grant('test', readable=['moo', 'baa'], writable=['moo'])
+        assert session.can_read('moo') and session.can_read('baa')
+        assert session.can_write('moo') and not session.can_write('baa')
+        self.server.revoke('test', readable=['baa'], writable=['moo'])
+        assert session.can_read('moo') and not session.can_read('baa')
+        assert not session.can_write('moo')
+
+    def test_session_main(self):
+        def session_main(*args):
+            argv = sys.argv
+            sys.argv = ['ssws-session', '--directory', self.temp_path] + list(args)
+            try:
+                sync.session_main()
+            finally:
+                sys.argv = argv
+        # as views.add_session runs it, one call per mode
+        session_main('--readable', '--channel', 'moo', '--channel', 'baa', 'test')
+        session_main('--writable', '--channel', 'moo', 'test')
+        session = self.server.session('test')
+        assert session.can_read('moo') and session.can_read('baa')
+        assert session.can_write('moo') and not session.can_write('baa')
+        session_main('--no-readable', '--channel', 'moo', 'test')
+        assert not session.can_read('moo') and session.can_write('moo')
+    
     def test_channel_setup(self):
         channel = self.server.channel('moo')
         assert channel.channel_id == 'moo'
@@ -49,4 +90,937 @@ class BaseTests(TestCase):
     def test_write_cleanup(self):
         channel = self.server.channel('moo')
         self.assertRaises(base.WriteError, channel.write, None)
+        self.assertRaises(base.WriteError, channel.write_many, ['this', None])
+        assert not os.listdir(channel.outbox_path)
+    
+    def test_channel_write_many(self):
+        channel = self.server.channel('moo')
+        filename = channel.write_many(['Vladivostok', 'Omsk'])
+        assert os.listdir(channel.outbox_path) == [os.path.basename(filename)]
+        content = open(filename, 'rb').read()
+        assert content == '15:moo,Vladivostok,8:moo,Omsk,', content
+        records = [
+            content[offset:offset+length] 
+            for offset, length in base.decode_batch(content)
+        ]
+        assert records == ['moo,Vladivostok', 'moo,Omsk'], records
+    
+    def test_publish_socket(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.server.publish_path)
+        listener.listen(1)
+        channel = self.server.channel('moo')
+        try:
+            assert channel.write('Vladivostok') is None
+            assert channel.write_many(['Omsk', 'Tomsk']) is None
+            connection, _ = listener.accept()
+            expected = ''.join([
+                struct.pack('!I', len(record)) + record
+                for record in ['moo,Vladivostok', 'moo,Omsk', 'moo,Tomsk']
+            ])
+            received = ''
+            while len(received) < len(expected):
+                received += connection.recv(4096)
+            assert received == expected, repr(received)
+            connection.close()
+        finally:
+            listener.close()
+        # daemon went away, fall back to the spool
+        filename = channel.write('Vladivostok')
+        if filename is None:
+            # first write after the close may be buffered
+            filename = channel.write('Vladivostok')
+        assert os.path.dirname(filename) == channel.outbox_path, filename
+    
+    def test_publish_timeout(self):
+        # a stalled daemon, listening but never reading
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.server.publish_path)
+        listener.listen(1)
+        publisher = sync.Publisher(self.server.publish_path)
+        publisher.TIMEOUT = .05
+        try:
+            start = time.time()
+            assert not publisher.send(['moo,' + 'x'*1024*1024]*16)
+            assert time.time() - start < 5, 'blocked on the daemon'
+            # and callers spool until the retry delay has passed
+            assert publisher.connect() is None
+        finally:
+            publisher.close()
+            listener.close()
+    
+    def test_stream_batches(self):
+        lines = [
+            '{"channel":"moo","message":"Vladivostok"}\n', 
+            '{"message":{"city":"Omsk"}}\n', 
+            '\n',
+            '{"channel":"baa","message":"Tomsk"}\n', 
+        ]
+        batches = list(sync.stream_batches(lines, default_channel='moo', ndjson=True, batch_size=2))
+        assert batches == [
+            ('moo', ['Vladivostok', '{"city": "Omsk"}']), 
+            ('baa', ['Tomsk']), 
+        ], batches
+        batches = list(sync.stream_batches(['a\n', 'b\n'], default_channel='moo'))
+        assert batches == [('moo', ['a', 'b'])], batches
+        # an idle (but open) pipe doesn't hold back pending messages
+        read, write = os.pipe()
+        stream = os.fdopen(read)
+        try:
+            os.write(write, 'a\nb')
+            batches = sync.stream_batches(
+                sync.poll_lines(stream), default_channel='moo', flush_interval=.05, 
+            )
+            start = time.time()
+            assert next(batches) == ('moo', ['a']), 'unexpected batch'
+            assert time.time() - start < 1, 'waited for more input'
+            os.write(write, 'c\n')
+            os.close(write)
+            write = None
+            assert list(batches) == [('moo', ['bc'])]
+        finally:
+            stream.close()
+            if write is not None:
+                os.close(write)
         
+
+class ServiceTests(TestCase):
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp(prefix='ssws-test-', dir='/run/shm')
+        os.chmod(self.temp_path, 0775)
+        self.sync = sync.Server(self.temp_path)
+        self.server = service.Server(self.temp_path)
+    def tearDown(self):
+        self.server.cleanup()
+        shutil.rmtree(self.temp_path, True)
+    
+    def test_subscriber_index(self):
+        self.sync.session('test').add_readable('moo')
+        session = self.server.session('test')
+        assert session in self.server.subscribers['moo']
+        session.on_readable_change(
+            None, 
+            filepath.FilePath(os.path.join(session.readable_path, 'moo')), 
+            inotify.IN_DELETE, 
+        )
+        assert 'moo' not in self.server.subscribers, self.server.subscribers
+        assert 'moo' not in session.readable
+    
+    def _publish(self, channel_id, message):
+        filename = self.sync.channel(channel_id).write(message)
+        channel = self.server.channel(channel_id)
+        channel.on_outbox_message(None, filepath.FilePath(filename), inotify.IN_MOVED_TO)
+        run_pending()
+        return filename
+    
+    def test_fanout_subscribers_only(self):
+        self.sync.session('reader').add_readable('moo')
+        reader = self.server.session('reader')
+        reader.protocols.append(RecordingProtocol())
+        idle = self.server.session('idle')
+        idle.protocols.append(RecordingProtocol())
+        filename = self._publish('moo', 'Vladivostok')
+        assert reader.protocols[0].messages == ['moo,Vladivostok'], reader.protocols[0].messages
+        assert not idle.protocols[0].messages
+        assert not os.path.exists(filename)
+    
+    def test_channel_log(self):
+        for i in range(3):
+            self._publish('moo', 'message %s'%(i, ))
+        channel = self.server.channel('moo')
+        assert channel.log.head == 3, channel.log.head
+        assert not os.listdir(channel.outbox_path)
+        assert len(os.listdir(channel.log_path)) == 3
+        since = self.sync.channel('moo').messages_since(1)
+        assert since == [(2, 'moo,message 1'), (3, 'moo,message 2')], since
+    
+    def test_batch_log(self):
+        self.sync.session('test').add_readable('moo')
+        session = self.server.session('test')
+        protocol = RecordingProtocol()
+        session.protocols.append(protocol)
+        filename = self.sync.channel('moo').write_many(['message %s'%(i, ) for i in range(3)])
+        channel = self.server.channel('moo')
+        channel.on_outbox_message(None, filepath.FilePath(filename), inotify.IN_MOVED_TO)
+        run_pending()
+        assert protocol.messages == ['moo,message %s'%(i, ) for i in range(3)], protocol.messages
+        assert channel.log.head == 3
+        assert len(os.listdir(channel.log_path)) == 1
+        since = self.sync.channel('moo').messages_since(1)
+        assert since == [(2, 'moo,message 1'), (3, 'moo,message 2')], since
+        # re-loading (daemon restart) gets the same records back
+        reloaded = service.MessageLog('moo', channel.log_path, 60, 10, 1024)
+        reloaded.load()
+        assert [message.acquire() for message in reloaded.entries] == protocol.messages
+        # batch file is only removed with its last message
+        channel.log.max_messages = 1
+        channel.log.prune()
+        run_io(self.server)
+        assert len(os.listdir(channel.log_path)) == 1
+        channel.log.max_messages = 0
+        channel.log.prune()
+        run_io(self.server)
+        assert not os.listdir(channel.log_path)
+    
+    def test_publish_protocol(self):
+        self.sync.session('test').add_readable('moo')
+        session = self.server.session('test')
+        protocol = RecordingProtocol()
+        session.protocols.append(protocol)
+        publisher = service.PublishFactory(self.server).buildProtocol(None)
+        publisher.makeConnection(StringTransport())
+        data = ''.join([
+            struct.pack('!I', len(record)) + record
+            for record in ['moo,Vladivostok', 'moo,Omsk', 'moo,Tomsk']
+        ])
+        # records can span (and share) reads
+        publisher.dataReceived(data[:20])
+        publisher.dataReceived(data[20:])
+        run_pending()
+        assert protocol.messages == ['moo,Vladivostok', 'moo,Omsk', 'moo,Tomsk'], protocol.messages
+        protocol.send_pending()
+        channel = self.server.channel('moo')
+        assert [message.path for message in channel.log.entries] == [None]*3
+        # in-memory messages keep their payload for late subscribers
+        assert channel.log.since(0)[0].payload == 'moo,Vladivostok'
+        assert not os.listdir(channel.log_path)
+    
+    def test_log_retention(self):
+        self.server.log_messages = 2
+        for i in range(3):
+            self._publish('moo', 'message %s'%(i, ))
+        channel = self.server.channel('moo')
+        assert [entry.sequence for entry in channel.log.entries] == [2, 3]
+        run_io(self.server)
+        assert len(os.listdir(channel.log_path)) == 2
+        channel.log.prune(time.time() + self.server.log_retention + 1)
+        assert not channel.log.entries
+        run_io(self.server)
+        assert not os.listdir(channel.log_path)
+    
+    def test_readable_since(self):
+        for i in range(3):
+            self._publish('moo', 'message %s'%(i, ))
+        session = self.server.session('late')
+        protocol = RecordingProtocol()
+        session.protocols.append(protocol)
+        self.sync.session('late').add_readable('moo', since=1)
+        session.on_readable_change(
+            None, 
+            filepath.FilePath(os.path.join(session.readable_path, 'moo')), 
+            inotify.IN_MOVED_TO, 
+        )
+        assert protocol.messages == ['moo,message 1', 'moo,message 2'], protocol.messages
+        self._publish('moo', 'message 3')
+        assert protocol.messages[-1] == 'moo,message 3', protocol.messages
+
+    def test_restart_sequences(self):
+        self._publish('moo', 'message 1')
+        channel = self.server.channel('moo')
+        # in-memory messages leave nothing in the log directory
+        channel.publish('moo,message 2')
+        self.sync.session('test').add_readable('moo', since=0)
+        session = self.server.session('test')
+        protocol = RecordingProtocol()
+        session.protocols.append(protocol)
+        session.send_pending()
+        assert protocol.messages == ['moo,message 1', 'moo,message 2'], protocol.messages
+        run_pending()
+        run_io(self.server)
+        assert base.flag_since(os.path.join(session.readable_path, 'moo')) is None
+        self.server.cleanup()
+        self.server = service.Server(self.temp_path)
+        assert self.server.channel('moo').log.head == 2
+        # the backlog isn't re-sent, sequences carry on from 2
+        session = self.server.session('test')
+        protocol = RecordingProtocol()
+        session.protocols.append(protocol)
+        self._publish('moo', 'message 3')
+        assert protocol.messages == ['moo,message 3'], protocol.messages
+        # a log pruned to nothing still knows its head
+        channel = self.server.channel('moo')
+        channel.log.prune(time.time() + self.server.log_retention + 1)
+        run_pending()
+        run_io(self.server)
+        assert not os.listdir(channel.log_path)
+        self.server.cleanup()
+        self.server = service.Server(self.temp_path)
+        assert self.server.channel('moo').log.head == 3
+
+    def test_channel_recreate(self):
+        self.sync.session('test').add_readable('moo')
+        session = self.server.session('test')
+        websocket, transport = connect(self.server, 'test')
+        websocket.dataReceived(client_frame(',{"ordered":true}'))
+        run_pending()
+        self._publish('moo', 'first')
+        self._publish('moo', 'second')
+        websocket.dataReceived(client_frame(',{"ack":{"moo":2}}'))
+        worker_process = service.WorkerProcess(self.server, 0)
+        worker_process.makeConnection(StringTransport())
+        # reaped, the session (which has a connection) is kept
+        self.server.SESSION_TIMEOUT = 0
+        channel = self.server.channel('moo')
+        channel.active = 0
+        self.server.expire_later(self.server.channels, 'moo', channel, 0)
+        self.server.reaper()
+        assert 'moo' not in self.server.channels
+        assert '!forget moo' in worker_process.transport.value()
+        transport.clear()
+        # re-created, its sequences start again
+        self._publish('moo', 'again')
+        assert self.server.channel('moo').log.head == 1
+        assert session.cursors == {'moo': 1} and session.acked == {'moo': 0}, (session.cursors, session.acked)
+        expected = txws.make_hybi07_frame(',{"heads": {"moo": 0}}') + txws.make_hybi07_frame('moo:1,again')
+        assert transport.value() == expected, repr(transport.value())
+        # workers drop their copy of the channel
+        worker = service.WorkerServer(self.temp_path)
+        try:
+            worker.channel('moo')
+            worker.apply_command('forget moo')
+            assert 'moo' not in worker.channels
+        finally:
+            worker.cleanup()
+
+    def test_shared_payload(self):
+        protocols = []
+        for session_id in ('first', 'second'):
+            self.sync.session(session_id).add_readable('moo')
+            session = self.server.session(session_id)
+            protocols.append(RecordingProtocol())
+            session.protocols.append(protocols[-1])
+        self._publish('moo', 'Vladivostok')
+        first, second = [protocol.queued[0] for protocol in protocols]
+        assert first is second
+        assert protocols[0].messages[0] is protocols[1].messages[0]
+        assert first.refcount == 2, first.refcount
+        protocols[0].send_pending()
+        assert first.payload is not None
+        protocols[1].send_pending()
+        assert first.payload is None
+        assert first.refcount == 0
+
+    def test_shared_frames(self):
+        self.sync.session('test').add_readable('moo')
+        self.server.session('test')
+        connections = [connect(self.server, 'test') for i in range(2)]
+        self._publish('moo', 'Vladivostok')
+        run_pending()
+        frame = txws.make_hybi07_frame('moo,Vladivostok')
+        for websocket, transport in connections:
+            assert transport.value().endswith(frame), repr(transport.value())
+
+    def test_batched_drain(self):
+        self.sync.session('test').add_readable('moo')
+        self.server.session('test')
+        websocket, transport = connect(self.server, 'test')
+        run_pending()
+        transport.clear()
+        channel = self.server.channel('moo')
+        for i in range(3):
+            filename = self.sync.channel('moo').write('message %s'%(i, ))
+            channel.on_outbox_message(None, filepath.FilePath(filename), inotify.IN_MOVED_TO)
+        assert channel.log.head == 0, 'drained before the end of the tick'
+        run_pending()
+        assert channel.log.head == 3, channel.log.head
+        expected = ''.join([
+            txws.make_hybi07_frame('moo,message %s'%(i, )) for i in range(3)
+        ])
+        assert transport.value() == expected, repr(transport.value())
+
+    def test_backpressure(self):
+        self.sync.session('test').add_readable('moo')
+        self.server.session('test')
+        websocket, transport = connect(self.server, 'test')
+        run_pending()
+        transport.clear()
+        protocol = websocket.wrappedProtocol
+        assert transport.producer is protocol
+        protocol.pauseProducing()
+        for i in range(3):
+            self._publish('moo', 'message %s'%(i, ))
+        assert transport.value() == '', 'wrote to a paused connection'
+        assert protocol.queue_depth == 3, protocol.queue_depth
+        protocol.resumeProducing()
+        run_pending()
+        assert protocol.queue_depth == 0, protocol.queue_depth
+        expected = ''.join([
+            txws.make_hybi07_frame('moo,message %s'%(i, )) for i in range(3)
+        ])
+        assert transport.value() == expected, repr(transport.value())
+
+    def test_metrics(self):
+        self.sync.session('test').add_readable('moo')
+        self.server.session('test')
+        websocket, transport = connect(self.server, 'test')
+        run_pending()
+        protocol = websocket.wrappedProtocol
+        protocol.pauseProducing()
+        self._publish('moo', 'queued')
+        websocket.dataReceived(client_frame(',{}'))
+        text = metrics.render([({}, self.server.metrics.collect(self.server))])
+        for line in [
+            'ssws_connections 1',
+            'ssws_sessions{state="loaded"} 1',
+            'ssws_channel_messages_total{channel="moo"} 1',
+            'ssws_channel_subscribers{channel="moo"} 1',
+            'ssws_fan_out_seconds_count 1',
+            'ssws_queue_depth_bucket{le="1"} 1',
+            'ssws_queue_depth_bucket{le="0"} 0',
+            'ssws_received_frames_total 2',
+            'ssws_written_frames_total 0',
+        ]:
+            assert line in text.splitlines(), (line, text)
+        protocol.resumeProducing()
+        run_pending()
+        assert self.server.metrics.frames_written == 1
+        assert self.server.metrics.bytes_written == len(txws.make_hybi07_frame('moo,queued'))
+        # worker snapshots are merged in with a worker label
+        text = metrics.render([
+            ({}, self.server.metrics.collect(self.server)),
+            ({'worker': '0'}, json.loads(json.dumps(self.server.metrics.collect(self.server)))),
+        ])
+        assert text.count('# TYPE ssws_connections gauge') == 1, text
+        assert 'ssws_connections{worker="0"} 1' in text.splitlines(), text
+
+    def test_incoming_handlers(self):
+        session = self.sync.session('test')
+        session.add_readable('chat')
+        session.add_writable('chat')
+        self.server.session('test')
+        channel = self.server.channel('chat')
+        websocket, transport = connect(self.server, 'test')
+        run_pending()
+        # default, published through the spool
+        websocket.dataReceived(client_frame('chat,spooled'))
+        assert len(os.listdir(channel.outbox_path)) == 1
+        channel.drain()
+        run_pending()
+        # in memory, delivered without touching the filesystem
+        transport.clear()
+        self.sync.channel('chat').set_handler('broadcast')
+        websocket.dataReceived(client_frame('chat,hello'))
+        run_pending()
+        assert transport.value() == txws.make_hybi07_frame('chat,hello'), repr(transport.value())
+        assert not os.listdir(channel.outbox_path)
+        assert channel.log.entries[-1].path is None
+        # in memory, then written to the log
+        self.sync.channel('chat').set_handler('broadcast-persist')
+        websocket.dataReceived(client_frame('chat,kept'))
+        websocket.dataReceived(client_frame('chat,also kept'))
+        run_pending()
+        run_io(self.server)
+        assert channel.log.entries[-1].path is not None
+        records = sync.Server(self.temp_path).channel('chat').messages_since(2)
+        assert records == [(3, 'chat,kept'), (4, 'chat,also kept')], records
+        # left for the server to process
+        self.sync.channel('chat').set_handler('inbox')
+        websocket.dataReceived(client_frame('chat,question'))
+        assert len(os.listdir(channel.inbox_path)) == 1
+        # unknown handlers fall back to the server's default
+        self.sync.channel('chat').set_handler('missing')
+        assert channel.handler() == 'spool'
+
+    def test_overflow_policies(self):
+        self.server.queue_limit = 2
+        self.sync.session('test').add_readable('moo')
+        self.server.session('test')
+        for policy, expected in [
+            ('drop-oldest', ['moo,1', 'moo,2']), 
+            ('drop-newest', ['moo,0', 'moo,1']), 
+            ('coalesce', ['moo,2']), 
+        ]:
+            self.sync.channel('moo').set_overflow(policy)
+            websocket, transport = connect(self.server, 'test')
+            run_pending()
+            protocol = websocket.wrappedProtocol
+            protocol.pauseProducing()
+            for i in range(3):
+                self._publish('moo', str(i))
+            queued = [message.payload for message in protocol.outgoing_queue]
+            assert queued == expected, (policy, queued)
+            assert protocol.dropped == 3 - len(expected), (policy, protocol.dropped)
+            websocket.connectionLost(None)
+        # drop-oldest drops the oldest message, even when the new one is 
+        # the only message queued on its channel
+        self.sync.channel('moo').set_overflow('drop-oldest')
+        self.sync.session('test').add_readable('baa')
+        self.server.session('test').change_permission(True, 'readable', 'baa')
+        websocket, transport = connect(self.server, 'test')
+        run_pending()
+        protocol = websocket.wrappedProtocol
+        protocol.pauseProducing()
+        for channel_id in ('moo', 'moo', 'baa'):
+            self._publish(channel_id, 'quiet' if channel_id == 'baa' else 'busy')
+        queued = [message.payload for message in protocol.outgoing_queue]
+        assert queued == ['moo,busy', 'baa,quiet'], queued
+        websocket.connectionLost(None)
+        self.sync.channel('moo').set_overflow('disconnect')
+        websocket, transport = connect(self.server, 'test')
+        run_pending()
+        websocket.wrappedProtocol.pauseProducing()
+        for i in range(3):
+            self._publish('moo', str(i))
+        assert transport.disconnected
+    
+    def test_interest(self):
+        for channel_id in ('moo', 'baa'):
+            self.sync.session('test').add_readable(channel_id)
+        session = self.server.session('test')
+        narrow, narrow_transport = connect(self.server, 'test')
+        everything, everything_transport = connect(self.server, 'test')
+        narrow.dataReceived(client_frame(',{"subscribe":["moo"]}'))
+        run_pending()
+        narrow_transport.clear()
+        everything_transport.clear()
+        self._publish('moo', '1')
+        self._publish('baa', '1')
+        assert narrow_transport.value() == txws.make_hybi07_frame('moo,1'), repr(narrow_transport.value())
+        assert everything_transport.value().count('baa,1') == 1
+        narrow_transport.clear()
+        narrow.dataReceived(client_frame(',{"unsubscribe":["moo"]}'))
+        self._publish('moo', '2')
+        assert narrow_transport.value() == '', repr(narrow_transport.value())
+        # back to everything, only new messages for unordered connections
+        narrow.dataReceived(client_frame(',{"subscribe":"*"}'))
+        run_pending()
+        self._publish('baa', '2')
+        assert narrow_transport.value() == txws.make_hybi07_frame('baa,2'), repr(narrow_transport.value())
+        # ordered connections are sent what they skipped
+        ordered, ordered_transport = connect(self.server, 'test')
+        ordered.dataReceived(client_frame(',{"ordered":true,"unsubscribe":["moo"]}'))
+        run_pending()
+        ordered_transport.clear()
+        self._publish('moo', '3')
+        self._publish('baa', '3')
+        ordered.dataReceived(client_frame(',{"subscribe":["moo"]}'))
+        run_pending()
+        expected = txws.make_hybi07_frame('baa:3,3') + txws.make_hybi07_frame('moo:3,3')
+        assert ordered_transport.value() == expected, repr(ordered_transport.value())
+        # the other connections were not sent moo 3 twice
+        assert everything_transport.value().count('moo,3') == 1
+        # subscribing while receiving all (but excluded) channels, only those
+        everything.dataReceived(client_frame(',{"unsubscribe":["moo"]}'))
+        everything.dataReceived(client_frame(',{"subscribe":["moo"]}'))
+        run_pending()
+        everything_transport.clear()
+        self._publish('moo', '4')
+        self._publish('baa', '4')
+        assert everything_transport.value() == txws.make_hybi07_frame('moo,4'), repr(everything_transport.value())
+        assert session.readable == set(['moo', 'baa']), session.readable
+
+    def test_conflate(self):
+        self.sync.channel('status').set_conflate()
+        self._publish('status', '1')
+        self.sync.session('test').add_readable('status')
+        self.server.session('test')
+        websocket, transport = connect(self.server, 'test')
+        run_pending()
+        # new subscribers start with the current value
+        assert transport.value().endswith(txws.make_hybi07_frame('status,1')), repr(transport.value())
+        transport.clear()
+        protocol = websocket.wrappedProtocol
+        protocol.pauseProducing()
+        for i in range(2, 6):
+            self._publish('status', str(i))
+        assert protocol.queue_depth == 1, protocol.queue_depth
+        protocol.resumeProducing()
+        run_pending()
+        assert transport.value() == txws.make_hybi07_frame('status,5'), repr(transport.value())
+        channel = self.server.channel('status')
+        assert len(channel.log.entries) == 1, channel.log.entries
+        run_io(self.server)
+        assert len(os.listdir(channel.log_path)) == 1, os.listdir(channel.log_path)
+        other, other_transport = connect(self.server, 'test')
+        run_pending()
+        assert other_transport.value().endswith(txws.make_hybi07_frame('status,5')), repr(other_transport.value())
+        assert transport.value() == txws.make_hybi07_frame('status,5'), repr(transport.value())
+
+    def test_deflate(self):
+        self.server.deflate = framing.FrameMaker(6, 64)
+        self.sync.session('test').add_readable('moo')
+        self.server.session('test')
+        offer = 'permessage-deflate; client_max_window_bits'
+        compressed, compressed_transport = connect(self.server, 'test', offer)
+        shared, shared_transport = connect(self.server, 'test', offer)
+        plain, plain_transport = connect(self.server, 'test')
+        assert 'Sec-WebSocket-Extensions: permessage-deflate; server_no_context_takeover\r\n' in compressed_transport.value()
+        assert 'Sec-WebSocket-Extensions' not in plain_transport.value()
+        run_pending()
+        for transport in (compressed_transport, shared_transport, plain_transport):
+            transport.clear()
+        payload = json.dumps({'values': range(200)})
+        self._publish('moo', payload)
+        self._publish('moo', 'small')
+        big, small = txws.make_hybi07_frame('moo,' + payload), txws.make_hybi07_frame('moo,small')
+        assert plain_transport.value() == big + small
+        value = compressed_transport.value()
+        assert value == shared_transport.value()
+        assert value.endswith(small) and value[0] == '\xc1', repr(value[:8])
+        frames, rest = framing.parse_frames(value)
+        assert not rest
+        assert [flag for _, _, _, flag in frames] == [True, False]
+        assert zlib.decompressobj(-15).decompress(frames[0][2] + framing.TAIL) == 'moo,' + payload
+        assert len(value) < len(big) / 2, (len(value), len(big))
+        # clients can compress their messages too
+        compressed.dataReceived(client_frame(framing.compress(',{"subscribe":["moo"]}', 6), opcode=0x41))
+        assert compressed.wrappedProtocol.interest == set(['moo'])
+        # a message which inflates beyond MAX_MESSAGE closes the connection
+        compressed.MAX_MESSAGE = 1024
+        compressed_transport.clear()
+        compressed.dataReceived(client_frame(framing.compress('moo,' + 'x'*2048, 6), opcode=0x41))
+        assert compressed_transport.value() == txws.make_hybi07_frame('\x03\xf1Message too big', 0x8)
+        assert compressed_transport.disconnecting
+        # offers restricting our window are declined
+        assert framing.negotiate('permessage-deflate; server_max_window_bits=10') is None
+        assert framing.negotiate('x-webkit-deflate-frame, permessage-deflate; client_no_context_takeover') == (
+            'permessage-deflate; server_no_context_takeover; client_no_context_takeover', True, 
+        )
+
+    def test_binary_framing(self):
+        self.sync.session('test').add_readable('moo')
+        self.sync.session('test').add_writable('moo')
+        self.server.session('test')
+        websocket, transport = connect(self.server, 'test', protocols='base64, ssws.binary')
+        handshake, _, frames = transport.value().partition('\r\n\r\n')
+        assert 'Sec-WebSocket-Protocol: ssws.binary' in handshake, handshake
+        frames, _ = framing.parse_frames(frames)
+        welcome = json.loads(frames[0][2][1:])
+        number = welcome['channels']['moo']
+        assert welcome['success'] and number == self.server.channel_number('moo'), welcome
+        run_pending()
+        transport.clear()
+        self._publish('moo', 'hello')
+        assert transport.value() == txws.make_hybi07_frame(struct.pack('!I', number) + 'hello', 0x2), repr(transport.value())
+        # ordered connections also get the sequence
+        ordered, ordered_transport = connect(self.server, 'test', protocols='ssws.binary')
+        ordered.dataReceived(client_frame(',{"ordered":true}'))
+        run_pending()
+        ordered_transport.clear()
+        self._publish('moo', 'world')
+        frames, _ = framing.parse_frames(ordered_transport.value())
+        assert [(opcode, data) for fin, opcode, data, compressed in frames] == [
+            (framing.BINARY, struct.pack('!IQ', number, 2) + 'world'), 
+        ], frames
+        # clients publish with binary messages, which can arrive in pieces
+        message = client_frame(struct.pack('!I', number) + 'from', opcode=0x2, fin=False)
+        message += client_frame(' client', opcode=0x0)
+        for byte in message:
+            websocket.dataReceived(byte)
+        outbox = self.sync.channel('moo').outbox_path
+        assert [open(os.path.join(outbox, name)).read() for name in os.listdir(outbox)] == ['moo,from client']
+        transport.clear()
+        websocket.dataReceived(client_frame(struct.pack('!I', 9999) + 'x', opcode=0x2))
+        assert 'unknown channel number' in transport.value()
+        # text messages (and clients not asking for binary) are unchanged
+        websocket.dataReceived(
+            client_frame(',{"unsubscribe":', fin=False) + client_frame('["moo"]}', opcode=0x0)
+        )
+        assert websocket.wrappedProtocol.excluded == set(['moo'])
+        plain, plain_transport = connect(self.server, 'test')
+        run_pending()
+        plain_transport.clear()
+        self._publish('moo', 'text')
+        assert plain_transport.value().endswith(txws.make_hybi07_frame('moo,text')), repr(plain_transport.value())
+
+    def test_client_batch(self):
+        self.sync.session('test').add_readable('moo')
+        self.sync.session('test').add_writable('moo')
+        self.server.session('test')
+        websocket, transport = connect(self.server, 'test')
+        websocket.dataReceived(client_frame(',' + json.dumps({'batch': [
+            'moo,one', u'moo,t\xe9o', ',{"unsubscribe":["moo"]}',
+            ',{"batch":["moo,nested"]}', 42,
+        ]})))
+        outbox = self.sync.channel('moo').outbox_path
+        written = sorted([open(os.path.join(outbox, name)).read() for name in os.listdir(outbox)])
+        assert written == ['moo,one', u'moo,t\xe9o'.encode('utf-8')], written
+        assert websocket.wrappedProtocol.excluded == set(['moo'])
+
+    def test_ordered_delivery(self):
+        self.sync.session('test').add_readable('moo')
+        session = self.server.session('test')
+        websocket, transport = connect(self.server, 'test')
+        websocket.dataReceived(client_frame(',{"ordered":true}'))
+        run_pending()
+        transport.clear()
+        self._publish('moo', 'first')
+        self._publish('moo', 'second')
+        expected = txws.make_hybi07_frame('moo:1,first') + txws.make_hybi07_frame('moo:2,second')
+        assert transport.value() == expected, repr(transport.value())
+        websocket.dataReceived(client_frame(',{"ack":{"moo":1}}'))
+        assert session.acked == {'moo': 1}, session.acked
+        websocket.connectionLost(None)
+        self._publish('moo', 'third')
+        # reconnect, resumes after the last ack, "first" isn't re-sent
+        websocket, transport = connect(self.server, 'test')
+        run_pending()
+        transport.clear()
+        websocket.dataReceived(client_frame(',{"ordered":true}'))
+        run_pending()
+        expected = txws.make_hybi07_frame('moo:2,second') + txws.make_hybi07_frame('moo:3,third')
+        assert transport.value() == expected, repr(transport.value())
+        # client-supplied resume point
+        websocket, transport = connect(self.server, 'test')
+        run_pending()
+        transport.clear()
+        websocket.dataReceived(client_frame(',{"ordered":true,"resume":{"moo":2}}'))
+        run_pending()
+        assert transport.value() == txws.make_hybi07_frame('moo:3,third'), repr(transport.value())
+        # resuming beyond the head, the client is told to carry on from it
+        websocket, transport = connect(self.server, 'test')
+        run_pending()
+        transport.clear()
+        websocket.dataReceived(client_frame(',{"ordered":true,"resume":{"moo":10}}'))
+        run_pending()
+        assert transport.value() == txws.make_hybi07_frame(',{"heads": {"moo": 3}}'), repr(transport.value())
+    
+    def test_unacked_retention(self):
+        self.server.cleanup()
+        self.server = service.Server(self.temp_path, log_retention=0, ack_timeout=60)
+        channel = self.server.channel('moo')
+        self.sync.session('test').add_readable('moo')
+        self.server.session('test')
+        websocket, transport = connect(self.server, 'test')
+        websocket.dataReceived(client_frame(',{"ordered":true}'))
+        run_pending()
+        self._publish('moo', 'first')
+        self._publish('moo', 'second')
+        self.server.reaper()
+        assert len(channel.log.entries) == 2, 'pruned unacked messages'
+        websocket.dataReceived(client_frame(',{"ack":{"moo":1}}'))
+        self.server.reaper()
+        assert [entry.sequence for entry in channel.log.entries] == [2]
+        websocket.wrappedProtocol.last_ack -= 120
+        self.server.reaper()
+        assert not channel.log.entries, 'timed out connection still holding messages'
+    
+    def test_expiry(self):
+        self.server.SESSION_TIMEOUT = 0
+        for session_id in ('idle', 'busy', 'recent'):
+            self.server.session(session_id)
+        self.server.session('busy').protocols.append(RecordingProtocol())
+        channel = self.server.channel('moo')
+        # in-memory activity, written to disk in batches
+        recent = self.server.session('recent')
+        recent.mark_active()
+        assert recent in self.server.dirty
+        self.server.flush_activity()
+        assert not self.server.dirty
+        recent.active = time.time() + 60
+        self.server.reaper()
+        assert sorted(self.server.sessions) == ['busy', 'recent'], self.server.sessions
+        assert 'moo' not in self.server.channels
+        assert not os.path.exists(channel.channel_path)
+        # only the re-scheduled (busy, recent) checks are left
+        assert len(self.server.expiry) == 2, self.server.expiry
+    
+    def test_incremental_cleanup(self):
+        session = self.server.session('large')
+        for i in range(50000):
+            open(os.path.join(session.outbox_path, str(i)), 'w').close()
+        start = time.time()
+        session.cleanup()
+        assert time.time() - start < .1, 'cleanup blocked for %.3fs'%(time.time() - start, )
+        # the name can be re-used at once
+        assert not os.path.exists(session.session_path)
+        ticks = []
+        loop = LoopingCall(lambda: ticks.append(time.time()))
+        loop.start(.001)
+        try:
+            run_io(self.server, 60)
+        finally:
+            loop.stop()
+        assert not os.listdir(self.server.spool_dir), os.listdir(self.server.spool_dir)
+        lag = max([after - before for before, after in zip(ticks, ticks[1:])])
+        assert lag < .1, 'reactor blocked for %.3fs during the removal'%(lag, )
+
+    def test_lazy_rehydration(self):
+        self.sync.session('test').add_readable('moo')
+        self.sync.session('other').add_readable('moo')
+        self.sync.channel('moo').write('Vladivostok')
+        self.server.cleanup()
+        # the reactor's shutdown trigger stops the I/O threads again
+        self.server.io.stop()
+        self.server = service.Server(self.temp_path)
+        assert not self.server.sessions and not self.server.channels
+        assert self.server.dormant_sessions == set(['test', 'other'])
+        # first connection loads the session (and the channels it reads)
+        websocket, transport = connect(self.server, 'test')
+        assert sorted(self.server.sessions) == ['test']
+        assert 'moo' in self.server.channels
+        run_pending()
+        # published after the grant, while the daemon wasn't running
+        assert transport.value().endswith(txws.make_hybi07_frame('moo,Vladivostok'))
+        # the rest are loaded in the background
+        assert 'other' in self.server.sessions, self.server.dormant_sessions
+        assert not self.server.dormant_sessions
+    
+    def test_worker_relay(self):
+        self.sync.session('test').add_readable('moo')
+        self.server.session('test')
+        worker_process = service.WorkerProcess(self.server, 0)
+        worker_process.makeConnection(StringTransport())
+        assert self.server.relays == [worker_process]
+        self._publish('moo', 'Vladivostok')
+        self.sync.session('test').add_writable('baa')
+        self.server.session('test').change_permission(True, 'writable', 'baa')
+        relayed = worker_process.transport.value()
+        # a worker in the same spool, fed what the parent relayed
+        worker = service.WorkerServer(self.temp_path)
+        try:
+            websocket, transport = connect(worker, 'test')
+            run_pending()
+            session = worker.session('test', create=False)
+            assert session.readable == set(['moo']), session.readable
+            relay = service.RelayProtocol(worker)
+            relay.makeConnection(StringTransport())
+            relay.dataReceived(relayed)
+            self.sync.channel('moo').write('Omsk')
+            self._publish('moo', 'Tomsk')
+            relay.dataReceived(worker_process.transport.value()[len(relayed):])
+            run_pending()
+            # sent once each (the relayed "Vladivostok" was already in the worker's log)
+            assert transport.value().count(txws.make_hybi07_frame('moo,Omsk')) == 1
+            assert transport.value().count(txws.make_hybi07_frame('moo,Tomsk')) == 1
+            assert session.writable == set(['baa']), session.writable
+            # the worker never removes files from the spool
+            worker.reaper()
+            session.cleanup()
+            assert os.path.isdir(session.session_path)
+        finally:
+            worker.cleanup()
+    
+    def test_worker_restart(self):
+        spawned = []
+        worker_process = service.WorkerProcess(self.server, 3, lambda *args: spawned.append(args))
+        worker_process.makeConnection(StringTransport())
+        delays = []
+        for i in range(3):
+            call = worker_process.processEnded(failure.Failure(error.ProcessTerminated(1)))
+            delays.append(call.getTime() - reactor.seconds())
+            call.cancel()
+            worker_process.failures += 1
+        assert not self.server.relays
+        assert [round(delay) for delay in delays] == [1, 2, 4], delays
+        # a worker which ran for a while starts again from the shortest delay
+        worker_process.started -= worker_process.RESTART_RESET
+        call = worker_process.processEnded(failure.Failure(error.ProcessTerminated(1)))
+        assert round(call.getTime() - reactor.seconds()) == 1
+        function, args = call.func, call.args
+        call.cancel()
+        function(*args)
+        assert spawned == [(3, 1)], spawned
+    
+    def test_journal_control(self):
+        self.server.cleanup()
+        self.server = service.Server(self.temp_path, control='journal')
+        assert self.sync.journal_mode()
+        self.sync.grant('test', readable=['moo', 'baa'], writable=['moo'])
+        assert os.listdir(self.sync.control_path)
+        self.server.drain_control()
+        session = self.server.session('test')
+        assert session.readable == set(['moo', 'baa']), session.readable
+        assert session.writable == set(['moo']), session.writable
+        protocol = RecordingProtocol()
+        session.protocols.append(protocol)
+        self.sync.channel('moo').write('Vladivostok')
+        self.sync.channel('moo').write_many(['Omsk', 'Tomsk'])
+        self.server.drain_control()
+        assert protocol.messages == ['moo,Vladivostok', 'moo,Omsk', 'moo,Tomsk'], protocol.messages
+        self.sync.revoke('test', readable=['moo'])
+        self.server.drain_control()
+        assert session.readable == set(['baa']), session.readable
+        assert not os.listdir(self.sync.control_path)
+        # watches do not grow with sessions/channels
+        for i in range(10):
+            self.server.session('other-%s'%(i, ))
+            self.server.channel('other-%s'%(i, ))
+        assert len(self.server.inotify._watchpoints) == 3, self.server.inotify._watchpoints
+    
+    def test_journal_switch(self):
+        self.server.cleanup()
+        self.server = service.Server(self.temp_path, control='journal')
+        self.sync.grant('test', readable=['moo'])
+        self.server.cleanup()
+        # watch-mode daemon applies the left-over journal and removes it
+        self.server = service.Server(self.temp_path)
+        assert not self.sync.journal_mode()
+        assert 'moo' in self.server.session('test').readable
+        filename = self.sync.channel('moo').write('Vladivostok')
+        assert os.path.dirname(filename) == self.server.channel('moo').outbox_path
+
+def client_frame(data, opcode=0x1, fin=True):
+    """Build a (masked) client->server frame (fin=False for a fragment)"""
+    key = '\x01\x02\x03\x04'
+    if len(data) < 126:
+        length = chr(0x80|len(data))
+    else:
+        length = chr(0x80|126) + struct.pack('>H', len(data))
+    return chr((0x80 if fin else 0)|opcode) + length + key + txws.mask(data, key)
+
+def connect(server, session_id, extensions=None, protocols=None):
+    """Connect a txws-wrapped SSWSProtocol to session_id, returns (websocket, transport)
+    
+    extensions -- Sec-WebSocket-Extensions header to send
+    protocols -- Sec-WebSocket-Protocol header to send
+    """
+    factory = service.websocket_factory(server)
+    websocket = factory.buildProtocol(None)
+    transport = StringTransport()
+    transport.protocol = websocket
+    websocket.makeConnection(transport)
+    websocket.dataReceived(
+        'GET /ws/%s HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+        'Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+        'Sec-WebSocket-Version: 13\r\n%s%s\r\n'%(
+            session_id, 
+            'Sec-WebSocket-Extensions: %s\r\n'%(extensions, ) if extensions else '', 
+            'Sec-WebSocket-Protocol: %s\r\n'%(protocols, ) if protocols else '', 
+        )
+    )
+    websocket.dataReceived(client_frame(',{}'))
+    return websocket, transport
+
+def run_pending():
+    """Run reactor.callLater(0, ...) calls queued by the service (and their children)"""
+    while True:
+        due = [
+            call for call in reactor.getDelayedCalls()
+            if call.active() and call.getTime() <= reactor.seconds()
+        ]
+        if not due:
+            return
+        for call in due:
+            if call.active():
+                function, args, named = call.func, call.args, call.kw
+                call.cancel()
+                function(*args, **named)
+
+def run_io(server, timeout=10.0):
+    """Run the reactor until server's I/O threads have finished their work"""
+    end = time.time() + timeout
+    while server.io.busy() and time.time() < end:
+        reactor.iterate(.001)
+    assert not server.io.busy(), 'I/O still running after %ss'%(timeout, )
+
+class RecordingProtocol(object):
+    """Stand-in for an SSWSProtocol which records what it was sent"""
+    ready = True
+    ordered = False
+    binary = False
+    def __init__(self):
+        self.messages = []
+        self.queued = []
+    def add_message(self, message, conflate=False):
+        self.messages.append(message.acquire())
+        self.queued.append(message)
+    def schedule_send(self):
+        pass
+    def forget(self, channel_id):
+        pass
+    def rewind(self, channel_id, head):
+        pass
+    def send_pending(self):
+        while self.queued:
+            self.queued.pop(0).release()
@@ -3,19 +3,75 @@ from django.http import HttpResponse, HttpResponseRedirect
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 from annoying.decorators import render_to
-import subprocess
+import subprocess, time
 from functools import wraps
-from . import settings
+from . import settings, sync
 
 try:
     from django.utils.module_loading import import_string
 except ImportError:
     from django.utils.module_loading import import_by_path as import_string
 
-def add_session(key, readable=(), writable=()):
-    if not readable or writable:
+_SERVERS = {}
+def _sync_server(directory):
+    """Get the (cached) synchronous ssws API for directory"""
+    server = _SERVERS.get(directory)
+    if server is None:
+        server = _SERVERS[directory] = sync.Server(directory)
+    return server
+
+# (directory, key, channel, flag): expiry time for grants we have made
+_GRANTS = {}
+GRANT_CACHE_SIZE = 10000
+def _uncached(directory, key, channels, flag, now):
+    """Filter out channels this process granted (with flag) recently"""
+    return [
+        channel for channel in channels 
+        if _GRANTS.get((directory, key, channel, flag), 0) < now
+    ]
+def _remember(directory, key, channels, flag, expiry):
+    """Record that this process has granted channels (with flag)"""
+    if len(_GRANTS) > GRANT_CACHE_SIZE:
+        now = time.time()
+        for grant, current in _GRANTS.items():
+            if current < now:
+                del _GRANTS[grant]
+        if len(_GRANTS) > GRANT_CACHE_SIZE:
+            _GRANTS.clear()
+    for channel in channels:
+        _GRANTS[(directory, key, channel, flag)] = expiry
+
+def add_session(key, readable=(), writable=(), in_process=None):
+    """Register session key with ssws, granting read/write on channels
+    
+    in_process -- override settings' in_process, if False run the 
+        ssws-session command line tool (one interpreter per call)
+    
+    In-process grants which this process has already made (within 
+    settings' grant_cache_ttl) are skipped, as are grants which 
+    already exist on disk, so that repeat requests do not write 
+    flag files (and wake the daemon).
+    """
+    if in_process is None:
+        in_process = settings.SETTINGS['in_process']
+    directory = settings.SETTINGS['directory']
+    if in_process:
+        ttl = settings.SETTINGS['grant_cache_ttl']
+        if ttl:
+            now = time.time()
+            readable = _uncached(directory, key, readable, 'r', now)
+            writable = _uncached(directory, key, writable, 'w', now)
+            if not (readable or writable or _uncached(directory, key, [None], None, now)):
+                return
+        _sync_server(directory).grant(key, readable=readable, writable=writable)
+        if ttl:
+            _remember(directory, key, readable, 'r', now + ttl)
+            _remember(directory, key, writable, 'w', now + ttl)
+            _remember(directory, key, [None], None, now + ttl)
+    elif not (readable or writable):
         subprocess.check_call([
             'ssws-session', 
+                '--directory', directory, 
                 key, 
         ])
     else:
@@ -25,6 +81,7 @@ def add_session(key, readable=(), writable=()):
                 items.extend(['--channel', item])
             subprocess.check_call([
                 'ssws-session', 
+                    '--directory', directory, 
                     flag, 
             ] + items + [ 
                     key, 